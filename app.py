@@ -1,13 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, abort
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, abort, g, has_request_context
+from flask.cli import AppGroup
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
-from models import db, User, Bill, Settlement, Receipt, SystemConfig, LoginLog
+from config import Config, SQLITE_PROFILES
+from jobs import JobQueue
+from login_audit import LoginAuditWriter, archive_login_logs
+from metrics import MetricsRegistry
+from profiler import QueryProfiler
+from reconcile import StorageReconciler
+from migrations import upgrade_database
+from models import BILL_CATEGORIES, db, User, Bill, Settlement, Receipt, ReceiptBlob, SystemConfig, LoginLog, LoginStatsDaily, PairwiseBalance, Job
+from storage import ReceiptStore, StagedUpload, blob_key, blob_relative_path
+from thumbnails import Thumbnailer, delete_renditions, rendition_format, rendition_path
 from datetime import datetime, timedelta
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from functools import wraps
+from urllib.parse import quote
+from collections import Counter, OrderedDict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, object_session, selectinload
+from werkzeug.security import check_password_hash
+import atexit
+import click
+import mimetypes
 import os
+import re
 import secrets
 import shutil
-import tempfile
+import sqlite3
+import threading
+import time
 
 app = Flask(__name__)
 
@@ -24,9 +48,14 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)  # 7天有效期
 # 强制使用项目目录内的绝对路径（解决IDE运行目录问题）
 # 数据库路径 - 强制在项目目录内
 INSTANCE_PATH = os.path.join(app.root_path, 'instance')
-DB_PATH = os.path.join(INSTANCE_PATH, 'database.db')
+# DATABASE_PATH 为相对项目目录的路径或绝对路径（测试使用临时目录中的数据库）
+DB_PATH = os.path.join(app.root_path, os.environ.get('DATABASE_PATH') or os.path.join('instance', 'database.db'))
+LOG_ARCHIVE_FOLDER = os.path.join(INSTANCE_PATH, 'archive')  # 过期登录日志归档目录
+QUARANTINE_FOLDER = os.path.join(INSTANCE_PATH, 'quarantine')  # 核对凭证目录时隔离的孤儿文件
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = Config.SQLALCHEMY_ENGINE_OPTIONS
+app.config['SQLITE_PROFILE'] = Config.SQLITE_PROFILE
 
 # 文件上传配置 - 使用项目目录内的绝对路径
 UPLOAD_FOLDER = os.path.join(app.root_path, 'static', 'uploads', 'receipts')
@@ -34,10 +63,129 @@ print(f"数据库路径: {DB_PATH}")
 print(f"上传路径: {UPLOAD_FOLDER}")
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+BILLS_PAGE_SIZE = 20  # 账单列表每页数量
+BILLS_MAX_PAGE_SIZE = 100
+LOGIN_LOGS_PAGE_SIZE = 50  # 登录日志每页数量
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+receipt_store = ReceiptStore(UPLOAD_FOLDER)
+
+class UploadRequest(Request):
+    """上传文件在解析请求体时直接按块写入凭证暂存区（与存储目录同一文件系统），同时计算SHA-256
+
+    只有已登录用户提交到上传凭证的端点时才写入暂存区，其他请求的文件仍用 Werkzeug 默认的临时文件。
+    """
+    STAGING_ENDPOINTS = {'add_bill', 'edit_bill'}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in self.STAGING_ENDPOINTS and current_user.is_authenticated:
+            return receipt_store.open_staging()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+thumbnailer = Thumbnailer()
+atexit.register(thumbnailer.shutdown)
+
+# 后台任务队列（文件删除、上传后处理），处理函数见 FileUploadTransaction 之后
+job_queue = JobQueue()
+atexit.register(job_queue.shutdown)  # 后注册先执行：先停任务线程再关闭进程池
+
+def get_sqlite_profile():
+    """返回当前生效的SQLite存储配置档 (名称, PRAGMA设置)"""
+    name = app.config.get('SQLITE_PROFILE', 'balanced')
+    if name not in SQLITE_PROFILES:
+        name = 'balanced'
+    return name, SQLITE_PROFILES[name]
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    """在每个新的SQLite连接上应用存储配置档"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    _, pragmas = get_sqlite_profile()
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+# ---------------------------------------------------------------------------
+# 请求与数据库指标（/metrics 输出）
+# ---------------------------------------------------------------------------
+request_metrics = MetricsRegistry()
+request_metrics.counter('roommate_bills_http_requests_total', 'HTTP requests by endpoint, method and status code')
+request_metrics.histogram('roommate_bills_http_request_duration_seconds', 'HTTP request latency by endpoint')
+request_metrics.histogram('roommate_bills_http_response_size_bytes', 'HTTP response body size by endpoint',
+                          buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+request_metrics.gauge('roommate_bills_http_requests_in_flight', 'HTTP requests currently being handled')
+request_metrics.counter('roommate_bills_db_statements_total', 'SQL statements executed by endpoint')
+request_metrics.histogram('roommate_bills_db_statement_duration_seconds', 'SQL statement latency by endpoint',
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+atexit.register(request_metrics.flush)
+query_profiler = QueryProfiler()
+
+def metrics_endpoint_label():
+    """指标使用的端点名（路由端点名，未匹配路由为 unmatched，请求之外为 background）"""
+    if not has_request_context():
+        return 'background'
+    return request.endpoint or 'unmatched'
+
+@app.before_request
+def ensure_job_workers():
+    # fork 出的工作进程不继承任务线程，在首个请求时启动（已运行时只比较一次进程号）
+    job_queue.start(app)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.query_profile = query_profiler.start()
+    request_metrics.inc('roommate_bills_http_requests_in_flight')
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metrics_start' in g:
+        endpoint = metrics_endpoint_label()
+        request_metrics.inc('roommate_bills_http_requests_total',
+                            (('endpoint', endpoint), ('method', request.method), ('status', str(response.status_code))))
+        request_metrics.observe('roommate_bills_http_request_duration_seconds',
+                                time.perf_counter() - g.pop('metrics_start'), (('endpoint', endpoint),))
+        # 流式响应没有长度，不计入
+        if response.content_length is not None:
+            request_metrics.observe('roommate_bills_http_response_size_bytes',
+                                    response.content_length, (('endpoint', endpoint),))
+        query_profiler.finish(g.pop('query_profile', None), endpoint, response)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    request_metrics.inc('roommate_bills_http_requests_in_flight', amount=-1)
+    if 'metrics_start' in g:
+        # 未经过 after_request（视图抛出未处理异常）
+        endpoint = metrics_endpoint_label()
+        request_metrics.inc('roommate_bills_http_requests_total',
+                            (('endpoint', endpoint), ('method', request.method), ('status', '500')))
+        request_metrics.observe('roommate_bills_http_request_duration_seconds',
+                                time.perf_counter() - g.pop('metrics_start'), (('endpoint', endpoint),))
+        query_profiler.finish(g.pop('query_profile', None), endpoint)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_metrics(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_statement_start'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement_metrics(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_statement_start', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    endpoint = metrics_endpoint_label()
+    labels = (('endpoint', endpoint),)
+    request_metrics.inc('roommate_bills_db_statements_total', labels)
+    request_metrics.observe('roommate_bills_db_statement_duration_seconds', elapsed, labels)
+    query_profiler.record(g.get('query_profile') if has_request_context() else None, statement, elapsed, endpoint)
+
 # 初始化扩展
 db.init_app(app)
 login_manager = LoginManager()
@@ -48,9 +196,114 @@ login_manager.login_view = 'login'
 login_manager.remember_cookie_duration = timedelta(days=30)  # 记住我30天
 login_manager.session_protection = 'strong'  # 强会话保护
 
+class UserSnapshot:
+    """只读的用户快照，作为已登录请求中的 current_user
+
+    不绑定数据库会话，可在线程间共享；需要修改用户时请用 get_current_user_for_update()。
+    """
+    FIELDS = ('id', 'username', 'password_hash', 'display_name', 'created_at', 'is_default_password',
+              'is_admin', 'last_login', 'login_attempts', 'locked_until', 'is_active')
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            object.__setattr__(self, field, getattr(user, field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'UserSnapshot 为只读对象，无法修改 {name}')
+
+    def get_id(self):
+        return str(self.id)
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.username}>'
+
+class UserCache:
+    """按用户ID缓存只读快照（LRU + TTL，线程安全）"""
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (快照, 写入时间)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            snapshot, cached_at = entry
+            if self.ttl and time.monotonic() - cached_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, user_id, snapshot):
+        with self._lock:
+            self._entries[user_id] = (snapshot, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """使指定用户（或全部）的缓存失效"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+user_cache = UserCache()
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _track_modified_user(mapper, connection, user):
+    """记录本事务中被修改的用户，提交后再失效缓存"""
+    object_session(user).info.setdefault('modified_user_ids', set()).add(user.id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_modified_users(session):
+    for user_id in session.info.pop('modified_user_ids', ()):
+        user_cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_modified_users(session):
+    session.info.pop('modified_user_ids', None)
+    session.info.pop('jobs_enqueued', None)
+
+@event.listens_for(Session, 'after_commit')
+def _wake_job_workers(session):
+    # 任务随事务提交后才可见，此时再唤醒工作线程
+    if session.info.pop('jobs_enqueued', False):
+        job_queue.wake()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    snapshot = user_cache.get(user_id)
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user)
+        user_cache.put(user_id, snapshot)
+    return snapshot
+
+def get_current_user_for_update():
+    """获取当前登录用户的可写（绑定会话的）实例"""
+    return db.session.get(User, current_user.id)
+
+def get_user_map():
+    """返回本次请求内共享的 {用户ID: User} 映射（每个请求只查询一次）"""
+    if 'user_map' not in g:
+        g.user_map = {user.id: user for user in User.query.all()}
+    return g.user_map
 
 def admin_required(f):
     """管理员权限检查装饰器"""
@@ -133,39 +386,54 @@ def estimate_files_size(files):
     return total_size / (1024 * 1024)  # 转换为MB
 
 class FileUploadTransaction:
-    """文件上传事务管理器"""
+    """文件上传事务管理器
+
+    save_file() 登记凭证记录和文件引用；提交时先把暂存文件原子移动到内容寻址存储，再提交数据库。
+    上传后处理（图片压缩、缩略图）作为后台任务与凭证记录一起提交，见 process_receipt_job。
+    数据库提交失败时删除本次新增且无人引用的文件；出现异常时回滚，暂存文件随请求结束自动删除。
+    """
 
-    def __init__(self, bill_id):
+    def __init__(self, bill_id, keep_original=False):
         self.bill_id = bill_id
-        self.temp_dir = None
-        self.uploaded_files = []
+        self.keep_original = keep_original  # 图片压缩时是否保留原图
+        self.staged_files = []  # [(StagedUpload, 原文件名, Receipt)]
         self.database_objects = []
 
     def __enter__(self):
         """开始事务"""
-        # 创建临时目录
-        self.temp_dir = tempfile.mkdtemp(prefix=f'bill_{self.bill_id}_')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """结束事务，如果有异常则回滚"""
-        if exc_type is not None:
-            # 发生异常，执行回滚
-            self.rollback()
-        else:
-            # 没有异常，提交事务
-            self.commit()
-
-        # 清理临时目录
-        if self.temp_dir and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir, ignore_errors=True)
-
-    def save_file(self, file, filename):
-        """保存文件到临时目录"""
-        temp_path = os.path.join(self.temp_dir, filename)
-        file.save(temp_path)
-        self.uploaded_files.append((temp_path, filename))
-        return temp_path
+        try:
+            if exc_type is not None:
+                # 发生异常，执行回滚
+                self.rollback()
+            else:
+                # 没有异常，提交事务
+                self.commit()
+        finally:
+            for staged, _, _ in self.staged_files:
+                staged.close()
+
+    def save_file(self, file):
+        """暂存上传文件并创建对应的 Receipt 记录（随事务提交）"""
+        staged = file.stream if isinstance(file.stream, StagedUpload) else receipt_store.stage(file.stream)
+        key = blob_key(staged.sha256, file.filename)
+        filename = secure_filename_with_timestamp(file.filename)
+
+        ReceiptBlob.acquire(key, staged.size)
+        receipt = Receipt(
+            bill_id=self.bill_id,
+            filename=filename,
+            file_type='pdf' if filename.lower().endswith('.pdf') else 'image',
+            file_size=staged.size,
+            original_size=staged.size,
+            blob_key=key
+        )
+        self.add_database_object(receipt)
+        self.staged_files.append((staged, file.filename, receipt))
+        return receipt
 
     def add_database_object(self, obj):
         """添加数据库对象到事务"""
@@ -173,18 +441,23 @@ class FileUploadTransaction:
         db.session.add(obj)
 
     def commit(self):
-        """提交事务 - 移动文件到最终位置"""
-        if not self.uploaded_files:
-            return
-
-        # 创建目标目录
-        bill_folder = os.path.join(UPLOAD_FOLDER, str(self.bill_id))
-        os.makedirs(bill_folder, exist_ok=True)
-
-        # 移动文件到最终位置
-        for temp_path, filename in self.uploaded_files:
-            final_path = os.path.join(bill_folder, filename)
-            shutil.move(temp_path, final_path)
+        """提交事务 - 移动文件到存储后提交数据库"""
+        created_keys = []
+        try:
+            db.session.flush()  # 取得凭证ID
+            for staged, original_name, receipt in self.staged_files:
+                key, created = receipt_store.commit(staged, original_name)
+                if created:
+                    created_keys.append(key)
+                job_queue.enqueue('process_receipt', {
+                    'receipt_id': receipt.id, 'blob_key': key, 'keep_original': self.keep_original
+                }, key=f'process_receipt:{receipt.id}')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for key in created_keys:
+                delete_unreferenced_blob(key)
+            raise
 
     def rollback(self):
         """回滚事务 - 删除数据库对象"""
@@ -193,10 +466,159 @@ class FileUploadTransaction:
             if obj in db.session:
                 db.session.expunge(obj)
 
-        # 临时文件会在 __exit__ 中自动清理
+        # 暂存文件会在 __exit__ 中自动清理
+
+def image_optimize_enabled():
+    return app.config.get('IMAGE_OPTIMIZE', True) and thumbnailer.active
+
+@job_queue.handler('process_receipt')
+def process_receipt_job(payload):
+    """上传后处理：压缩图片（启用时）并生成缩略图和预览图，重复执行时跳过已完成的步骤"""
+    receipt_id = payload['receipt_id']
+    receipt = db.session.get(Receipt, receipt_id)
+    if receipt is None or not receipt.blob_key:
+        return  # 凭证已删除
+    key, file_type = receipt.blob_key, receipt.file_type
+    # 结束读事务：图片处理耗时较长，WAL 模式下读事务期间若有其他连接提交，无法再升级为写事务
+    db.session.rollback()
+
+    if file_type == 'image' and key == payload['blob_key'] and image_optimize_enabled():
+        key = optimize_receipt_image(receipt_id, key, payload.get('keep_original', False))
+        if key is None:
+            return
+    # 已有缩略图的文件（重复上传）在工作进程中会直接跳过
+    thumbnailer.generate(receipt_store.path(key), file_type)
+
+def optimize_receipt_image(receipt_id, source_key, keep_original=False):
+    """在进程池中压缩凭证图片并等待结果，压缩有效时把凭证切换到新文件
+
+    返回凭证当前的存储键；凭证在压缩期间被删除时返回 None。
+    """
+    result = thumbnailer.optimize(
+        receipt_store.path(source_key), receipt_store.staging_dir,
+        app.config.get('IMAGE_MAX_DIMENSION', 2560),
+        app.config.get('IMAGE_FORMAT', 'webp'),
+        app.config.get('IMAGE_QUALITY', 85)
+    ).result()
+
+    receipt = db.session.get(Receipt, receipt_id)
+    if result is None or receipt is None or receipt.blob_key != source_key:
+        # 未压缩（动图、已足够小），或压缩期间凭证已被删除或修改
+        if result is not None:
+            os.remove(result[0])
+        return receipt.blob_key if receipt is not None else None
+
+    staged_path, sha256, size, ext = result
+    new_filename = os.path.splitext(receipt.filename)[0] + ext
+    key = blob_key(sha256, new_filename)
+    created = False
+    try:
+        # 先登记引用（取得写锁）再提交文件，与 delete_unreferenced_blob 互斥
+        ReceiptBlob.acquire(key, size)
+        key, created = receipt_store.commit_path(staged_path, sha256, new_filename)
+        if receipt.bill.receipt_filename == receipt.filename:
+            receipt.bill.receipt_filename = new_filename
+        receipt.filename = new_filename
+        receipt.blob_key = key
+        receipt.file_size = size
+        if keep_original:
+            receipt.original_blob_key = source_key
+        else:
+            enqueue_file_deletion(ReceiptBlob.release([source_key]), [])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if created:
+            delete_unreferenced_blob(key)
+        raise
+    return key
+
+@app.context_processor
+def inject_upload_options():
+    return {'image_optimize_enabled': image_optimize_enabled()}
+
+def enqueue_file_deletion(blob_keys, legacy_paths):
+    """在释放文件引用的事务中登记删除任务，提交后由后台任务删除不再被引用的文件"""
+    for key in blob_keys:
+        job_queue.enqueue('delete_blob', {'key': key}, key=f'delete_blob:{key}')
+    for relative_path in legacy_paths:
+        job_queue.enqueue('delete_legacy_file', {'path': relative_path}, key=f'delete_legacy_file:{relative_path}')
+
+def delete_unreferenced_blob(key):
+    """文件不再被引用时删除（连同缩略图），返回是否已删除
+
+    引用检查和删除在同一个数据库写锁内完成：释放引用之后可能已有相同内容的新上传复用了该文件。
+    """
+    try:
+        if ReceiptBlob.is_referenced(key, for_update=True):
+            return False
+        delete_renditions(receipt_store.path(key))
+        receipt_store.delete(key)
+        return True
+    finally:
+        db.session.rollback()  # 释放写锁（未修改数据）
+
+@job_queue.handler('delete_blob')
+def delete_blob_job(payload):
+    key = payload['key']
+    if delete_unreferenced_blob(key):
+        print(f"已删除凭证文件: {key}")
+
+@job_queue.handler('delete_legacy_file')
+def delete_legacy_file_job(payload):
+    file_path = os.path.join(UPLOAD_FOLDER, payload['path'])
+    delete_renditions(file_path)
+    try:
+        os.remove(file_path)
+        print(f"已删除凭证文件: {file_path}")
+    except FileNotFoundError:
+        pass
+
+    # 删除旧版账单文件夹（如果为空）
+    bill_folder = os.path.dirname(file_path)
+    try:
+        if os.path.isdir(bill_folder) and not os.listdir(bill_folder):
+            os.rmdir(bill_folder)
+            print(f"已删除空目录: {bill_folder}")
+    except OSError as e:
+        print(f"删除目录失败: {bill_folder}, 错误: {e}")
+
+storage_reconciler = StorageReconciler(
+    UPLOAD_FOLDER, os.path.join(INSTANCE_PATH, 'storage_checkpoint.json'), QUARANTINE_FOLDER
+)
+
+def schedule_storage_reconcile():
+    """登记下一次凭证目录核对（已有待执行的核对时忽略），随当前事务提交"""
+    interval = app.config.get('STORAGE_RECONCILE_INTERVAL', 24 * 3600)
+    if interval > 0:
+        job_queue.enqueue('reconcile_storage', key='reconcile_storage', delay=interval)
+
+def reconcile_storage(quarantine=False, full=False):
+    """核对凭证目录与数据库，打印孤儿文件和缺失文件，返回报告"""
+    report = storage_reconciler.run(quarantine=quarantine, full=full)
+    print(f"凭证目录核对完成: {report['files']} 个文件，重新扫描 {report['rescanned_directories']}/"
+          f"{report['directories']} 个目录，孤儿文件 {len(report['orphans'])} 个"
+          f"（{report['orphan_bytes'] / 1024 / 1024:.1f}MB，已隔离 {report['quarantined']} 个），"
+          f"缺失文件 {len(report['missing'])} 个，耗时 {report['duration_seconds']}s")
+    for path in report['missing']:
+        print(f"缺失凭证文件: {path}")
+    return report
+
+@job_queue.handler('reconcile_storage')
+def reconcile_storage_job(payload):
+    """定期核对凭证目录；失败时不重试，等待下一次定期执行"""
+    try:
+        reconcile_storage(quarantine=app.config.get('STORAGE_RECONCILE_ACTION') == 'quarantine')
+    except Exception as e:
+        db.session.rollback()
+        print(f"凭证目录核对失败: {e}")
+    schedule_storage_reconcile()
+
+login_audit = LoginAuditWriter(app, LOG_ARCHIVE_FOLDER)
+atexit.register(login_audit.shutdown)
 
 def log_login_attempt(username, user_id=None, success=True, failure_reason=None):
-    """记录登录尝试"""
+    """记录登录尝试（异步批量写入，不阻塞登录请求）"""
     # 获取客户端IP地址
     ip_address = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', '未知'))
     if ',' in ip_address:
@@ -205,32 +627,29 @@ def log_login_attempt(username, user_id=None, success=True, failure_reason=None)
     # 获取用户代理
     user_agent = request.headers.get('User-Agent', '未知')[:500]  # 限制长度
 
-    # 创建日志记录
-    login_log = LoginLog(
-        user_id=user_id,
-        username=username,
-        ip_address=ip_address,
-        user_agent=user_agent,
-        success=success,
-        failure_reason=failure_reason
-    )
-
-    db.session.add(login_log)
-    try:
-        db.session.commit()
-    except:
-        db.session.rollback()
+    # 登录时间在请求时确定，而不是写入时
+    login_audit.submit({
+        'user_id': user_id,
+        'username': username,
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        'login_time': datetime.utcnow(),
+        'success': success,
+        'failure_reason': failure_reason
+    })
 
 def init_database():
     """初始化数据库和默认用户"""
     # 确保必要的目录存在 - 使用明确的路径
     os.makedirs(INSTANCE_PATH, exist_ok=True)
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
     print(f"创建目录: {INSTANCE_PATH}")
     print(f"创建目录: {app.config['UPLOAD_FOLDER']}")
 
-    db.create_all()
+    # 按版本号执行数据库迁移（结构已是最新时只做一次版本查询）
+    upgrade_database()
 
     # 检查是否已有用户
     if User.query.count() == 0:
@@ -256,6 +675,31 @@ def init_database():
         print("已创建默认用户账号")
 
     # 初始化系统配置
+    SystemConfig.configure_cache(app.config.get('SYSTEM_CONFIG_CACHE_TTL'))
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', user_cache.ttl)
+    user_cache.max_size = app.config.get('USER_CACHE_SIZE', user_cache.max_size)
+    login_audit.enabled = app.config.get('LOGIN_AUDIT_ASYNC', login_audit.enabled)
+    request_metrics.configure(app.config.get('METRICS_MULTIPROC_DIR'))
+    thumbnailer.enabled = app.config.get('THUMBNAILS_ENABLED', thumbnailer.enabled)
+    if app.config.get('RECEIPT_SENDFILE') == 'x-sendfile':
+        app.config['USE_X_SENDFILE'] = True
+    thumbnailer.max_workers = app.config.get('THUMBNAIL_WORKERS', thumbnailer.max_workers)
+    job_queue.workers = app.config.get('JOB_WORKERS', job_queue.workers)
+    job_queue.poll_interval = app.config.get('JOB_POLL_INTERVAL', job_queue.poll_interval)
+    job_queue.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', job_queue.max_attempts)
+    job_queue.retry_delay = app.config.get('JOB_RETRY_DELAY', job_queue.retry_delay)
+    job_queue.retention_days = app.config.get('JOB_RETENTION_DAYS', job_queue.retention_days)
+    storage_reconciler.min_age = app.config.get('STORAGE_ORPHAN_MIN_AGE', storage_reconciler.min_age)
+    query_profiler.configure(
+        enabled=app.config.get('SQL_PROFILER', query_profiler.enabled),
+        slow_query_ms=app.config.get('SQL_SLOW_QUERY_MS', query_profiler.slow_query_ms),
+        n_plus_one_threshold=app.config.get('SQL_N_PLUS_ONE_THRESHOLD', query_profiler.n_plus_one_threshold)
+    )
+    system_gauges.interval = app.config.get('METRICS_REFRESH_INTERVAL', system_gauges.interval)
+    health_checker.interval = app.config.get('HEALTH_CHECK_INTERVAL', health_checker.interval)
+    login_audit.max_queue = app.config.get('LOGIN_AUDIT_QUEUE_SIZE', login_audit.max_queue)
+    login_audit.batch_size = app.config.get('LOGIN_AUDIT_BATCH_SIZE', login_audit.batch_size)
+    login_audit.flush_interval = app.config.get('LOGIN_AUDIT_FLUSH_INTERVAL', login_audit.flush_interval)
     if SystemConfig.query.count() == 0:
         default_configs = [
             # 安全设置
@@ -272,6 +716,7 @@ def init_database():
             # 系统设置
             ('system.default_password', 'password123', '系统默认密码'),
             ('system.name', '室友记账系统', '系统名称'),
+            ('system.login_log_retention_days', '90', '登录日志保留天数（超过后归档，0表示不归档）'),
         ]
 
         for key, value, description in default_configs:
@@ -280,18 +725,67 @@ def init_database():
         db.session.commit()
         print("已初始化系统配置")
 
+    SystemConfig.load_cache()
+
+    # 启动任务工作线程，继续执行上次退出前未完成的任务
+    schedule_storage_reconcile()
+    db.session.commit()
+    job_queue.start(app)
+
 @app.route('/')
 def index():
     if not current_user.is_authenticated:
         return redirect(url_for('login'))
 
-    # 获取所有账单
-    bills = Bill.query.order_by(Bill.date.desc()).all()
+    # 服务器端只渲染第一页账单，其余通过 /api/bills 滚动加载
+    user_map = get_user_map()
+    bills, next_cursor = query_bills_page({})
+
+    # 账单结算统计（全量）
+    bill_stats = {'settled': 0, 'unsettled': 0}
+    for is_settled, count in db.session.query(Bill.is_settled, db.func.count(Bill.id)).group_by(Bill.is_settled):
+        bill_stats['settled' if is_settled else 'unsettled'] += count
 
     # 计算债务明细
-    debt_details = calculate_debt_details(current_user.id)
+    debt_details = get_debt_details(current_user.id)
+
+    return render_template('index.html', bills=bills, next_cursor=next_cursor, bill_stats=bill_stats,
+                         debt_details=debt_details, user_map=user_map)
 
-    return render_template('index.html', bills=bills, debt_details=debt_details)
+def query_bills_page(args):
+    """按游标分页查询账单（按 (date, id) 倒序，走 ix_bill_date_id 索引）
+
+    支持的参数：before=<ISO日期时间>,<账单ID>、limit、payer、participant、
+    settled=true/false、from/to=YYYY-MM-DD。参数无效时抛出 ValueError。
+    返回 (账单列表, 下一页游标或None)。
+    """
+    limit = min(int(args.get('limit') or BILLS_PAGE_SIZE), BILLS_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('limit 必须为正整数')
+
+    participant = args.get('participant')
+    query = Bill.participated_by(int(participant)) if participant else Bill.query
+
+    if args.get('payer'):
+        query = query.filter(Bill.payer_id == int(args['payer']))
+    if args.get('settled'):
+        query = query.filter(Bill.is_settled == (args['settled'].lower() == 'true'))
+    if args.get('from'):
+        query = query.filter(Bill.date >= datetime.strptime(args['from'], '%Y-%m-%d'))
+    if args.get('to'):
+        query = query.filter(Bill.date < datetime.strptime(args['to'], '%Y-%m-%d') + timedelta(days=1))
+    if args.get('before'):
+        before_date, before_id = args['before'].rsplit(',', 1)
+        query = query.filter(
+            db.tuple_(Bill.date, Bill.id) < (datetime.fromisoformat(before_date), int(before_id))
+        )
+
+    bills = Bill.with_details(query).order_by(Bill.date.desc(), Bill.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(bills) > limit:
+        bills = bills[:limit]
+        next_cursor = f"{bills[-1].date.isoformat()},{bills[-1].id}"
+    return bills, next_cursor
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -416,9 +910,10 @@ def change_password():
             return render_template('change_password.html')
 
         # 更新密码
-        current_user.set_password(new_password)
-        current_user.is_default_password = False  # 标记不再是默认密码
-        current_user.reset_login_attempts()  # 重置登录失败次数
+        user = get_current_user_for_update()
+        user.set_password(new_password)
+        user.is_default_password = False  # 标记不再是默认密码
+        user.reset_login_attempts()  # 重置登录失败次数
         db.session.commit()
 
         flash('密码修改成功！', 'success')
@@ -438,7 +933,8 @@ def settings():
             return render_template('settings.html', user=current_user)
 
         # 更新显示名称
-        current_user.display_name = new_display_name
+        user = get_current_user_for_update()
+        user.display_name = new_display_name
         db.session.commit()
 
         flash('个人信息更新成功！', 'success')
@@ -483,17 +979,9 @@ def admin():
         else:
             config_groups.setdefault('other', []).append(config)
 
-    # 获取登录日志统计
-    total_logs = LoginLog.query.count()
-    success_logs = LoginLog.query.filter_by(success=True).count()
-    failed_logs = total_logs - success_logs
-
-    log_stats = {
-        'total': total_logs,
-        'success': success_logs,
-        'failed': failed_logs,
-        'success_rate': round((success_logs / total_logs * 100) if total_logs > 0 else 0, 1)
-    }
+    # 获取登录日志统计（先写入队列中尚未落库的日志，统计读每日汇总表）
+    login_audit.flush(timeout=1)
+    log_stats = LoginStatsDaily.get_totals()
 
     return render_template('admin.html',
                          users=users,
@@ -509,18 +997,26 @@ def admin():
 def admin_config():
     """系统配置管理（仅处理POST请求）"""
     # 更新配置值
+    configs = {config.key: config for config in SystemConfig.query.all()}
     for key in request.form:
         if key.startswith('config_'):
             config_key = key[7:]  # 移除 'config_' 前缀
             value = request.form[key]
 
             # 查找并更新配置
-            config = SystemConfig.query.filter_by(key=config_key).first()
+            config = configs.get(config_key)
             if config:
                 config.value = value
                 config.updated_at = datetime.utcnow()
 
-    db.session.commit()
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # 写入后刷新缓存（提交失败时回滚后重新加载，保证与数据库一致）
+        SystemConfig.load_cache()
     flash('系统配置已更新', 'success')
     return redirect(url_for('admin'))
 
@@ -528,44 +1024,55 @@ def admin_config():
 @login_required
 @admin_required
 def admin_logs():
-    """查看登录日志"""
-    # 获取分页参数
-    page = request.args.get('page', 1, type=int)
-    per_page = 50
-
-    # 获取筛选参数
-    username_filter = request.args.get('username', '')
-    success_filter = request.args.get('success', '')
-
-    # 构建查询
-    query = LoginLog.query
+    """查看登录日志（全文搜索 + 游标分页）"""
+    # 先写入队列中尚未落库的日志
+    login_audit.flush(timeout=1)
 
-    if username_filter:
-        query = query.filter(LoginLog.username.like(f'%{username_filter}%'))
+    filters = {key: request.args[key].strip() for key in ('q', 'username', 'success', 'from', 'to')
+               if request.args.get(key, '').strip()}
+    try:
+        logs, next_cursor = query_login_logs_page(request.args)
+    except ValueError:
+        flash('筛选参数无效', 'error')
+        return redirect(url_for('admin_logs'))
 
-    if success_filter:
-        success_bool = success_filter.lower() == 'true'
-        query = query.filter(LoginLog.success == success_bool)
+    # 统计信息（读每日汇总表，包含已归档的日志）
+    stats = LoginStatsDaily.get_totals()
 
-    # 按时间倒序排列并分页
-    logs = query.order_by(LoginLog.login_time.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
+    return render_template('admin_logs.html', logs=logs, stats=stats, filters=filters,
+                         next_cursor=next_cursor, is_first_page=not request.args.get('before'))
 
-    # 统计信息
-    total_logs = LoginLog.query.count()
-    success_logs = LoginLog.query.filter_by(success=True).count()
-    failed_logs = total_logs - success_logs
+def query_login_logs_page(args):
+    """按游标分页查询登录日志（按 (login_time, id) 倒序，走 ix_login_log_login_time 索引）
 
-    stats = {
-        'total': total_logs,
-        'success': success_logs,
-        'failed': failed_logs,
-        'success_rate': round((success_logs / total_logs * 100) if total_logs > 0 else 0, 1)
-    }
+    支持的参数：q=全文搜索、username=用户名（子串）、success=true/false、
+    from/to=YYYY-MM-DD、before=<ISO日期时间>,<日志ID>。参数无效时抛出 ValueError。
+    返回 (日志列表, 下一页游标或None)。
+    """
+    query = LoginLog.query.options(selectinload(LoginLog.user))
+
+    if args.get('q', '').strip():
+        query = query.filter(LoginLog.text_filter(args['q']))
+    if args.get('username', '').strip():
+        query = query.filter(LoginLog.text_filter(args['username'], column='username'))
+    if args.get('success'):
+        query = query.filter(LoginLog.success == (args['success'].lower() == 'true'))
+    if args.get('from'):
+        query = query.filter(LoginLog.login_time >= datetime.strptime(args['from'], '%Y-%m-%d'))
+    if args.get('to'):
+        query = query.filter(LoginLog.login_time < datetime.strptime(args['to'], '%Y-%m-%d') + timedelta(days=1))
+    if args.get('before'):
+        before_time, before_id = args['before'].rsplit(',', 1)
+        query = query.filter(
+            db.tuple_(LoginLog.login_time, LoginLog.id) < (datetime.fromisoformat(before_time), int(before_id))
+        )
 
-    return render_template('admin_logs.html', logs=logs, stats=stats,
-                         username_filter=username_filter, success_filter=success_filter)
+    logs = query.order_by(LoginLog.login_time.desc(), LoginLog.id.desc()).limit(LOGIN_LOGS_PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(logs) > LOGIN_LOGS_PAGE_SIZE:
+        logs = logs[:LOGIN_LOGS_PAGE_SIZE]
+        next_cursor = f"{logs[-1].login_time.isoformat()},{logs[-1].id}"
+    return logs, next_cursor
 
 @app.route('/add_bill', methods=['GET', 'POST'])
 @login_required
@@ -582,25 +1089,14 @@ def add_bill():
         else:
             bill_date = datetime.now()
 
-        # 类型映射字典
-        type_names = {
-            'water': '💧 水费',
-            'electricity': '⚡ 电费',
-            'gas': '🔥 燃气费',
-            'trash': '🗑️ 垃圾费',
-            'internet': '🌐 网费',
-            'shopping': '🛒 超市购买',
-            'food': '🍔 餐饮外卖',
-            'daily': '🧻 日用品',
-            'other': '📝 其它费用'
-        }
-
-        # 构建描述
+        # 构建描述（类型名称见 BILL_CATEGORIES）
+        if bill_type not in BILL_CATEGORIES:
+            bill_type = 'other'
         if bill_type == 'other':
             custom_desc = request.form.get('custom_description', '').strip()
-            description = f"📝 {custom_desc}" if custom_desc else type_names['other']
+            description = f"📝 {custom_desc}" if custom_desc else BILL_CATEGORIES['other']
         else:
-            description = type_names.get(bill_type, '📝 其它费用')
+            description = BILL_CATEGORIES[bill_type]
 
         # 添加补充说明
         notes = request.form.get('notes', '').strip()
@@ -615,9 +1111,15 @@ def add_bill():
             payer_id=current_user.id,
             amount=amount,
             description=description,
-            participants=','.join(participants),
+            category=bill_type,
             date=bill_date  # 使用用户选择的日期
         )
+        try:
+            bill.set_participants(participants)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return render_template('add_bill.html', users=User.query.all(), today=datetime.now().strftime('%Y-%m-%d')), 400
+        bill.update_settlement_counters(settled_ids=set())
 
         # 处理多文件上传 - 使用优化的事务系统
         files = request.files.getlist('receipts')
@@ -636,33 +1138,20 @@ def add_bill():
         db.session.add(bill)
         db.session.flush()  # 获取bill.id但不提交
 
+        # 记入债务账本（与账单在同一事务中提交）
+        PairwiseBalance.apply_bill_debts(bill, bill.get_open_debts(settled_ids=set()))
+
         try:
-            # 使用事务管理器处理文件上传
-            with FileUploadTransaction(bill.id) as transaction:
+            # 使用事务管理器处理文件上传（退出时移动文件并提交数据库事务）
+            with FileUploadTransaction(bill.id, keep_original=bool(request.form.get('keep_original'))) as transaction:
                 for file in valid_files:
-                    # 生成安全文件名
-                    filename = secure_filename_with_timestamp(file.filename)
-
-                    # 保存到临时目录
-                    temp_path = transaction.save_file(file, filename)
-
-                    # 创建Receipt记录
-                    receipt = Receipt(
-                        bill_id=bill.id,
-                        filename=filename,
-                        file_type='pdf' if filename.lower().endswith('.pdf') else 'image',
-                        file_size=os.path.getsize(temp_path)
-                    )
-                    transaction.add_database_object(receipt)
+                    receipt = transaction.save_file(file)
 
                     # 保留对旧字段的兼容（使用第一个文件）
                     if not bill.receipt_filename:
-                        bill.receipt_filename = filename
+                        bill.receipt_filename = receipt.filename
                         bill.receipt_type = receipt.file_type
 
-                # 如果到这里没有异常，提交数据库事务
-                db.session.commit()
-
         except Exception as e:
             # 回滚数据库事务
             db.session.rollback()
@@ -693,8 +1182,7 @@ def settle_individual(bill_id, user_id):
         return redirect(url_for('index'))
 
     # 检查用户是否是该账单的参与者
-    participants = bill.get_participants_list()
-    if user_id not in participants:
+    if not bill.has_participant(user_id):
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'message': f'{user.display_name}不是该账单的参与者'}), 400
         flash(f'{user.display_name}不是该账单的参与者')
@@ -703,21 +1191,25 @@ def settle_individual(bill_id, user_id):
     # 检查是否已经结算过
     existing_settlement = Settlement.query.filter_by(bill_id=bill_id, settler_id=user_id).first()
 
+    split_amount = bill.get_split_amount()
     if existing_settlement:
         # 如果已结算，则撤销结算
         db.session.delete(existing_settlement)
+        if user_id != bill.payer_id:
+            PairwiseBalance.add_debt(user_id, bill.payer_id, bill_id, split_amount)
         action = "撤销结算"
         is_settled = False
         settled_date = None
     else:
         # 如果未结算，则添加结算记录
-        split_amount = bill.get_split_amount()
         settlement = Settlement(
             bill_id=bill_id,
             settler_id=user_id,
             settled_amount=split_amount
         )
         db.session.add(settlement)
+        if user_id != bill.payer_id:
+            PairwiseBalance.remove_debt(user_id, bill.payer_id, bill_id, split_amount)
         db.session.commit()  # Commit to get the settled_date
         action = "标记已结算"
         is_settled = True
@@ -726,6 +1218,7 @@ def settle_individual(bill_id, user_id):
     db.session.commit()
 
     # 检查是否所有人都已结算，更新账单状态
+    bill.update_settlement_counters()
     bill.is_settled = bill.check_fully_settled()
     db.session.commit()
 
@@ -755,9 +1248,14 @@ def toggle_settlement(bill_id):
         flash('只有账单创建者才能管理结算状态')
         return redirect(url_for('index'))
 
+    # 先冲销账本中该账单当前的未结算债务
+    PairwiseBalance.apply_bill_debts(bill, bill.get_open_debts(), sign=-1)
+
     if bill.is_settled:
         # 如果当前是已结算，则清除所有结算记录
         Settlement.query.filter_by(bill_id=bill_id).delete()
+        PairwiseBalance.apply_bill_debts(bill, bill.get_open_debts(settled_ids=set()))
+        bill.update_settlement_counters(settled_ids=set())
         bill.is_settled = False
         action = "未结算"
         new_status = False
@@ -777,6 +1275,7 @@ def toggle_settlement(bill_id):
                     )
                     db.session.add(settlement)
 
+        bill.update_settlement_counters(settled_ids=set(participants))
         bill.is_settled = True
         action = "已结算"
         new_status = True
@@ -806,28 +1305,140 @@ def toggle_settlement(bill_id):
     flash(f'账单"{bill.description}"已标记为{action}')
     return redirect(url_for('index'))
 
+@app.route('/api/settlements/bulk', methods=['POST'])
+@login_required
+def api_bulk_settlements():
+    """批量结算：在单个事务中为多个账单/参与者设置结算状态
+
+    请求体（JSON）二选一：
+      {"items": [{"bill_id": 1, "user_id": 2, "settled": true}, ...]}
+      {"filter": {"debtor_id": 2, "creditor_id": 1}}  # 结清 debtor 欠 creditor 的全部账单
+    只有账单创建者和管理员才能管理结算状态（creditor_id 默认为当前用户，只有管理员可以指定其他人），
+    任一条目校验失败则整批不执行。
+    """
+    data = request.get_json(silent=True) or {}
+
+    if 'filter' in data:
+        debt_filter = data.get('filter') or {}
+        try:
+            debtor_id = int(debt_filter['debtor_id'])
+            creditor_id = int(debt_filter.get('creditor_id', current_user.id))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': '筛选条件无效'}), 400
+        if creditor_id != current_user.id and not current_user.is_admin:
+            return jsonify({'success': False, 'message': '只有管理员才能结算其他人创建的账单'}), 403
+        ledger_row = db.session.get(PairwiseBalance, (debtor_id, creditor_id))
+        bill_ids = ledger_row.get_open_bill_ids() if ledger_row else []
+        requested = {(bill_id, debtor_id): True for bill_id in bill_ids}
+    else:
+        requested = {}
+        try:
+            for item in data.get('items') or []:
+                requested[(int(item['bill_id']), int(item['user_id']))] = bool(item.get('settled', True))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': '结算条目格式无效'}), 400
+
+    if not requested:
+        return jsonify({'success': True, 'message': '没有需要处理的结算', 'bills': {}})
+
+    # 批量校验权限和参与关系
+    bills = {bill.id: bill for bill in Bill.with_details(
+        Bill.query.filter(Bill.id.in_({bill_id for bill_id, _ in requested}))
+    )}
+    errors = []
+    for bill_id, user_id in requested:
+        bill = bills.get(bill_id)
+        if not bill:
+            errors.append(f'账单{bill_id}不存在')
+        elif bill.payer_id != current_user.id and not current_user.is_admin:
+            errors.append(f'只有账单创建者才能管理账单"{bill.description}"的结算状态')
+        elif not bill.has_participant(user_id):
+            errors.append(f'用户{user_id}不是账单"{bill.description}"的参与者')
+    if errors:
+        return jsonify({'success': False, 'message': errors[0], 'errors': errors}), 403
+
+    settled_date = datetime.utcnow()
+    to_insert = []
+    to_delete = []
+    for (bill_id, user_id), settled in requested.items():
+        bill = bills[bill_id]
+        existing = next((settlement for settlement in bill.settlements if settlement.settler_id == user_id), None)
+        if settled and not existing:
+            to_insert.append({
+                'bill_id': bill_id,
+                'settler_id': user_id,
+                'settled_amount': bill.get_split_amount(),
+                'settled_date': settled_date
+            })
+        elif not settled and existing:
+            to_delete.append(existing)
+
+    try:
+        if to_insert:
+            db.session.execute(Settlement.__table__.insert(), to_insert)
+        if to_delete:
+            Settlement.query.filter(Settlement.id.in_([s.id for s in to_delete]))\
+                .delete(synchronize_session=False)
+
+        # 同步债务账本
+        for row in to_insert:
+            bill = bills[row['bill_id']]
+            if row['settler_id'] != bill.payer_id:
+                PairwiseBalance.remove_debt(row['settler_id'], bill.payer_id, bill.id, row['settled_amount'])
+        for settlement in to_delete:
+            bill = bills[settlement.bill_id]
+            if settlement.settler_id != bill.payer_id:
+                PairwiseBalance.add_debt(settlement.settler_id, bill.payer_id, bill.id, bill.get_split_amount())
+
+        # 重新计算受影响账单的整体结算状态
+        settled_by_bill = {
+            bill_id: {s.settler_id for s in bill.settlements} for bill_id, bill in bills.items()
+        }
+        for row in to_insert:
+            settled_by_bill[row['bill_id']].add(row['settler_id'])
+        for settlement in to_delete:
+            settled_by_bill[settlement.bill_id].discard(settlement.settler_id)
+
+        result = {}
+        for bill_id, bill in bills.items():
+            settled_ids = settled_by_bill[bill_id]
+            bill.update_settlement_counters(settled_ids)
+            bill.is_settled = bill.check_fully_settled()
+            result[bill_id] = {
+                'is_settled': bill.is_settled,
+                'settled_users': sorted(user_id for user_id in bill.get_participants_list()
+                                        if user_id != bill.payer_id and user_id in settled_ids)
+            }
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"批量结算失败: {str(e)}")
+        return jsonify({'success': False, 'message': '批量结算失败，请稍后重试'}), 500
+
+    return jsonify({
+        'success': True,
+        'message': f'已标记 {len(to_insert)} 笔结算，撤销 {len(to_delete)} 笔结算',
+        'settled_count': len(to_insert),
+        'unsettled_count': len(to_delete),
+        'settled_date': settled_date.strftime('%m-%d %H:%M'),
+        'bills': result
+    })
+
 def calculate_user_balance(user_id):
     """计算用户的应付/应收余额"""
     balance = 0.0
 
-    # 计算用户付出的钱
-    paid_bills = Bill.query.filter_by(payer_id=user_id, is_settled=False).all()
-    for bill in paid_bills:
-        participants = bill.get_participants_list()
-        if user_id in participants:
+    # 只遍历用户参与的未结算账单
+    open_bills = Bill.participated_by(user_id).filter(Bill.is_settled == False).all()
+    for bill in open_bills:
+        split_amount = bill.get_split_amount()
+        if bill.payer_id == user_id:
             # 用户付了钱，应该收回其他人的份额
-            split_amount = bill.get_split_amount()
             balance += bill.amount - split_amount  # 应收 = 总金额 - 自己的份额
-
-    # 计算用户参与但没付钱的账单
-    all_bills = Bill.query.filter_by(is_settled=False).all()
-    for bill in all_bills:
-        if bill.payer_id != user_id:  # 不是自己付的钱
-            participants = bill.get_participants_list()
-            if user_id in participants:
-                # 用户参与了但没付钱，需要付给付款人
-                split_amount = bill.get_split_amount()
-                balance -= split_amount  # 应付
+        else:
+            # 用户参与了但没付钱，需要付给付款人
+            balance -= split_amount  # 应付
 
     return round(balance, 2)
 
@@ -838,18 +1449,17 @@ def calculate_debt_details(user_id):
     i_owe = defaultdict(lambda: {'amount': 0, 'bills': []})  # 我欠别人的
     owe_me = defaultdict(lambda: {'amount': 0, 'bills': []})  # 别人欠我的
 
-    # 获取所有账单（包括部分结算的）
-    all_bills = Bill.query.all()
+    # 获取用户参与的所有账单（包括部分结算的）
+    users = get_user_map()
+    participated_bills = Bill.with_details(Bill.participated_by(user_id)).all()
 
-    for bill in all_bills:
+    for bill in participated_bills:
         participants = bill.get_participants_list()
-        if user_id not in participants:
-            continue
 
         # 获取该账单的结算状态
-        settlement_status = bill.get_settlement_status()
+        settlement_status = bill.get_settlement_status(users)
         split_amount = bill.get_split_amount()
-        payer = User.query.get(bill.payer_id)
+        payer = users.get(bill.payer_id)
 
         if bill.payer_id == user_id:
             # 我是付款人，检查其他参与者是否已结算
@@ -858,7 +1468,7 @@ def calculate_debt_details(user_id):
                     participant_status = settlement_status.get(participant_id)
                     if participant_status and not participant_status['is_settled']:
                         # 该参与者还未结算，欠我钱
-                        participant = User.query.get(participant_id)
+                        participant = users.get(participant_id)
                         owe_me[participant.display_name]['amount'] += split_amount
                         owe_me[participant.display_name]['bills'].append(bill.description)
         else:
@@ -897,13 +1507,451 @@ def calculate_debt_details(user_id):
         'total_owe_me': round(total_owe_me, 2)
     }
 
+def get_debt_details(user_id):
+    """从债务账本读取用户的债务关系明细（与 calculate_debt_details 返回结构一致）"""
+    rows = PairwiseBalance.query.filter(db.or_(
+        PairwiseBalance.debtor_id == user_id,
+        PairwiseBalance.creditor_id == user_id
+    )).all()
+
+    # 批量加载相关用户和账单描述
+    other_ids = {row.creditor_id if row.debtor_id == user_id else row.debtor_id for row in rows}
+    users = {user.id: user for user in User.query.filter(User.id.in_(other_ids))} if other_ids else {}
+    bill_ids = {bill_id for row in rows for bill_id in row.get_open_bill_ids()}
+    descriptions = dict(
+        db.session.query(Bill.id, Bill.description).filter(Bill.id.in_(bill_ids))
+    ) if bill_ids else {}
+
+    i_owe_list = []
+    owe_me_list = []
+    for row in sorted(rows, key=lambda r: (r.creditor_id, r.debtor_id)):
+        if row.debtor_id == row.creditor_id:
+            continue
+        other_id = row.creditor_id if row.debtor_id == user_id else row.debtor_id
+        other = users.get(other_id)
+        if not other:
+            continue
+        entry = {
+            'user': other.display_name,
+            'amount': round(row.amount, 2),
+            'bills': [descriptions[bill_id] for bill_id in sorted(row.get_open_bill_ids()) if bill_id in descriptions]
+        }
+        if row.debtor_id == user_id:
+            i_owe_list.append(entry)
+        else:
+            owe_me_list.append(entry)
+
+    total_owe_me = sum(item['amount'] for item in owe_me_list)
+    total_i_owe = sum(item['amount'] for item in i_owe_list)
+
+    return {
+        'i_owe': i_owe_list,
+        'owe_me': owe_me_list,
+        'total_i_owe': round(total_i_owe, 2),
+        'total_owe_me': round(total_owe_me, 2)
+    }
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """执行未应用的数据库迁移"""
+    applied = upgrade_database()
+    if not applied:
+        print("✅ 数据库结构已是最新版本")
+
+@app.cli.command('archive-login-logs')
+@click.option('--days', type=int, default=None, help='保留天数，默认读取系统配置')
+def archive_login_logs_command(days):
+    """归档过期的登录日志"""
+    login_audit.flush()
+    archived = archive_login_logs(LOG_ARCHIVE_FOLDER, days)
+    if not archived:
+        print("没有需要归档的登录日志")
+
+@app.cli.command('thumbnails-backfill')
+def thumbnails_backfill_command():
+    """为已有凭证补生成缩略图和预览图"""
+    if not thumbnailer.active:
+        print("❌ 缩略图功能未启用或未安装 Pillow")
+        raise SystemExit(1)
+
+    # 以文件路径去重：内容相同的凭证共用一个文件
+    files = {}
+    for receipt in Receipt.query.all():
+        files[os.path.join(UPLOAD_FOLDER, receipt.storage_path)] = receipt.file_type
+    # 旧版只记录在账单上的凭证
+    legacy_bills = Bill.query.filter(Bill.receipt_filename.isnot(None), ~Bill.receipts.any()).all()
+    for bill in legacy_bills:
+        files[os.path.join(UPLOAD_FOLDER, str(bill.id), bill.receipt_filename)] = bill.receipt_type
+
+    print(f"检查 {len(files)} 个凭证文件...")
+    created, failed = thumbnailer.run(files.items())
+    print(f"✅ 新生成 {created} 个缩略图/预览图" + (f"，{failed} 个文件失败" if failed else ""))
+
+@app.cli.command('storage-reconcile')
+@click.option('--quarantine', is_flag=True, help='把孤儿文件移到 instance/quarantine/（默认只报告）')
+@click.option('--full', is_flag=True, help='忽略检查点，重新扫描全部目录')
+def storage_reconcile_command(quarantine, full):
+    """核对凭证目录与数据库，报告孤儿文件和缺失文件"""
+    report = reconcile_storage(quarantine=quarantine, full=full)
+    for path in report['orphans'][:100]:
+        print(f"孤儿文件: {path}")
+    if len(report['orphans']) > 100:
+        print(f"... 共 {len(report['orphans'])} 个")
+
+jobs_cli = AppGroup('jobs', help='查看和执行后台任务')
+app.cli.add_command(jobs_cli)
+
+@jobs_cli.command('stats')
+def jobs_stats_command():
+    """按状态统计任务数量"""
+    counts = Job.count_by_status()
+    for status in ('pending', 'running', 'done', 'failed'):
+        print(f"{status:8} {counts.get(status, 0)}")
+
+@jobs_cli.command('list')
+@click.option('--status', type=click.Choice(['pending', 'running', 'done', 'failed']), default=None, help='只显示该状态')
+@click.option('--limit', type=int, default=20, show_default=True, help='最多显示条数')
+def jobs_list_command(status, limit):
+    """列出最近的任务"""
+    query = Job.query.order_by(Job.id.desc())
+    if status:
+        query = query.filter(Job.status == status)
+    jobs = query.limit(limit).all()
+    if not jobs:
+        print("没有任务")
+    for job in jobs:
+        print(f"#{job.id} {job.kind} {job.status} 尝试{job.attempts}/{job.max_attempts} "
+              f"执行时间 {job.run_after:%Y-%m-%d %H:%M:%S} {job.payload}")
+        if job.last_error:
+            print(f"    最近错误: {job.last_error}")
+
+@jobs_cli.command('run')
+@click.option('--limit', type=int, default=None, help='最多执行的任务数')
+def jobs_run_command(limit):
+    """在当前进程执行所有到期任务（JOB_WORKERS=0 时可由定时任务调用）"""
+    count = job_queue.run_pending(app, limit)
+    print(f"✅ 执行了 {count} 个任务" + (f"，{job_queue.stats['failed']} 个重试次数用尽" if job_queue.stats['failed'] else ""))
+
+@jobs_cli.command('retry')
+@click.argument('job_ids', nargs=-1, type=int)
+def jobs_retry_command(job_ids):
+    """把失败的任务重新放回队列（不指定ID时为全部失败任务）"""
+    count = Job.retry_failed(list(job_ids))
+    print(f"已重新排队 {count} 个任务")
+
+@jobs_cli.command('purge')
+@click.option('--days', type=int, default=None, help='保留天数，默认 JOB_RETENTION_DAYS')
+def jobs_purge_command(days):
+    """删除已完成的旧任务"""
+    days = job_queue.retention_days if days is None else days
+    count = Job.purge_finished(datetime.utcnow() - timedelta(days=days))
+    print(f"已删除 {count} 个 {days} 天前完成的任务")
+
+@app.cli.command('rebuild-ledger')
+def rebuild_ledger_command():
+    """重建债务账本并与逐账单计算结果比对"""
+    pair_count = PairwiseBalance.rebuild()
+    print(f"已重建债务账本，共 {pair_count} 组债务关系")
+
+    def normalize(details):
+        return {
+            direction: sorted((item['user'], round(item['amount'], 2), sorted(item['bills']))
+                              for item in details[direction])
+            for direction in ('i_owe', 'owe_me')
+        }
+
+    mismatches = 0
+    for user in User.query.all():
+        expected = normalize(calculate_debt_details(user.id))
+        actual = normalize(get_debt_details(user.id))
+        if expected != actual:
+            mismatches += 1
+            print(f"❌ 用户 {user.username} 的账本与计算结果不一致")
+            print(f"   计算结果: {expected}")
+            print(f"   账本结果: {actual}")
+
+    if mismatches:
+        raise SystemExit(1)
+    print("✅ 账本校验通过")
+
+def calculate_settle_plan():
+    """计算全体室友的最少转账结算方案
+
+    一次遍历所有未结算账单，按 Bill.get_split_amount() 的分摊结果汇总每人净额，
+    再贪心匹配当前最大的债务人与最大的债权人（转账次数不超过 人数-1）。
+    返回 (方案字典, 未结算债务列表[(账单ID, 债务人ID, 债权人ID, 金额)])。
+    """
+    import hashlib
+    import heapq
+    from collections import defaultdict
+
+    users = get_user_map()
+    open_bills = Bill.with_details(Bill.query.filter(Bill.is_settled == False)).order_by(Bill.id).all()
+
+    # 以"分"为单位计算，避免浮点误差
+    net_cents = defaultdict(int)  # 正数为应收，负数为应付
+    open_debts = []
+    pairs = set()
+    for bill in open_bills:
+        for debtor_id, amount in bill.get_open_debts().items():
+            cents = int(round(amount * 100))
+            net_cents[debtor_id] -= cents
+            net_cents[bill.payer_id] += cents
+            open_debts.append((bill.id, debtor_id, bill.payer_id, amount))
+            pairs.add((debtor_id, bill.payer_id))
+
+    creditors = [(-cents, user_id) for user_id, cents in net_cents.items() if cents > 0]
+    debtors = [(cents, user_id) for user_id, cents in net_cents.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    def display_name(user_id):
+        user = users.get(user_id)
+        return user.display_name if user else f'用户{user_id}'
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor_id = heapq.heappop(creditors)
+        debit, debtor_id = heapq.heappop(debtors)
+        cents = min(-credit, -debit)
+        transfers.append({
+            'from_id': debtor_id,
+            'from': display_name(debtor_id),
+            'to_id': creditor_id,
+            'to': display_name(creditor_id),
+            'amount': cents / 100
+        })
+        if -credit > cents:
+            heapq.heappush(creditors, (credit + cents, creditor_id))
+        if -debit > cents:
+            heapq.heappush(debtors, (debit + cents, debtor_id))
+
+    balances = [
+        {'user_id': user_id, 'user': display_name(user_id), 'net': cents / 100}
+        for user_id, cents in sorted(net_cents.items()) if cents != 0
+    ]
+
+    # 方案令牌：未结算债务集合的指纹，应用方案时用于确认数据未发生变化
+    plan_token = hashlib.sha256(repr(open_debts).encode('utf-8')).hexdigest()[:16]
+
+    plan = {
+        'transfers': transfers,
+        'balances': balances,
+        'transfer_count': len(transfers),
+        'pairwise_count': len(pairs),
+        'open_bill_count': len({debt[0] for debt in open_debts}),
+        'plan_token': plan_token
+    }
+    return plan, open_debts
+
+@app.route('/api/settle_plan')
+@login_required
+def api_settle_plan():
+    """API端点：返回全体室友的最少转账结算方案"""
+    plan, _ = calculate_settle_plan()
+    plan['can_apply'] = current_user.is_admin
+    return jsonify(plan)
+
+@app.route('/api/settle_plan/apply', methods=['POST'])
+@login_required
+@admin_required
+def api_settle_plan_apply():
+    """一键应用结算方案：在单个事务中为所有未结算参与人写入结算记录"""
+    data = request.get_json(silent=True) or {}
+
+    # 先取得写锁（不修改任何行的 UPDATE）再计算方案：校验令牌到提交之间其他请求无法修改账单
+    db.session.execute(Bill.__table__.update().where(db.false()).values(is_settled=Bill.__table__.c.is_settled))
+    plan, open_debts = calculate_settle_plan()
+
+    if data.get('plan_token') != plan['plan_token']:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': '账单数据已发生变化，请刷新结算方案后重试'}), 409
+
+    if not open_debts:
+        db.session.rollback()
+        return jsonify({'success': True, 'message': '没有需要结算的账单', 'settled_count': 0})
+
+    try:
+        settled_date = datetime.utcnow()
+        db.session.execute(Settlement.__table__.insert(), [
+            {'bill_id': bill_id, 'settler_id': debtor_id, 'settled_amount': amount, 'settled_date': settled_date}
+            for bill_id, debtor_id, _, amount in open_debts
+        ])
+
+        bill_ids = {debt[0] for debt in open_debts}
+        Bill.query.filter(Bill.id.in_(bill_ids)).update(
+            {Bill.is_settled: True, Bill.settled_count: Bill.participant_count}, synchronize_session=False
+        )
+
+        # 只从账本冲销本次结清的债务，其他来源的账本行（如旧数据中已标记结清但仍有欠款的账单）保持不变
+        for bill_id, debtor_id, creditor_id, amount in open_debts:
+            PairwiseBalance.remove_debt(debtor_id, creditor_id, bill_id, amount)
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"应用结算方案失败: {str(e)}")
+        return jsonify({'success': False, 'message': '结算失败，请稍后重试'}), 500
+
+    return jsonify({
+        'success': True,
+        'message': f'已按方案结清 {len(bill_ids)} 个账单中的 {len(open_debts)} 笔分摊',
+        'settled_count': len(open_debts)
+    })
+
+@app.route('/api/bills')
+@login_required
+def api_bills():
+    """API端点：游标分页的账单列表（render=html 时附带渲染好的账单卡片）"""
+    try:
+        bills, next_cursor = query_bills_page(request.args)
+    except ValueError:
+        return jsonify({'error': '查询参数无效'}), 400
+
+    user_map = get_user_map()
+    result = {
+        'bills': [serialize_bill(bill) for bill in bills],
+        'next_cursor': next_cursor
+    }
+
+    if request.args.get('render') == 'html':
+        result['html'] = ''.join(
+            render_template('_bill_card.html', bill=bill, user_map=user_map) for bill in bills
+        )
+
+    return jsonify(result)
+
+def serialize_bill(bill):
+    """账单列表/搜索接口中单个账单的JSON表示"""
+    return {
+        'id': bill.id,
+        'description': bill.description,
+        'category': bill.category,
+        'amount': float(bill.amount),
+        'date': bill.date.strftime('%Y-%m-%d'),
+        'payer_id': bill.payer_id,
+        'payer': bill.payer.display_name,
+        'participants': bill.get_participants_list(),
+        'split_amount': bill.get_split_amount(),
+        'is_settled': bill.is_settled,
+        'receipts_count': len(bill.receipts)
+    }
+
+@app.route('/api/bills/search')
+@login_required
+def api_bills_search():
+    """API端点：账单搜索（全文 + 筛选 + 分类统计）
+
+    参数：q=描述关键词（子串匹配，空格分隔多个词）、category、payer、
+    amount_min/amount_max、from/to=YYYY-MM-DD、page、limit。
+    有关键词时按相关度排序，否则按日期倒序。facets 为各类型和付款人的账单数
+    （统计某一维度时不应用该维度自身的筛选条件）。
+    """
+    try:
+        limit = min(int(request.args.get('limit') or BILLS_PAGE_SIZE), BILLS_MAX_PAGE_SIZE)
+        page = int(request.args.get('page') or 1)
+        if limit < 1 or page < 1:
+            raise ValueError('分页参数必须为正整数')
+
+        category = request.args.get('category') or None
+        payer_id = int(request.args['payer']) if request.args.get('payer') else None
+        conditions = []
+        if request.args.get('amount_min'):
+            conditions.append(Bill.amount >= float(request.args['amount_min']))
+        if request.args.get('amount_max'):
+            conditions.append(Bill.amount <= float(request.args['amount_max']))
+        if request.args.get('from'):
+            conditions.append(Bill.date >= datetime.strptime(request.args['from'], '%Y-%m-%d'))
+        if request.args.get('to'):
+            conditions.append(Bill.date < datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1))
+    except ValueError:
+        return jsonify({'error': '查询参数无效'}), 400
+
+    matches, like_conditions = Bill.search(request.args.get('q', ''))
+    offset = (page - 1) * limit
+
+    if matches is None and not like_conditions:
+        # 无关键词：分类统计和分页直接由数据库完成（走类型、付款人和日期索引）
+        def filtered(query, *skip):
+            if category is not None and 'category' not in skip:
+                query = query.filter(Bill.category == category)
+            if payer_id is not None and 'payer' not in skip:
+                query = query.filter(Bill.payer_id == payer_id)
+            return query.filter(*conditions)
+
+        total = filtered(db.session.query(db.func.count(Bill.id))).scalar()
+        page_ids = [bill_id for bill_id, in filtered(db.session.query(Bill.id))
+                    .order_by(Bill.date.desc(), Bill.id.desc()).offset(offset).limit(limit)]
+        category_counts = Counter(dict(
+            filtered(db.session.query(Bill.category, db.func.count(Bill.id)), 'category').group_by(Bill.category)
+        ))
+        payer_counts = Counter(dict(
+            filtered(db.session.query(Bill.payer_id, db.func.count(Bill.id)), 'payer').group_by(Bill.payer_id)
+        ))
+    else:
+        # 有关键词：一次查询取出命中账单的 (ID, 类型, 付款人)，类型/付款人筛选、总数、
+        # 分类统计和分页都在内存中完成，避免对全文/LIKE结果重复扫描
+        query = db.select(Bill.id, Bill.category, Bill.payer_id).where(*conditions, *like_conditions)
+        order = [Bill.date.desc(), Bill.id.desc()]
+        if matches is not None:
+            query = query.join(matches, matches.c.id == Bill.id)
+            order.insert(0, matches.c.rank)
+        rows = db.session.execute(query.order_by(*order)).all()
+
+        category_counts = Counter(row.category for row in rows if payer_id is None or row.payer_id == payer_id)
+        payer_counts = Counter(row.payer_id for row in rows if category is None or row.category == category)
+        hit_ids = [row.id for row in rows
+                   if (category is None or row.category == category) and (payer_id is None or row.payer_id == payer_id)]
+        total = len(hit_ids)
+        page_ids = hit_ids[offset:offset + limit]
+
+    bills_by_id = {bill.id: bill for bill in Bill.with_details().filter(Bill.id.in_(page_ids))}
+    user_map = get_user_map()
+
+    return jsonify({
+        'bills': [serialize_bill(bills_by_id[bill_id]) for bill_id in page_ids],
+        'total': total,
+        'page': page,
+        'limit': limit,
+        'has_more': offset + limit < total,
+        'facets': {
+            'category': [{
+                'category': key,
+                'name': BILL_CATEGORIES.get(key, key),
+                'count': count
+            } for key, count in category_counts.most_common()],
+            'payer': [{
+                'payer_id': key,
+                'payer': user_map[key].display_name if key in user_map else str(key),
+                'count': count
+            } for key, count in payer_counts.most_common()]
+        }
+    })
+
 @app.route('/api/debt_details')
 @login_required
 def api_debt_details():
     """API端点：返回当前用户的债务关系数据"""
-    debt_details = calculate_debt_details(current_user.id)
+    debt_details = get_debt_details(current_user.id)
     return jsonify(debt_details)
 
+def receipt_urls(storage_path, original_blob_key=None):
+    """凭证原文件和缩略图/预览图的访问地址（缩略图尚未生成时为 None，查看器改用原文件）
+
+    图片压缩时保留了原图的，original_url 指向原图。
+    """
+    fmt = rendition_format()
+    source_path = os.path.join(UPLOAD_FOLDER, storage_path)
+    original_path = blob_relative_path(original_blob_key) if original_blob_key else storage_path
+    urls = {'original_url': url_for('uploaded_file', filename=f'receipts/{original_path}')}
+    for name in ('thumb', 'preview'):
+        path = rendition_path(source_path, name, fmt)
+        urls[f'{name}_url'] = (
+            url_for('uploaded_file', filename=f'receipts/{rendition_path(storage_path, name, fmt)}')
+            if os.path.exists(path) else None
+        )
+    return urls
+
 @app.route('/api/receipt/<int:bill_id>')
 @login_required
 def api_receipt(bill_id):
@@ -911,8 +1959,7 @@ def api_receipt(bill_id):
     bill = Bill.query.get_or_404(bill_id)
 
     # 权限检查：只有参与者可以查看
-    participants = bill.get_participants_list()
-    if current_user.id not in participants:
+    if not bill.has_participant(current_user.id):
         return jsonify({'error': '抱歉，您无权查看此凭证。只有参与该账单分摊的室友才能查看相关凭证文件。'}), 403
 
     # 获取所有凭证文件
@@ -927,13 +1974,15 @@ def api_receipt(bill_id):
 
     # 首先添加新的Receipt记录
     for receipt in receipts:
-        filepath = f"uploads/receipts/{bill.id}/{receipt.filename}"
+        filepath = f"uploads/receipts/{receipt.storage_path}"
         receipt_files.append({
             'filename': receipt.filename,
             'filepath': filepath,
             'file_type': receipt.file_type,
             'file_size': receipt.file_size,
-            'upload_date': receipt.upload_date.strftime('%Y-%m-%d %H:%M')
+            'upload_date': receipt.upload_date.strftime('%Y-%m-%d %H:%M'),
+            'original_size': receipt.original_size,
+            **receipt_urls(receipt.storage_path, receipt.original_blob_key)
         })
 
     # 如果没有新记录但有旧字段，添加旧字段（向后兼容）
@@ -944,7 +1993,8 @@ def api_receipt(bill_id):
             'filepath': filepath,
             'file_type': bill.receipt_type,
             'file_size': None,
-            'upload_date': None
+            'upload_date': None,
+            **receipt_urls(f'{bill.id}/{bill.receipt_filename}')
         })
 
     return jsonify({
@@ -967,8 +2017,7 @@ def view_receipt(bill_id):
     bill = Bill.query.get_or_404(bill_id)
 
     # 权限检查：只有参与者可以查看
-    participants = bill.get_participants_list()
-    if current_user.id not in participants:
+    if not bill.has_participant(current_user.id):
         flash('抱歉，您无权查看此凭证。只有参与该账单分摊的室友才能查看相关凭证文件。')
         return redirect(url_for('index'))
 
@@ -976,8 +2025,11 @@ def view_receipt(bill_id):
         flash('该账单没有凭证')
         return redirect(url_for('index'))
 
-    # 构建文件路径
-    filepath = f"uploads/receipts/{bill.id}/{bill.receipt_filename}"
+    # 构建文件路径（优先使用第一个凭证记录，旧数据只有账单上的文件名）
+    if bill.receipts:
+        filepath = f"uploads/receipts/{bill.receipts[0].storage_path}"
+    else:
+        filepath = f"uploads/receipts/{bill.id}/{bill.receipt_filename}"
 
     return render_template('view_receipt.html',
                          bill=bill,
@@ -992,17 +2044,18 @@ def dashboard():
     # 统计数据
     bills_count = Bill.query.filter_by(payer_id=user_id).count()
 
-    # 计算参与的账单数（包含用户ID的账单）
-    participated_bills_count = Bill.query.filter(Bill.participants.contains(str(user_id))).count()
+    # 计算参与的账单数
+    participated_bills_count = Bill.participated_by(user_id).count()
 
     # 计算已结清的账单数（对用户而言没有未结债务的账单）
-    debt_details = calculate_debt_details(user_id)
+    debt_details = get_debt_details(user_id)
     settled_bills_count = 0
 
     # 遍历所有用户参与的账单，统计已结清的
-    all_participated_bills = Bill.query.filter(Bill.participants.contains(str(user_id))).all()
+    users = get_user_map()
+    all_participated_bills = Bill.with_details(Bill.participated_by(user_id)).all()
     for bill in all_participated_bills:
-        settlement_status = bill.get_settlement_status()
+        settlement_status = bill.get_settlement_status(users)
         user_status = settlement_status.get(user_id)
         if user_status and user_status['is_settled']:
             settled_bills_count += 1
@@ -1023,26 +2076,53 @@ def dashboard():
                          debt_details=debt_details,
                          recent_bills=recent_bills)
 
+# 凭证文件名唯一且内容不会改变（内容寻址或带时间戳），允许浏览器缓存一年且无需重新验证
+RECEIPT_CACHE_MAX_AGE = 365 * 24 * 3600
+UPLOADS_BASE = os.path.join(app.root_path, 'static', 'uploads')
+_CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}(\.[\w.]+)?$')
+
+def receipt_etag(filename):
+    """内容寻址的文件直接以文件名（含SHA-256）作为强ETag，其余文件由Werkzeug按修改时间和大小生成"""
+    name = os.path.basename(filename)
+    return name if _CONTENT_ADDRESSED_NAME.match(name) else True
+
+def set_receipt_cache_headers(response):
+    # 需要登录才能访问，只允许浏览器缓存，不允许共享缓存
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = RECEIPT_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def uploaded_file(filename):
     """
     服务上传的文件
-    使用 send_from_directory 安全地提供文件访问
+    支持 If-None-Match 条件请求（304）和 Range 分段请求（大PDF可按需加载）。
+    RECEIPT_SENDFILE=x-accel 时只做登录检查，由 nginx 按 X-Accel-Redirect 发送文件；
+    RECEIPT_SENDFILE=x-sendfile 时由 Apache/lighttpd 按 X-Sendfile 发送。
     """
+    if app.config.get('RECEIPT_SENDFILE') == 'x-accel':
+        if safe_join(UPLOADS_BASE, filename) is None:
+            abort(404)
+        etag = receipt_etag(filename)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if etag is not True:
+            response.set_etag(etag)
+            if etag in request.if_none_match:
+                response.status_code = 304
+                return set_receipt_cache_headers(response)
+        response.headers['X-Accel-Redirect'] = app.config.get('RECEIPT_ACCEL_PREFIX', '/protected-uploads/') + quote(filename)
+        return set_receipt_cache_headers(response)
+
     try:
-        # 使用static/uploads作为基础路径，filename已经包含receipts/部分
-        uploads_base = os.path.join(app.root_path, 'static', 'uploads')
-        full_path = os.path.join(uploads_base, filename)
-        print(f"请求文件: {filename}")
-        print(f"搜索基础路径: {uploads_base}")
-        print(f"完整路径: {full_path}")
-        print(f"文件存在: {os.path.exists(full_path)}")
-
-        return send_from_directory(uploads_base, filename)
-    except FileNotFoundError as e:
-        print(f"文件未找到错误: {e}")
+        response = send_from_directory(UPLOADS_BASE, filename, etag=receipt_etag(filename),
+                                       max_age=RECEIPT_CACHE_MAX_AGE, conditional=True)
+    except NotFound:
         return f"文件未找到: {filename}", 404
+    response.headers['Accept-Ranges'] = 'bytes'
+    return set_receipt_cache_headers(response)
 
 @app.route('/delete_bill/<int:bill_id>', methods=['POST'])
 @login_required
@@ -1062,36 +2142,16 @@ def delete_bill(bill_id):
         receipts_count = len(bill.receipts)
         settlements_count = len(bill.settlements)
 
-        # 先收集要删除的文件路径列表
-        files_to_delete = []
-        for receipt in bill.receipts:
-            # 使用账单ID创建正确的文件路径（文件存储在子目录中）
-            file_path = os.path.join(UPLOAD_FOLDER, str(bill_id), receipt.filename)
-            if os.path.exists(file_path):
-                files_to_delete.append(file_path)
+        receipts = list(bill.receipts)
 
-        # 先删除数据库记录（级联删除会自动删除settlements和receipts记录）
+        # 删除数据库记录（级联删除会自动删除settlements和receipts记录），释放文件引用；
+        # 不再被引用的文件由与删除一起提交的后台任务删除
+        PairwiseBalance.apply_bill_debts(bill, bill.get_open_debts(), sign=-1)
         db.session.delete(bill)
+        enqueue_file_deletion(*Receipt.release_files(receipts))
         db.session.commit()
         print(f"数据库删除成功：账单{bill_id}及其关联记录")
 
-        # 数据库删除成功后再删除文件
-        for file_path in files_to_delete:
-            try:
-                os.remove(file_path)
-                print(f"已删除凭证文件: {file_path}")
-            except OSError as e:
-                print(f"删除文件失败: {file_path}, 错误: {e}")
-
-        # 删除账单文件夹（如果为空）
-        bill_folder = os.path.join(UPLOAD_FOLDER, str(bill_id))
-        try:
-            if os.path.exists(bill_folder) and not os.listdir(bill_folder):
-                os.rmdir(bill_folder)
-                print(f"已删除空目录: {bill_folder}")
-        except OSError as e:
-            print(f"删除目录失败: {bill_folder}, 错误: {e}")
-
         flash(f'账单已删除！同时删除了 {settlements_count} 个结算记录和 {receipts_count} 个凭证文件。', 'success')
         return jsonify({'success': True, 'message': '账单删除成功'})
 
@@ -1119,10 +2179,13 @@ def edit_bill(bill_id):
     if request.method == 'POST':
         try:
             old_amount = bill.amount
-            old_participants = bill.participants
+            old_participants = set(bill.get_participants_list())
+            old_debts = bill.get_open_debts()
 
-            # 更新账单信息
-            bill.description = request.form['description']
+            # 更新账单信息（描述变化时重新推断账单类型）
+            if request.form['description'] != bill.description:
+                bill.description = request.form['description']
+                bill.category = Bill.category_from_description(bill.description)
             bill.amount = float(request.form['amount'])
             bill.date = datetime.strptime(request.form['date'], '%Y-%m-%d')
 
@@ -1131,47 +2194,34 @@ def edit_bill(bill_id):
             payer_id_str = str(bill.payer_id)
             if payer_id_str not in selected_participants:
                 selected_participants.append(payer_id_str)
-            bill.participants = ','.join(selected_participants)
+            try:
+                bill.set_participants(selected_participants)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), 'error')
+                return render_template('edit_bill.html', bill=bill, users=users), 400
 
             # 检查是否修改了影响结算的字段（金额或参与者）
             amount_changed = bill.amount != old_amount
-            participants_changed = bill.participants != old_participants
+            participants_changed = set(bill.get_participants_list()) != old_participants
 
             if amount_changed or participants_changed:
                 # 删除所有现有的结算记录
                 Settlement.query.filter_by(bill_id=bill.id).delete()
                 bill.is_settled = False
+
+                # 更新债务账本：冲销旧债务，按新金额/参与者重新记入
+                PairwiseBalance.apply_bill_debts(bill, old_debts, sign=-1)
+                PairwiseBalance.apply_bill_debts(bill, bill.get_open_debts(settled_ids=set()))
+                bill.update_settlement_counters(settled_ids=set())
                 flash('由于修改了金额或参与者，已清除原有结算记录，需要重新结算。', 'warning')
 
-            # 处理新上传的文件
+            # 处理新上传的文件（退出时移动文件并提交数据库事务）
             uploaded_files = request.files.getlist('receipts')
-            for file in uploaded_files:
-                if file and file.filename and allowed_file(file.filename):
-                    # 创建账单专属目录
-                    bill_folder = os.path.join(UPLOAD_FOLDER, str(bill.id))
-                    os.makedirs(bill_folder, exist_ok=True)
-
-                    # 生成安全的文件名
-                    filename = secure_filename_with_timestamp(file.filename)
-                    file_path = os.path.join(bill_folder, filename)
-                    file.save(file_path)
-
-                    # 确定文件类型
-                    file_type = 'pdf' if filename.lower().endswith('.pdf') else 'image'
-
-                    # 获取文件大小
-                    file_size = os.path.getsize(file_path)
-
-                    # 保存到数据库
-                    receipt = Receipt(
-                        bill_id=bill.id,
-                        filename=filename,
-                        file_type=file_type,
-                        file_size=file_size
-                    )
-                    db.session.add(receipt)
-
-            db.session.commit()
+            with FileUploadTransaction(bill.id, keep_original=bool(request.form.get('keep_original'))) as transaction:
+                for file in uploaded_files:
+                    if file and file.filename and allowed_file(file.filename):
+                        transaction.save_file(file)
             flash('账单修改成功！', 'success')
             return redirect(url_for('index'))
 
@@ -1197,14 +2247,9 @@ def delete_receipt(receipt_id):
         return jsonify({'error': '只有账单创建者可以删除凭证'}), 403
 
     try:
-        # 删除文件系统中的文件
-        file_path = os.path.join(UPLOAD_FOLDER, str(bill.id), receipt.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"已删除凭证文件: {file_path}")
-
-        # 删除数据库记录
+        # 删除数据库记录并释放文件引用，不再被引用的文件由后台任务删除
         db.session.delete(receipt)
+        enqueue_file_deletion(*Receipt.release_files([receipt]))
         db.session.commit()
 
         return jsonify({'success': True, 'message': '凭证删除成功'})
@@ -1218,34 +2263,104 @@ def delete_receipt(receipt_id):
 # 健康检查和监控端点
 # ===========================
 
-@app.route('/health')
-def health_check():
-    """系统健康检查端点"""
-    try:
-        health_status = {
-            'status': 'healthy',
-            'timestamp': datetime.utcnow().isoformat(),
-            'version': '1.4',
-            'checks': {}
-        }
+class BackgroundRefresher:
+    """由后台线程定期刷新的结果快照（/health、/metrics 使用），读取时只访问内存
+
+    子类实现 compute() 返回结果；首次读取时若还没有快照则在调用线程同步计算一次。
+    """
+    thread_name = 'background-refresher'
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._snapshot = None  # (结果, 刷新时间)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def compute(self):
+        raise NotImplementedError
+
+    def get(self):
+        """返回 (结果, 快照时间)"""
+        self._ensure_started()
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.refresh()
+                snapshot = self._snapshot
+        return snapshot
+
+    def refresh(self):
+        """立即重新计算并替换快照（在调用线程中执行）"""
+        result = self.compute()
+        self._snapshot = (result, time.time())
+        return result
+
+    def _ensure_started(self):
+        # fork 后的子进程不继承线程，需要重新启动
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"{self.thread_name} 刷新失败: {e}")
+
+class HealthChecker(BackgroundRefresher):
+    """数据库、磁盘和上传目录检查，后台定期执行，探针只读取缓存结果
+
+    上传目录只检查权限，不再每次写入测试文件（减少SD卡写入）。
+    """
+    thread_name = 'health-checker'
+
+    def compute(self):
+        checks = {}
+        status = 'healthy'
 
         # 检查数据库连接
         try:
-            User.query.count()
-            health_status['checks']['database'] = {'status': 'ok', 'message': '数据库连接正常'}
+            with app.app_context():
+                active_users, total_bills = db.session.execute(db.select(
+                    db.select(db.func.count(User.id)).where(User.is_active == True).scalar_subquery(),
+                    db.select(db.func.count(Bill.id)).scalar_subquery()
+                )).one()
+                journal_mode = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+                db.session.rollback()
+            profile_name, _ = get_sqlite_profile()
+            checks['database'] = {
+                'status': 'ok',
+                'message': '数据库连接正常',
+                'sqlite_profile': profile_name,
+                'journal_mode': journal_mode
+            }
+            checks['application'] = {
+                'status': 'ok',
+                'active_users': active_users,
+                'total_bills': total_bills
+            }
         except Exception as e:
-            health_status['checks']['database'] = {'status': 'error', 'message': f'数据库连接失败: {str(e)}'}
-            health_status['status'] = 'unhealthy'
+            checks['database'] = {'status': 'error', 'message': f'数据库连接失败: {str(e)}'}
+            checks['application'] = {'status': 'error', 'message': f'应用状态检查失败: {str(e)}'}
+            status = 'unhealthy'
 
         # 检查磁盘空间
         try:
-            import shutil
             total, used, free = shutil.disk_usage('.')
             free_mb = free // (1024*1024)
             total_mb = total // (1024*1024)
             used_percent = round((used / total) * 100, 1)
 
-            health_status['checks']['disk_space'] = {
+            checks['disk_space'] = {
                 'status': 'ok' if free_mb > 100 else 'warning',
                 'free_mb': free_mb,
                 'total_mb': total_mb,
@@ -1253,36 +2368,42 @@ def health_check():
             }
 
             if free_mb <= 50:
-                health_status['status'] = 'unhealthy'
-            elif free_mb <= 100:
-                health_status['status'] = 'degraded'
+                status = 'unhealthy'
+            elif free_mb <= 100 and status == 'healthy':
+                status = 'degraded'
 
         except Exception as e:
-            health_status['checks']['disk_space'] = {'status': 'error', 'message': f'磁盘检查失败: {str(e)}'}
+            checks['disk_space'] = {'status': 'error', 'message': f'磁盘检查失败: {str(e)}'}
 
         # 检查上传目录权限
-        try:
-            test_file = os.path.join(UPLOAD_FOLDER, '.health_check')
-            with open(test_file, 'w') as f:
-                f.write('test')
-            os.remove(test_file)
-            health_status['checks']['upload_directory'] = {'status': 'ok', 'message': '上传目录可写'}
-        except Exception as e:
-            health_status['checks']['upload_directory'] = {'status': 'error', 'message': f'上传目录不可写: {str(e)}'}
-            health_status['status'] = 'unhealthy'
+        if os.path.isdir(UPLOAD_FOLDER) and os.access(UPLOAD_FOLDER, os.W_OK | os.X_OK):
+            checks['upload_directory'] = {'status': 'ok', 'message': '上传目录可写'}
+        else:
+            checks['upload_directory'] = {'status': 'error', 'message': f'上传目录不存在或不可写: {UPLOAD_FOLDER}'}
+            status = 'unhealthy'
 
-        # 检查活跃用户数
-        try:
-            active_users = User.query.filter_by(is_active=True).count()
-            total_bills = Bill.query.count()
+        return {'status': status, 'checks': checks}
 
-            health_status['checks']['application'] = {
-                'status': 'ok',
-                'active_users': active_users,
-                'total_bills': total_bills
-            }
-        except Exception as e:
-            health_status['checks']['application'] = {'status': 'error', 'message': f'应用状态检查失败: {str(e)}'}
+    def is_stale(self, checked_at):
+        """结果超过 3 个检查周期（至少 60 秒）未更新，说明检查线程已停止或卡住"""
+        return time.time() - checked_at > max(self.interval * 3, 60)
+
+health_checker = HealthChecker()
+
+@app.route('/health')
+def health_check():
+    """系统健康检查端点（返回后台检查的缓存结果及各项检查距今秒数）"""
+    try:
+        result, checked_at = health_checker.get()
+        age_seconds = round(time.time() - checked_at, 1)
+        health_status = {
+            'status': result['status'],
+            'timestamp': datetime.utcnow().isoformat(),
+            'version': '1.4',
+            'checks': {name: dict(check, age_seconds=age_seconds) for name, check in result['checks'].items()}
+        }
+        if health_checker.is_stale(checked_at) and health_status['status'] == 'healthy':
+            health_status['status'] = 'degraded'
 
         # 设置HTTP状态码
         status_code = 200
@@ -1300,65 +2421,166 @@ def health_check():
             'error': f'健康检查失败: {str(e)}'
         }), 503
 
-@app.route('/metrics')
-def metrics():
-    """系统指标端点（简化版Prometheus格式）"""
-    try:
-        # 基础指标
-        user_count = User.query.count()
-        bill_count = Bill.query.count()
-        settlement_count = Settlement.query.count()
-        receipt_count = Receipt.query.count()
+@app.route('/health/live')
+def health_live():
+    """存活探针：进程能处理请求即返回200，不做任何检查"""
+    return jsonify({'status': 'alive'})
 
-        # 磁盘使用情况
+@app.route('/health/ready')
+def health_ready():
+    """就绪探针：返回后台检查的缓存结论，不健康或结果过期时返回503"""
+    try:
+        result, checked_at = health_checker.get()
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': f'健康检查失败: {str(e)}'}), 503
+    age_seconds = round(time.time() - checked_at, 1)
+    if health_checker.is_stale(checked_at):
+        return jsonify({'status': 'unavailable', 'reason': 'stale', 'age_seconds': age_seconds}), 503
+    if result['status'] == 'unhealthy':
+        return jsonify({'status': 'unavailable', 'age_seconds': age_seconds}), 503
+    return jsonify({'status': 'ready', 'health': result['status'], 'age_seconds': age_seconds})
+
+class SystemGauges(BackgroundRefresher):
+    """/metrics 中的数据与存储指标，由后台线程定期刷新，抓取时只读取内存快照"""
+    thread_name = 'metrics-refresher'
+
+    def compute(self):
+        with app.app_context():
+            counts = db.session.execute(db.select(
+                db.select(db.func.count(User.id)).scalar_subquery(),
+                db.select(db.func.count(Bill.id)).scalar_subquery(),
+                db.select(db.func.count(Settlement.id)).scalar_subquery(),
+                db.select(db.func.count(Receipt.id)).scalar_subquery(),
+                db.select(db.func.coalesce(db.func.sum(Receipt.file_size), 0)).scalar_subquery(),
+                db.select(db.func.coalesce(
+                    db.func.sum(db.func.coalesce(Receipt.original_size, Receipt.file_size) - Receipt.file_size), 0
+                )).scalar_subquery(),
+                db.select(db.func.count(Job.id)).where(Job.status == 'pending').scalar_subquery(),
+                db.select(db.func.count(Job.id)).where(Job.status == 'failed').scalar_subquery()
+            )).one()
+            page_size = db.session.execute(db.text('PRAGMA page_size')).scalar()
+            page_count = db.session.execute(db.text('PRAGMA page_count')).scalar()
+            freelist_count = db.session.execute(db.text('PRAGMA freelist_count')).scalar()
+            db.session.rollback()
+            wal_path = f'{db.engine.url.database}-wal'
+
+        values = {
+            'users_total': counts[0],
+            'bills_total': counts[1],
+            'settlements_total': counts[2],
+            'receipts_total': counts[3],
+            'upload_size_bytes': counts[4],
+            'upload_saved_bytes': counts[5],
+            'jobs_pending': counts[6],
+            'jobs_failed': counts[7],
+            'sqlite_page_size_bytes': page_size,
+            'sqlite_page_count': page_count,
+            'sqlite_freelist_count': freelist_count,
+            'sqlite_wal_size_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+            'upload_files': self._count_files(UPLOAD_FOLDER),
+        }
         try:
-            import shutil
             total, used, free = shutil.disk_usage('.')
-            disk_usage_bytes = used
-            disk_total_bytes = total
-        except:
-            disk_usage_bytes = 0
-            disk_total_bytes = 0
-
-        # 上传文件总大小
-        total_upload_size = 0
-        try:
-            for receipt in Receipt.query.all():
-                if receipt.file_size:
-                    total_upload_size += receipt.file_size
-        except:
-            pass
-
-        metrics_data = f"""# HELP roommate_bills_users_total Total number of users
-# TYPE roommate_bills_users_total counter
-roommate_bills_users_total {user_count}
-
-# HELP roommate_bills_bills_total Total number of bills
-# TYPE roommate_bills_bills_total counter
-roommate_bills_bills_total {bill_count}
-
-# HELP roommate_bills_settlements_total Total number of settlements
-# TYPE roommate_bills_settlements_total counter
-roommate_bills_settlements_total {settlement_count}
-
-# HELP roommate_bills_receipts_total Total number of receipts
-# TYPE roommate_bills_receipts_total counter
-roommate_bills_receipts_total {receipt_count}
-
-# HELP roommate_bills_upload_size_bytes Total size of uploaded files
-# TYPE roommate_bills_upload_size_bytes gauge
-roommate_bills_upload_size_bytes {total_upload_size}
-
-# HELP roommate_bills_disk_usage_bytes Current disk usage
-# TYPE roommate_bills_disk_usage_bytes gauge
-roommate_bills_disk_usage_bytes {disk_usage_bytes}
-
-# HELP roommate_bills_disk_total_bytes Total disk space
-# TYPE roommate_bills_disk_total_bytes gauge
-roommate_bills_disk_total_bytes {disk_total_bytes}
-"""
-
-        return metrics_data, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        except OSError:
+            total = used = 0
+        values['disk_usage_bytes'] = used
+        values['disk_total_bytes'] = total
+
+        return values
+
+    @staticmethod
+    def _count_files(folder):
+        count = 0
+        stack = [folder]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue  # 跳过暂存区等隐藏文件
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            count += 1
+            except OSError:
+                continue
+        return count
+
+system_gauges = SystemGauges()
+
+# (指标名, 类型, 说明)，值来自 SystemGauges 快照
+SYSTEM_GAUGE_METRICS = [
+    ('users_total', 'gauge', 'Total number of users'),
+    ('bills_total', 'gauge', 'Total number of bills'),
+    ('settlements_total', 'gauge', 'Total number of settlements'),
+    ('receipts_total', 'gauge', 'Total number of receipts'),
+    ('upload_size_bytes', 'gauge', 'Total size of uploaded files'),
+    ('upload_saved_bytes', 'gauge', 'Bytes saved by recompressing uploaded images'),
+    ('upload_files', 'gauge', 'Number of files in the upload directory'),
+    ('jobs_pending', 'gauge', 'Background jobs waiting to run'),
+    ('jobs_failed', 'gauge', 'Background jobs that exhausted their retries'),
+    ('sqlite_page_size_bytes', 'gauge', 'SQLite page size'),
+    ('sqlite_page_count', 'gauge', 'SQLite database size in pages'),
+    ('sqlite_freelist_count', 'gauge', 'Unused SQLite pages (reclaimable with VACUUM)'),
+    ('sqlite_wal_size_bytes', 'gauge', 'Size of the SQLite write-ahead log file'),
+    ('disk_usage_bytes', 'gauge', 'Current disk usage'),
+    ('disk_total_bytes', 'gauge', 'Total disk space'),
+]
+
+@app.route('/metrics')
+def metrics():
+    """系统指标端点（Prometheus格式）
+
+    数据与存储指标来自后台线程定期刷新的快照，抓取本身不查询数据库。
+    """
+    try:
+        values, refreshed_at = system_gauges.get()
+
+        lines = []
+        for name, metric_type, help_text in SYSTEM_GAUGE_METRICS:
+            lines.append(f'# HELP roommate_bills_{name} {help_text}')
+            lines.append(f'# TYPE roommate_bills_{name} {metric_type}')
+            lines.append(f'roommate_bills_{name} {values[name]}')
+            lines.append('')
+        lines.append('# HELP roommate_bills_metrics_snapshot_age_seconds Seconds since the gauges above were refreshed')
+        lines.append('# TYPE roommate_bills_metrics_snapshot_age_seconds gauge')
+        lines.append(f'roommate_bills_metrics_snapshot_age_seconds {round(time.time() - refreshed_at, 3)}')
+        lines.append('')
+
+        metrics_data = '\n'.join(lines) + f"""
+# HELP roommate_bills_login_audit_queue_depth Login audit events waiting to be written
+# TYPE roommate_bills_login_audit_queue_depth gauge
+roommate_bills_login_audit_queue_depth {login_audit.queue_depth()}
+
+# HELP roommate_bills_login_audit_written_total Login audit events written to the database
+# TYPE roommate_bills_login_audit_written_total counter
+roommate_bills_login_audit_written_total {login_audit.stats['written']}
+
+# HELP roommate_bills_login_audit_batches_total Login audit write batches
+# TYPE roommate_bills_login_audit_batches_total counter
+roommate_bills_login_audit_batches_total {login_audit.stats['batches']}
+
+# HELP roommate_bills_login_audit_backpressure_total Times a login waited for a full audit queue
+# TYPE roommate_bills_login_audit_backpressure_total counter
+roommate_bills_login_audit_backpressure_total {login_audit.stats['backpressure']}
+
+# HELP roommate_bills_login_audit_dropped_total Login audit events dropped (queue full or write error)
+# TYPE roommate_bills_login_audit_dropped_total counter
+roommate_bills_login_audit_dropped_total {login_audit.stats['dropped']}
+
+# HELP roommate_bills_login_audit_write_errors_total Failed login audit write batches
+# TYPE roommate_bills_login_audit_write_errors_total counter
+roommate_bills_login_audit_write_errors_total {login_audit.stats['errors']}
+
+# HELP roommate_bills_jobs_processed_total Background jobs processed by this process, by outcome
+# TYPE roommate_bills_jobs_processed_total counter
+roommate_bills_jobs_processed_total{{outcome="succeeded"}} {job_queue.stats['succeeded']}
+roommate_bills_jobs_processed_total{{outcome="retried"}} {job_queue.stats['retried']}
+roommate_bills_jobs_processed_total{{outcome="failed"}} {job_queue.stats['failed']}
+
+{request_metrics.render()}"""
+
+        return metrics_data, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
     except Exception as e:
         return f"# Error generating metrics: {str(e)}", 500, {'Content-Type': 'text/plain; charset=utf-8'}
@@ -6,6 +6,39 @@ import os
 import secrets
 from datetime import timedelta
 
+from sqlalchemy.pool import QueuePool
+
+# SQLite存储配置档（通过连接事件在每个新连接上执行PRAGMA）
+# - durable:  WAL + synchronous=FULL，每次提交都落盘，断电也不丢已提交数据
+# - balanced: WAL + synchronous=NORMAL，断电可能丢失最近几次提交但不会损坏数据库（默认）
+# - fast:     WAL + synchronous=OFF，写入最快、SD卡磨损最少，断电可能损坏数据库
+SQLITE_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 10000,
+        'cache_size': -8000,  # 负数表示KB，约8MB
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'busy_timeout': 5000,
+        'cache_size': -32000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
 class Config:
     """基础配置类"""
     # 强制使用项目目录内的绝对路径
@@ -20,11 +53,52 @@ class Config:
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{DB_PATH}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # SQLite存储配置档（durable|balanced|fast），见 SQLITE_PROFILES
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'balanced')
+
+    # 连接池：多线程服务器下每个线程各取一个连接，WAL模式允许读写并发
+    # SQLAlchemy 1.4 对SQLite文件数据库默认使用 NullPool（不接受连接池参数），因此显式指定 QueuePool
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10)),
+        'pool_timeout': 30,
+        'pool_recycle': 3600,
+    }
+
     # 文件上传配置
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads', 'receipts')
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_UPLOAD_SIZE', 10 * 1024 * 1024))  # 10MB
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 
+    # 凭证缩略图/预览图（需要 Pillow，PDF 还需要 pdftoppm 或 PyMuPDF），在独立进程池中生成
+    THUMBNAILS_ENABLED = os.environ.get('THUMBNAILS_ENABLED', 'true').lower() == 'true'
+    THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 1))
+
+    # 上传图片压缩（后台进程执行）：按EXIF旋转并去除EXIF、缩小到最大边长、重新编码（webp|jpeg）
+    IMAGE_OPTIMIZE = os.environ.get('IMAGE_OPTIMIZE', 'true').lower() == 'true'
+    IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 2560))
+    IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'webp')
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 85))
+
+    # 后台任务队列（文件删除、上传后处理）：随应用启动的工作线程数，0 表示不启动（由 flask jobs run 执行）
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 5))  # 检查其他进程提交的任务的间隔（秒）
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', 10))  # 首次重试等待（秒），之后每次加倍
+    JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))  # 已完成任务的保留天数
+
+    # 凭证目录与数据库的定期核对（后台任务）：间隔（秒，0 表示不定期执行）；
+    # 孤儿文件处理方式 report（只报告）| quarantine（移到 instance/quarantine/）；修改时间早于该秒数的文件才算孤儿
+    STORAGE_RECONCILE_INTERVAL = int(os.environ.get('STORAGE_RECONCILE_INTERVAL', 24 * 3600))
+    STORAGE_RECONCILE_ACTION = os.environ.get('STORAGE_RECONCILE_ACTION', 'report')
+    STORAGE_ORPHAN_MIN_AGE = int(os.environ.get('STORAGE_ORPHAN_MIN_AGE', 3600))
+
+    # 凭证文件交给前端Web服务器发送：空（由Flask发送）| x-accel（nginx）| x-sendfile（Apache/lighttpd）
+    RECEIPT_SENDFILE = os.environ.get('RECEIPT_SENDFILE', '')
+    # x-accel 模式下 nginx 中对应 static/uploads/ 目录的 internal location
+    RECEIPT_ACCEL_PREFIX = os.environ.get('RECEIPT_ACCEL_PREFIX', '/protected-uploads/')
+
     # 会话配置
     SESSION_COOKIE_NAME = 'roommate_session'
     SESSION_COOKIE_HTTPONLY = True
@@ -36,6 +110,26 @@ class Config:
     REMEMBER_COOKIE_DURATION = timedelta(days=30)
     SESSION_PROTECTION = 'strong'
 
+    # 已登录用户快照缓存（user_loader），用户信息修改后会自动失效
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 256))
+
+    # 登录审计日志异步批量写入
+    LOGIN_AUDIT_ASYNC = os.environ.get('LOGIN_AUDIT_ASYNC', 'true').lower() == 'true'
+    LOGIN_AUDIT_QUEUE_SIZE = int(os.environ.get('LOGIN_AUDIT_QUEUE_SIZE', 1000))
+    LOGIN_AUDIT_BATCH_SIZE = int(os.environ.get('LOGIN_AUDIT_BATCH_SIZE', 100))
+    LOGIN_AUDIT_FLUSH_INTERVAL = float(os.environ.get('LOGIN_AUDIT_FLUSH_INTERVAL', 1.0))
+
+    # 多进程部署时各工作进程共享请求指标的目录（单进程部署留空）
+    METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+    # /metrics 中数据与存储指标的后台刷新间隔（秒）
+    METRICS_REFRESH_INTERVAL = int(os.environ.get('METRICS_REFRESH_INTERVAL', 30))
+
+    # 按请求统计SQL：疑似N+1查询日志和 Server-Timing 响应头；慢查询日志阈值（毫秒，0 表示关闭）
+    SQL_PROFILER = os.environ.get('SQL_PROFILER', 'false').lower() == 'true'
+    SQL_SLOW_QUERY_MS = int(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 5))
+
     # 服务器配置
     HOST = os.environ.get('HOST', '0.0.0.0')
     PORT = int(os.environ.get('PORT', 7769))
@@ -43,6 +137,12 @@ class Config:
     # 磁盘空间阈值（MB）
     MIN_DISK_SPACE_MB = int(os.environ.get('MIN_DISK_SPACE_MB', 100))
 
+    # /health 后台检查间隔（秒），探针只读取缓存结果
+    HEALTH_CHECK_INTERVAL = int(os.environ.get('HEALTH_CHECK_INTERVAL', 30))
+
+    # 系统配置缓存有效期（秒），0 表示仅在写入时刷新；多进程部署时建议设置为较短时间
+    SYSTEM_CONFIG_CACHE_TTL = int(os.environ.get('SYSTEM_CONFIG_CACHE_TTL', 0))
+
     @staticmethod
     def init_app(app):
         """初始化Flask应用配置"""
@@ -60,6 +160,7 @@ class DevelopmentConfig(Config):
 
     # 开发环境可以启用更详细的日志
     LOG_LEVEL = 'DEBUG'
+    SQL_PROFILER = os.environ.get('SQL_PROFILER', 'true').lower() == 'true'
 
 class ProductionConfig(Config):
     """生产环境配置"""
@@ -94,6 +195,9 @@ class TestingConfig(Config):
 
     # 测试环境使用内存数据库
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_ENGINE_OPTIONS = {}  # 内存数据库使用单线程连接池，不支持连接池参数
+    LOGIN_AUDIT_ASYNC = False  # 内存数据库无法跨线程共享，登录日志同步写入
+    JOB_WORKERS = 0  # 同上，测试中调用 job_queue.run_pending(app) 执行任务
 
     # 禁用CSRF保护以便测试
     WTF_CSRF_ENABLED = False
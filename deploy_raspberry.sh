@@ -58,10 +58,10 @@ detect_system() {
         PYTHON_VERSION=$(python3 --version 2>&1 | cut -d' ' -f2)
         info "Python版本: $PYTHON_VERSION"
 
-        # 检查版本是否满足要求 (>= 3.6)
-        MIN_VERSION="3.6"
-        if ! python3 -c "import sys; exit(0 if sys.version_info >= (3,6) else 1)" 2>/dev/null; then
-            error "Python版本过低，需要3.6或更高版本"
+        # 检查版本是否满足要求 (>= 3.7)
+        MIN_VERSION="3.7"
+        if ! python3 -c "import sys; exit(0 if sys.version_info >= (3,7) else 1)" 2>/dev/null; then
+            error "Python版本过低，需要3.7或更高版本"
             exit 1
         fi
         success "Python版本符合要求"
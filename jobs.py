@@ -0,0 +1,166 @@
+"""SQLite 持久化的后台任务队列
+
+请求处理中调用 enqueue() 把任务写入 job 表，与业务数据在同一事务中提交（回滚时任务也不存在），
+提交后唤醒工作线程立即执行，请求不再等待文件删除、图片压缩等慢操作。
+
+工作线程随应用启动（JOB_WORKERS 个），用一条 UPDATE ... RETURNING 领取任务（SQLite 3.35 之前先查询再带条件更新），
+多线程、多进程部署时同一任务只会被领取一次；其他进程提交的任务在 poll_interval 内被领取。
+失败的任务按指数退避重试（retry_delay * 2^(次数-1)，最长 max_retry_delay），次数用尽后标记为 failed，
+可用 flask jobs retry 重新放回队列；执行中进程退出的任务超过 stale_timeout 后会被重新领取。
+因此任务处理函数必须可以重复执行。
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+
+class JobQueue:
+    """任务处理函数注册表和工作线程"""
+
+    def __init__(self, workers=2, poll_interval=5, max_attempts=5, retry_delay=10, max_retry_delay=3600,
+                 stale_timeout=600, retention_days=7):
+        self.workers = workers  # 0 表示不启动工作线程（由 flask jobs run 执行）
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.stale_timeout = stale_timeout
+        self.retention_days = retention_days
+        self.purge_interval = 3600
+        self.handlers = {}
+        self._app = None
+        self._threads = []
+        self._pid = None
+        self._wake = False
+        self._stopping = False
+        self._last_purge = None
+        self._cond = threading.Condition()
+        self.stats = {
+            'succeeded': 0,  # 执行成功的任务数
+            'retried': 0,    # 失败后等待重试的次数
+            'failed': 0,     # 重试次数用尽的任务数
+        }
+
+    def handler(self, kind):
+        """注册任务处理函数（装饰器），函数接收 payload 字典，在应用上下文中执行"""
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def enqueue(self, kind, payload=None, key=None, delay=0):
+        """在当前数据库事务中登记任务，key 相同的任务未执行前不会重复登记"""
+        if kind not in self.handlers:
+            raise ValueError(f'未注册的任务类型: {kind}')
+        Job.enqueue(kind, payload or {}, idempotency_key=key, delay=delay, max_attempts=self.max_attempts)
+
+    def wake(self):
+        """有新任务提交时唤醒工作线程"""
+        with self._cond:
+            self._wake = True
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # 工作线程
+    # ------------------------------------------------------------------
+    def start(self, app):
+        """启动工作线程（已在当前进程运行时直接返回）"""
+        if self.workers <= 0 or (self._pid == os.getpid() and self._threads):
+            return
+        with self._cond:
+            # fork 后的子进程不继承线程，需要重新启动
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._app = app
+            self._pid = os.getpid()
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def shutdown(self, timeout=5):
+        """停止工作线程，等待正在执行的任务结束（超时后放弃，任务稍后会被重新领取）"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._pid == os.getpid():
+            deadline = time.monotonic() + timeout
+            for thread in self._threads:
+                thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+        self._pid = None
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                with self._app.app_context():
+                    ran = self.run_one()
+                    self._maybe_purge()
+            except Exception as e:
+                print(f"任务队列出错: {e}")
+                ran = False
+            if ran:
+                continue
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping or self._wake, timeout=self.poll_interval)
+                self._wake = False
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if not self.retention_days or (self._last_purge is not None and now - self._last_purge < self.purge_interval):
+            return
+        self._last_purge = now
+        purged = Job.purge_finished(datetime.utcnow() - timedelta(days=self.retention_days))
+        if purged:
+            print(f"已清理 {purged} 个 {self.retention_days} 天前完成的任务")
+
+    # ------------------------------------------------------------------
+    # 执行
+    # ------------------------------------------------------------------
+    def run_one(self):
+        """领取并执行一个到期任务（需在应用上下文中调用），没有可执行的任务时返回 False"""
+        job = Job.claim(datetime.utcnow() - timedelta(seconds=self.stale_timeout))
+        if job is None:
+            return False
+
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise LookupError(f'未注册的任务类型: {job.kind}')
+            handler(json.loads(job.payload))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            error = f'{type(e).__name__}: {e}'
+            if job.attempts < job.max_attempts:
+                delay = min(self.retry_delay * 2 ** (job.attempts - 1), self.max_retry_delay)
+                Job.finish(job.id, error, retry_at=datetime.utcnow() + timedelta(seconds=delay))
+                self._count('retried')
+                print(f"任务 {job.id}（{job.kind}）第 {job.attempts} 次执行失败，{delay} 秒后重试: {error}")
+            else:
+                Job.finish(job.id, error)
+                self._count('failed')
+                print(f"任务 {job.id}（{job.kind}）执行 {job.attempts} 次均失败: {error}")
+        else:
+            Job.finish(job.id)
+            self._count('succeeded')
+        return True
+
+    def _count(self, name):
+        with self._cond:
+            self.stats[name] += 1
+
+    def run_pending(self, app, limit=None):
+        """在当前线程执行到期任务，直到没有可执行的任务或达到 limit，返回执行数"""
+        count = 0
+        with app.app_context():
+            while (limit is None or count < limit) and self.run_one():
+                count += 1
+        return count
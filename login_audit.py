@@ -0,0 +1,188 @@
+"""登录审计日志的异步批量写入与过期日志归档
+
+log_login_attempt() 只把日志放入内存队列，LoginAuditWriter 的后台线程按批写入 login_log 表，
+同时维护每日登录汇总（LoginStatsDaily），并定期把超过保留天数的日志移到压缩归档文件
+（instance/archive/login_log-*.jsonl.gz，每行一条 JSON 记录）。
+"""
+import gzip
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from models import db, LoginLog, LoginStatsDaily, SystemConfig
+
+
+class LoginAuditWriter:
+    """登录审计日志异步批量写入（有界队列 + 后台线程）
+
+    登录请求只把日志放入内存队列，后台线程按批插入并每批提交一次。
+    队列满时短暂等待写入线程腾出空间，仍然满则丢弃该条日志并计数。
+    写入线程同时维护每日登录汇总，并每隔 retention_interval 秒归档一次过期日志。
+    """
+
+    def __init__(self, app, archive_folder, max_queue=1000, batch_size=100, flush_interval=1.0,
+                 enqueue_timeout=0.05):
+        self.app = app
+        self.archive_folder = archive_folder
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.enabled = True  # False 时在请求内同步写入
+        self.retention_interval = 24 * 3600
+        self._last_retention = None
+        self._pending = deque()
+        self._inflight = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self.stats = {
+            'enqueued': 0,      # 进入队列的日志数
+            'written': 0,       # 已写入数据库的日志数
+            'batches': 0,       # 写入批次数
+            'backpressure': 0,  # 队列满需要等待的次数
+            'dropped': 0,       # 因队列满或写入失败丢弃的日志数
+            'errors': 0,        # 写入失败的批次数
+        }
+
+    def submit(self, record):
+        """提交一条登录日志（字段同 LoginLog），返回是否已接收"""
+        if not self.enabled:
+            self._write_batch([record])
+            return True
+
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                self.stats['backpressure'] += 1
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: len(self._pending) < self.max_queue, timeout=self.enqueue_timeout)
+                if len(self._pending) >= self.max_queue:
+                    self.stats['dropped'] += 1
+                    return False
+            self._pending.append(record)
+            self.stats['enqueued'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        self._ensure_started()
+        return True
+
+    def flush(self, timeout=5):
+        """等待队列中的日志全部写入，返回是否在超时前完成"""
+        if self._thread is None or not self._thread.is_alive():
+            # 写入线程未运行（未启动或已关闭）时在当前线程写入
+            with self._cond:
+                batch = list(self._pending)
+                self._pending.clear()
+            if batch:
+                self._write_batch(batch)
+            return True
+
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout=timeout)
+
+    def shutdown(self, timeout=5):
+        """停止写入线程，退出前写完剩余日志"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _ensure_started(self):
+        # fork 后的子进程不继承线程，需要重新启动
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='login-audit-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: (self._stopping or self._flush_requested
+                             or len(self._pending) >= min(self.batch_size, self.max_queue)),
+                    timeout=self.flush_interval
+                )
+                if self._stopping and not self._pending:
+                    return
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                self._inflight = len(batch)
+                if not self._pending:
+                    self._flush_requested = False
+
+            if batch:
+                self._write_batch(batch)
+
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+
+            now = time.monotonic()
+            if self.retention_interval and (self._last_retention is None
+                                            or now - self._last_retention >= self.retention_interval):
+                self._last_retention = now
+                try:
+                    with self.app.app_context():
+                        archive_login_logs(self.archive_folder)
+                except Exception as e:
+                    print(f"登录日志归档失败: {e}")
+
+    def _write_batch(self, batch):
+        try:
+            # 使用独立的应用上下文（和会话），不影响请求中的事务
+            with self.app.app_context():
+                db.session.execute(LoginLog.__table__.insert(), batch)
+                LoginStatsDaily.record_batch(batch)
+                db.session.commit()
+            with self._cond:
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+        except Exception as e:
+            with self._cond:
+                self.stats['errors'] += 1
+                self.stats['dropped'] += len(batch)
+            print(f"登录日志写入失败，丢弃 {len(batch)} 条: {e}")
+
+
+def archive_login_logs(archive_folder, retention_days=None):
+    """将超过保留天数的登录日志移到 archive_folder 下的压缩归档文件，返回归档记录数"""
+    if retention_days is None:
+        retention_days = SystemConfig.get_config('system.login_log_retention_days', 90)
+    if not retention_days or retention_days <= 0:
+        return 0
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    has_expired = LoginLog.query.with_entities(LoginLog.id).filter(LoginLog.login_time < cutoff).first() is not None
+    # 结束读事务：WAL 模式下读事务期间若有其他连接提交，无法再升级为写事务
+    db.session.rollback()
+    if not has_expired:
+        return 0
+
+    os.makedirs(archive_folder, exist_ok=True)
+    archive_path = os.path.join(
+        archive_folder, f"login_log-{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{os.getpid()}.jsonl.gz"
+    )
+    with gzip.open(archive_path, 'xt', encoding='utf-8') as archive_file:
+        archived = LoginLog.archive_before(cutoff, archive_file)
+
+    if archived:
+        print(f"已归档 {archived} 条 {retention_days} 天前的登录日志到 {archive_path}")
+    else:
+        os.remove(archive_path)
+    return archived
@@ -0,0 +1,204 @@
+"""Prometheus 指标采集（不依赖第三方库）
+
+MetricsRegistry 在进程内以字典保存计数器、仪表和直方图，所有更新在一把锁内完成，
+可在多线程服务器中使用。多进程部署时设置共享目录（METRICS_MULTIPROC_DIR），
+各进程定期把自己的快照写入该目录，任一进程响应 /metrics 时合并全部快照：
+计数器和直方图按进程求和（已退出进程的累计值保留），仪表只合并仍在运行的进程。
+"""
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class MetricsRegistry:
+    """进程内指标注册表（线程安全）"""
+
+    def __init__(self, flush_interval=5):
+        self.flush_interval = flush_interval  # 多进程模式下写快照的最短间隔（秒）
+        self.multiprocess_dir = None
+        self._lock = threading.Lock()
+        self._metrics = {}  # 指标名 -> {'type', 'help', 'buckets'}
+        self._values = {}   # 指标名 -> {标签元组: 值}；直方图的值为 [各桶计数..., 总和, 次数]
+        self._last_flush = 0
+
+    def configure(self, multiprocess_dir=None):
+        """设置多进程共享目录（为空时只统计当前进程）"""
+        self.multiprocess_dir = multiprocess_dir or None
+        if self.multiprocess_dir:
+            os.makedirs(self.multiprocess_dir, exist_ok=True)
+
+    # ------------------------------------------------------------------
+    # 定义指标
+    # ------------------------------------------------------------------
+    def counter(self, name, help_text):
+        self._define(name, 'counter', help_text)
+
+    def gauge(self, name, help_text):
+        self._define(name, 'gauge', help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._define(name, 'histogram', help_text, tuple(sorted(buckets)))
+
+    def _define(self, name, metric_type, help_text, buckets=None):
+        with self._lock:
+            self._metrics[name] = {'type': metric_type, 'help': help_text, 'buckets': buckets}
+            self._values.setdefault(name, {})
+
+    # ------------------------------------------------------------------
+    # 更新
+    # ------------------------------------------------------------------
+    def inc(self, name, labels=(), amount=1):
+        """计数器/仪表增加 amount（labels 为 (名称, 值) 元组）"""
+        with self._lock:
+            values = self._values[name]
+            values[labels] = values.get(labels, 0) + amount
+        self._maybe_flush()
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._values[name][labels] = value
+
+    def observe(self, name, value, labels=()):
+        """直方图记录一次观测值"""
+        buckets = self._metrics[name]['buckets']
+        with self._lock:
+            values = self._values[name]
+            series = values.get(labels)
+            if series is None:
+                series = values[labels] = [0] * len(buckets) + [0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+        self._maybe_flush()
+
+    # ------------------------------------------------------------------
+    # 多进程快照
+    # ------------------------------------------------------------------
+    def snapshot(self):
+        """返回可序列化的当前值 {指标名: [[标签, 值], ...]}"""
+        with self._lock:
+            return {
+                name: [[list(map(list, labels)), list(value) if isinstance(value, list) else value]
+                       for labels, value in values.items()]
+                for name, values in self._values.items()
+            }
+
+    def _maybe_flush(self):
+        if self.multiprocess_dir and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把当前进程的快照写入共享目录（原子替换）"""
+        if not self.multiprocess_dir:
+            return
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.multiprocess_dir, f'{os.getpid()}.json')
+        temp_path = f'{path}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"指标快照写入失败: {e}")
+
+    def _collect(self):
+        """合并所有进程的快照，返回 {指标名: {标签元组: 值}}"""
+        if not self.multiprocess_dir:
+            return self._values_copy()
+
+        self.flush()
+        merged = {name: {} for name in self._metrics}
+        for filename in os.listdir(self.multiprocess_dir):
+            if not filename.endswith('.json'):
+                continue
+            pid = int(filename[:-5]) if filename[:-5].isdigit() else None
+            try:
+                with open(os.path.join(self.multiprocess_dir, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = pid is not None and _pid_alive(pid)
+            for name, series in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric['type'] == 'gauge' and not alive):
+                    continue
+                values = merged[name]
+                for labels, value in series:
+                    key = tuple(tuple(pair) for pair in labels)
+                    if isinstance(value, list):
+                        current = values.get(key)
+                        values[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        values[key] = values.get(key, 0) + value
+        return merged
+
+    def _values_copy(self):
+        with self._lock:
+            return {
+                name: {labels: list(value) if isinstance(value, list) else value
+                       for labels, value in values.items()}
+                for name, values in self._values.items()
+            }
+
+    # ------------------------------------------------------------------
+    # 输出
+    # ------------------------------------------------------------------
+    def render(self):
+        """按 Prometheus 文本格式输出全部指标"""
+        collected = self._collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for labels, value in sorted(collected.get(name, {}).items()):
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric['buckets'] + (math.inf,), value[:-2] + [0]):
+                    cumulative += count
+                    if bound == math.inf:
+                        cumulative = value[-1]
+                    bucket_labels = labels + (('le', _format_value(bound)),)
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(round(value[-2], 6))}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
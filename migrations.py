@@ -0,0 +1,416 @@
+"""数据库结构迁移
+
+每个迁移有一个递增的版本号，已应用的版本记录在 schema_version 表中。
+启动时只查询一次当前版本号，结构已是最新时不做任何表结构检查；
+新增迁移时在 MIGRATIONS 末尾追加，不要修改已发布的迁移。
+"""
+from collections import defaultdict
+
+from sqlalchemy.exc import OperationalError
+from models import db, SchemaVersion, create_fts_index, fts_ddl
+
+# 迁移只能使用下面固定的表定义和显式列名的SQL，不能使用模型（模型总是最新结构，
+# 旧数据库升级到中间版本时还没有后续迁移添加的字段）。
+
+
+def _user_table(metadata):
+    """版本管理之前的 user 表（迁移中只作为外键目标）"""
+    return db.Table(
+        'user', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('username', db.String(80), unique=True, nullable=False),
+        db.Column('password_hash', db.String(120), nullable=False),
+        db.Column('display_name', db.String(100), nullable=False),
+        db.Column('created_at', db.DateTime),
+        db.Column('is_default_password', db.Boolean, nullable=False),
+        db.Column('is_admin', db.Boolean, nullable=False),
+        db.Column('last_login', db.DateTime),
+        db.Column('login_attempts', db.Integer, nullable=False),
+        db.Column('locked_until', db.DateTime),
+        db.Column('is_active', db.Boolean, nullable=False),
+    )
+
+
+def _bill_columns():
+    """版本管理之前 bill 表中保留到版本2的字段"""
+    return [
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('payer_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
+        db.Column('amount', db.Float, nullable=False),
+        db.Column('description', db.String(200), nullable=False),
+        db.Column('date', db.DateTime),
+        db.Column('is_settled', db.Boolean),
+        db.Column('receipt_filename', db.String(200)),
+        db.Column('receipt_type', db.String(10)),
+        db.Column('created_at', db.DateTime),
+    ]
+
+
+def _baseline_metadata():
+    """版本管理之前的表结构（迁移1）"""
+    metadata = db.MetaData()
+    _user_table(metadata)
+    db.Table(
+        'system_config', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('key', db.String(100), unique=True, nullable=False),
+        db.Column('value', db.String(500), nullable=False),
+        db.Column('description', db.String(200)),
+        db.Column('created_at', db.DateTime),
+        db.Column('updated_at', db.DateTime),
+    )
+    bill_columns = _bill_columns()
+    bill_columns.insert(5, db.Column('participants', db.String(50), nullable=False))
+    db.Table('bill', metadata, *bill_columns)
+    db.Table(
+        'login_log', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+        db.Column('username', db.String(80), nullable=False),
+        db.Column('ip_address', db.String(45)),
+        db.Column('user_agent', db.String(500)),
+        db.Column('login_time', db.DateTime),
+        db.Column('success', db.Boolean, nullable=False),
+        db.Column('failure_reason', db.String(200)),
+    )
+    db.Table(
+        'settlement', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('bill_id', db.Integer, db.ForeignKey('bill.id'), nullable=False),
+        db.Column('settler_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
+        db.Column('settled_amount', db.Float, nullable=False),
+        db.Column('settled_date', db.DateTime),
+    )
+    db.Table(
+        'receipt', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('bill_id', db.Integer, db.ForeignKey('bill.id'), nullable=False),
+        db.Column('filename', db.String(200), nullable=False),
+        db.Column('file_type', db.String(10), nullable=False),
+        db.Column('file_size', db.Integer),
+        db.Column('upload_date', db.DateTime),
+    )
+    return metadata
+
+
+def create_baseline_tables():
+    """创建版本管理之前的基础表（已存在的表不变）"""
+    _baseline_metadata().create_all(db.engine)
+
+
+def migrate_legacy_participants():
+    """将旧版逗号分隔的 bill.participants 字段迁移到 bill_participant 关联表"""
+    metadata = db.MetaData()
+    _user_table(metadata)
+    db.Table('bill', metadata, db.Column('id', db.Integer, primary_key=True))  # 外键目标
+    participant_table = db.Table(
+        'bill_participant', metadata,
+        db.Column('bill_id', db.Integer, db.ForeignKey('bill.id', ondelete='CASCADE'), primary_key=True),
+        db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+        db.Index('ix_bill_participant_user_bill', 'user_id', 'bill_id')
+    )
+    new_bill_table = db.Table('bill_new', metadata, *_bill_columns())
+    participant_table.create(db.engine, checkfirst=True)
+
+    bill_columns = [column['name'] for column in db.inspect(db.engine).get_columns('bill')]
+    if 'participants' not in bill_columns:
+        return
+
+    with db.engine.begin() as conn:
+        # 旧数据中可能混有用户名，一次性构建用户名到ID的映射
+        user_rows = conn.exec_driver_sql('SELECT id, username FROM user').all()
+        user_ids = {row.id for row in user_rows}
+        username_to_id = {row.username: row.id for row in user_rows}
+
+        rows = []
+        for bill_id, raw_participants in conn.exec_driver_sql('SELECT id, participants FROM bill'):
+            for token in (raw_participants or '').split(','):
+                token = token.strip()
+                if not token:
+                    continue
+                user_id = int(token) if token.isdigit() else username_to_id.get(token)
+                if user_id in user_ids:
+                    rows.append({'bill_id': bill_id, 'user_id': user_id})
+                else:
+                    print(f"警告: 账单{bill_id}的参与者 '{token}' 无法匹配到用户，已跳过")
+
+        if rows:
+            conn.execute(participant_table.insert().prefix_with('OR IGNORE'), rows)
+
+        # 按SQLite官方流程重建bill表以删除旧字段（兼容不支持 DROP COLUMN 的旧版SQLite）
+        new_bill_table.create(conn)
+        kept_columns = ', '.join(c.name for c in new_bill_table.columns)
+        conn.exec_driver_sql(f'INSERT INTO bill_new ({kept_columns}) SELECT {kept_columns} FROM bill')
+        conn.exec_driver_sql('DROP TABLE bill')
+        conn.exec_driver_sql('ALTER TABLE bill_new RENAME TO bill')
+
+    print(f"已迁移 {len(rows)} 条账单参与人记录到 bill_participant 表")
+
+
+def migrate_bill_counters():
+    """为旧数据库添加账单结算计数字段并重新计数"""
+    bill_columns = [column['name'] for column in db.inspect(db.engine).get_columns('bill')]
+    with db.engine.begin() as conn:
+        for column in ('participant_count', 'settled_count'):
+            if column not in bill_columns:
+                conn.exec_driver_sql(f'ALTER TABLE bill ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+        conn.exec_driver_sql(
+            'UPDATE bill SET '
+            'participant_count = (SELECT COUNT(*) FROM bill_participant p WHERE p.bill_id = bill.id), '
+            'settled_count = (SELECT COUNT(*) FROM bill_participant p WHERE p.bill_id = bill.id AND '
+            '(p.user_id = bill.payer_id OR EXISTS ('
+            'SELECT 1 FROM settlement s WHERE s.bill_id = bill.id AND s.settler_id = p.user_id)))'
+        )
+    print("已重新计算账单结算计数")
+
+
+def rebuild_ledger():
+    """从现有账单数据构建债务账本（计算方法同 PairwiseBalance.rebuild）"""
+    metadata = db.MetaData()
+    _user_table(metadata)
+    balance_table = db.Table(
+        'pairwise_balance', metadata,
+        db.Column('debtor_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+        db.Column('creditor_id', db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True),
+        db.Column('amount', db.Float, nullable=False),
+        db.Column('open_bill_ids', db.Text, nullable=False),
+    )
+    balance_table.create(db.engine, checkfirst=True)
+
+    with db.engine.begin() as conn:
+        participants = defaultdict(list)
+        for bill_id, user_id in conn.exec_driver_sql('SELECT bill_id, user_id FROM bill_participant'):
+            participants[bill_id].append(user_id)
+        settled = defaultdict(set)
+        for bill_id, settler_id in conn.exec_driver_sql('SELECT bill_id, settler_id FROM settlement'):
+            settled[bill_id].add(settler_id)
+
+        pairs = defaultdict(lambda: {'amount': 0, 'bill_ids': []})
+        for bill_id, payer_id, amount in conn.exec_driver_sql('SELECT id, payer_id, amount FROM bill ORDER BY id'):
+            user_ids = participants[bill_id]
+            if not user_ids:
+                continue
+            split_amount = round(amount / len(user_ids), 2)
+            for debtor_id in user_ids:
+                if debtor_id == payer_id or debtor_id in settled[bill_id]:
+                    continue
+                pair = pairs[(debtor_id, payer_id)]
+                pair['amount'] += split_amount
+                pair['bill_ids'].append(str(bill_id))
+
+        conn.execute(balance_table.delete())
+        if pairs:
+            conn.execute(balance_table.insert(), [
+                {
+                    'debtor_id': debtor_id,
+                    'creditor_id': creditor_id,
+                    'amount': round(data['amount'], 2),
+                    'open_bill_ids': ','.join(data['bill_ids']),
+                }
+                for (debtor_id, creditor_id), data in pairs.items()
+            ])
+    print(f"已重建债务账本: {len(pairs)} 个债务对")
+
+
+# 热点查询索引：(索引名, 表名, 字段)。迁移脚本固定写死，不随模型定义变化
+HOT_PATH_INDEXES = [
+    ('ix_bill_date_id', 'bill', ('date', 'id')),
+    ('ix_bill_payer_settled', 'bill', ('payer_id', 'is_settled')),
+    ('ix_settlement_bill_settler', 'settlement', ('bill_id', 'settler_id')),
+    ('ix_receipt_bill_id', 'receipt', ('bill_id',)),
+    ('ix_login_log_login_time', 'login_log', ('login_time',)),
+    ('ix_login_log_username', 'login_log', ('username',)),
+]
+
+
+def add_hot_path_indexes():
+    """为账单、结算、凭证和登录日志的常用查询添加索引"""
+    with db.engine.begin() as conn:
+        for name, table, columns in HOT_PATH_INDEXES:
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})')
+
+
+def analyze_database():
+    """更新SQLite查询规划器的统计信息"""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+
+
+def create_login_stats():
+    """创建登录每日汇总表并用现有登录日志回填"""
+    stats_table = db.Table(
+        'login_stats_daily', db.MetaData(),
+        db.Column('date', db.Date, primary_key=True),
+        db.Column('username', db.String(80), primary_key=True),
+        db.Column('success_count', db.Integer, nullable=False),
+        db.Column('failure_count', db.Integer, nullable=False),
+    )
+    stats_table.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('DELETE FROM login_stats_daily')
+        conn.exec_driver_sql(
+            'INSERT INTO login_stats_daily (date, username, success_count, failure_count) '
+            'SELECT date(login_time), username, SUM(success = 1), SUM(success = 0) '
+            'FROM login_log WHERE login_time IS NOT NULL '
+            'GROUP BY date(login_time), username'
+        )
+
+
+def create_login_log_search():
+    """创建登录日志全文索引并导入现有日志"""
+    with db.engine.begin() as conn:
+        ddl = fts_ddl('login_log', ['username', 'ip_address', 'user_agent', 'failure_reason'])
+        if create_fts_index(conn, ddl):
+            conn.exec_driver_sql("INSERT INTO login_log_fts (login_log_fts) VALUES ('rebuild')")
+
+
+# 迁移9 按描述开头的类型名称推断账单类型（添加字段时 models.BILL_CATEGORIES 的内容，无法识别时为 other）
+BILL_CATEGORY_PREFIXES = [
+    ('water', '💧 水费'),
+    ('electricity', '⚡ 电费'),
+    ('gas', '🔥 燃气费'),
+    ('trash', '🗑️ 垃圾费'),
+    ('internet', '🌐 网费'),
+    ('shopping', '🛒 超市购买'),
+    ('food', '🍔 餐饮外卖'),
+    ('daily', '🧻 日用品'),
+]
+
+
+def add_bill_category_and_search():
+    """添加账单类型字段（从描述推断），并创建账单描述全文索引"""
+    bill_columns = [column['name'] for column in db.inspect(db.engine).get_columns('bill')]
+    bill_table = db.table('bill', db.column('id'), db.column('category'))
+    with db.engine.begin() as conn:
+        if 'category' not in bill_columns:
+            conn.exec_driver_sql("ALTER TABLE bill ADD COLUMN category VARCHAR(20) NOT NULL DEFAULT 'other'")
+
+        updates = []
+        for bill_id, description in conn.exec_driver_sql('SELECT id, description FROM bill'):
+            category = next((category for category, prefix in BILL_CATEGORY_PREFIXES
+                             if (description or '').startswith(prefix)), 'other')
+            updates.append({'bill_id': bill_id, 'category': category})
+        if updates:
+            conn.execute(
+                bill_table.update().where(bill_table.c.id == db.bindparam('bill_id'))
+                .values(category=db.bindparam('category')),
+                updates
+            )
+        conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_bill_category_date ON bill (category, date)')
+
+        if create_fts_index(conn, fts_ddl('bill', ['description'])):
+            conn.exec_driver_sql("INSERT INTO bill_fts (bill_fts) VALUES ('rebuild')")
+
+
+def create_receipt_blob_store():
+    """创建内容寻址凭证文件表，并为凭证添加存储键字段（已有文件仍按账单目录读取）"""
+    blob_table = db.Table(
+        'receipt_blob', db.MetaData(),
+        db.Column('key', db.String(80), primary_key=True),
+        db.Column('size', db.Integer, nullable=False),
+        db.Column('ref_count', db.Integer, nullable=False),
+        db.Column('created_at', db.DateTime),
+    )
+    blob_table.create(db.engine, checkfirst=True)
+    receipt_columns = [column['name'] for column in db.inspect(db.engine).get_columns('receipt')]
+    with db.engine.begin() as conn:
+        if 'blob_key' not in receipt_columns:
+            conn.exec_driver_sql('ALTER TABLE receipt ADD COLUMN blob_key VARCHAR(80) REFERENCES receipt_blob ("key")')
+        conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_receipt_blob_key ON receipt (blob_key)')
+
+
+def add_receipt_original_size():
+    """为凭证添加原始大小和保留原图字段（已有凭证的原始大小即当前大小）"""
+    receipt_columns = [column['name'] for column in db.inspect(db.engine).get_columns('receipt')]
+    with db.engine.begin() as conn:
+        if 'original_size' not in receipt_columns:
+            conn.exec_driver_sql('ALTER TABLE receipt ADD COLUMN original_size INTEGER')
+        if 'original_blob_key' not in receipt_columns:
+            conn.exec_driver_sql('ALTER TABLE receipt ADD COLUMN original_blob_key VARCHAR(80) REFERENCES receipt_blob ("key")')
+        conn.exec_driver_sql('UPDATE receipt SET original_size = file_size WHERE original_size IS NULL')
+
+
+def create_job_queue():
+    """创建后台任务表"""
+    job_table = db.Table(
+        'job', db.MetaData(),
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('kind', db.String(50), nullable=False),
+        db.Column('payload', db.Text, nullable=False),
+        db.Column('status', db.String(10), nullable=False),
+        db.Column('attempts', db.Integer, nullable=False),
+        db.Column('max_attempts', db.Integer, nullable=False),
+        db.Column('run_after', db.DateTime, nullable=False),
+        db.Column('idempotency_key', db.String(200)),
+        db.Column('last_error', db.Text),
+        db.Column('locked_at', db.DateTime),
+        db.Column('created_at', db.DateTime),
+        db.Column('finished_at', db.DateTime),
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+        db.Index('ux_job_pending_key', 'idempotency_key', unique=True, sqlite_where=db.text("status = 'pending'")),
+    )
+    job_table.create(db.engine, checkfirst=True)
+
+
+# (版本号, 说明, 迁移函数)，按版本号顺序执行
+MIGRATIONS = [
+    (1, '创建基础表结构', create_baseline_tables),
+    (2, '迁移账单参与人到 bill_participant 关联表', migrate_legacy_participants),
+    (3, '添加账单结算计数字段', migrate_bill_counters),
+    (4, '构建债务账本', rebuild_ledger),
+    (5, '添加热点查询索引', add_hot_path_indexes),
+    (6, '更新查询统计信息', analyze_database),
+    (7, '创建登录每日汇总表', create_login_stats),
+    (8, '创建登录日志全文索引', create_login_log_search),
+    (9, '添加账单类型字段和描述全文索引', add_bill_category_and_search),
+    (10, '创建内容寻址凭证文件存储', create_receipt_blob_store),
+    (11, '添加凭证原始大小字段', add_receipt_original_size),
+    (12, '创建后台任务表', create_job_queue),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version():
+    """返回当前数据库结构版本，未记录版本时返回 None"""
+    try:
+        return db.session.execute(db.select(db.func.max(SchemaVersion.version))).scalar() or 0
+    except OperationalError:
+        db.session.rollback()
+        return None
+
+
+def record_version(version, description):
+    db.session.add(SchemaVersion(version=version, description=description))
+    db.session.commit()
+
+
+def upgrade_database():
+    """将数据库升级到最新版本，返回本次应用的迁移数量"""
+    current = get_schema_version()
+    if current is not None and current >= LATEST_VERSION:
+        return 0
+
+    if current is None and not db.inspect(db.engine).has_table('user'):
+        # 全新数据库：模型定义已是最新结构，直接建表并记录为最新版本。
+        # 不执行 ANALYZE：空表的统计信息会误导查询规划器（FTS5 写入会变得极慢）
+        db.create_all()
+        record_version(LATEST_VERSION, '初始化数据库')
+        print(f"已创建数据库，结构版本 {LATEST_VERSION}")
+        return 1
+
+    if current is None:
+        # 引入版本管理之前的数据库：创建版本表后从头执行（各迁移均可重复执行）
+        SchemaVersion.__table__.create(db.engine, checkfirst=True)
+        current = 0
+
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"执行数据库迁移 {version}: {description}")
+        migrate()
+        record_version(version, description)
+        applied += 1
+    print(f"数据库结构已升级到版本 {LATEST_VERSION}")
+    return applied
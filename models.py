@@ -1,10 +1,99 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.dialects.sqlite import dialect as sqlite_dialect, insert as sqlite_insert
+from flask import g, has_app_context
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
+import sqlite3
+import threading
+import time
 from werkzeug.security import generate_password_hash, check_password_hash
+from storage import blob_relative_path
 
 db = SQLAlchemy()
 
+# UPDATE/DELETE ... RETURNING 需要 SQLite 3.35+（树莓派 OS Bullseye 自带 3.34.1），
+# 且 SQLite 方言要能编译 RETURNING（SQLAlchemy 2.0+，1.4 没有 update_returning/delete_returning），否则先查询再修改
+SQLITE_HAS_RETURNING = (sqlite3.sqlite_version_info >= (3, 35, 0)
+                        and getattr(sqlite_dialect, 'update_returning', False)
+                        and getattr(sqlite_dialect, 'delete_returning', False))
+
+# ---------------------------------------------------------------------------
+# 全文索引（FTS5 外部内容表 + 同步触发器）
+# trigram 分词支持任意子串搜索（含中文），但搜索词至少需要3个字符
+# ---------------------------------------------------------------------------
+FTS_MIN_TERM_LENGTH = 3
+_fts_tables = {}  # 全文索引表是否存在的缓存
+
+def fts_ddl(table, columns):
+    """生成表 table 的全文索引表 {table}_fts 及同步触发器的建表语句"""
+    fts = f'{table}_fts'
+    names = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    insert_new = f"INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new_values});"
+    delete_old = f"INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"{names}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        # 只在被索引的字段变化时更新索引
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {names} ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+    ]
+
+def create_fts_index(connection, ddl):
+    """执行全文索引建表语句（SQLite 未编译 FTS5 时跳过，搜索退化为 LIKE），返回是否成功"""
+    try:
+        for statement in ddl:
+            connection.exec_driver_sql(statement)
+    except OperationalError as e:
+        print(f"警告: 无法创建全文索引，搜索将使用 LIKE: {e}")
+        return False
+    _fts_tables.clear()
+    return True
+
+def fts_available(table):
+    if table not in _fts_tables:
+        _fts_tables[table] = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+        ), {'name': f'{table}_fts'}).first() is not None
+    return _fts_tables[table]
+
+def fts_search(model, text, columns, column=None):
+    """构建文本搜索：空格分隔的每个词都须出现（子串匹配）
+
+    column 为空时搜索 columns 中的全部字段，否则只搜索该字段。
+    返回 (命中子查询或None, LIKE条件列表)。子查询含 id 和 rank（bm25，越小越相关）两列；
+    不少于3个字符的词走全文索引，更短的词（或没有全文索引时）用 LIKE 过滤。
+    """
+    table = model.__tablename__
+    searched = [column] if column else columns
+    terms = text.split()
+    if fts_available(table):
+        fts_terms = [term for term in terms if len(term) >= FTS_MIN_TERM_LENGTH]
+        like_terms = [term for term in terms if len(term) < FTS_MIN_TERM_LENGTH]
+    else:
+        fts_terms, like_terms = [], terms
+
+    matches = None
+    if fts_terms:
+        prefix = f'{column} : ' if column else ''
+        match = ' AND '.join(prefix + '"' + term.replace('"', '""') + '"' for term in fts_terms)
+        matches = db.text(
+            f'SELECT rowid AS id, bm25({table}_fts) AS rank FROM {table}_fts WHERE {table}_fts MATCH :match'
+        ).bindparams(match=match).columns(db.column('id', db.Integer), db.column('rank', db.Float)).subquery()
+
+    like_conditions = []
+    for term in like_terms:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        like_conditions.append(db.or_(*(getattr(model, name).like(pattern, escape='\\') for name in searched)))
+    return matches, like_conditions
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -63,49 +152,159 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+# 账单参与人关联表（多对多）
+# 主键 (bill_id, user_id) 用于按账单查参与人，另建 (user_id, bill_id) 索引用于"我参与的账单"
+bill_participant = db.Table(
+    'bill_participant',
+    db.Column('bill_id', db.Integer, db.ForeignKey('bill.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_bill_participant_user_bill', 'user_id', 'bill_id')
+)
+
+# 账单类型：类型代码 -> 显示名称（账单描述以显示名称开头）
+BILL_CATEGORIES = {
+    'water': '💧 水费',
+    'electricity': '⚡ 电费',
+    'gas': '🔥 燃气费',
+    'trash': '🗑️ 垃圾费',
+    'internet': '🌐 网费',
+    'shopping': '🛒 超市购买',
+    'food': '🍔 餐饮外卖',
+    'daily': '🧻 日用品',
+    'other': '📝 其它费用'
+}
+
 class Bill(db.Model):
+    __table_args__ = (
+        db.Index('ix_bill_date_id', 'date', 'id'),  # 账单列表按 (date, id) 游标分页，也覆盖按日期查询
+        db.Index('ix_bill_payer_settled', 'payer_id', 'is_settled'),
+        db.Index('ix_bill_category_date', 'category', 'date'),  # 按类型筛选和分类统计
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     payer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(200), nullable=False)
+    category = db.Column(db.String(20), default='other', server_default='other', nullable=False)  # BILL_CATEGORIES 的键
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    participants = db.Column(db.String(50), nullable=False)  # 存储参与人ID，逗号分隔
     is_settled = db.Column(db.Boolean, default=False)
     receipt_filename = db.Column(db.String(200))  # 凭证文件名
     receipt_type = db.Column(db.String(10))  # 文件类型（pdf/image）
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # 持久化的结算进度计数（由结算相关操作维护，付款人计为已结算）
+    participant_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    settled_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
     # 关系
     settlements = db.relationship('Settlement', backref='bill', lazy=True, cascade='all, delete-orphan')
     receipts = db.relationship('Receipt', backref='bill', lazy=True, cascade='all, delete-orphan')
+    participant_users = db.relationship('User', secondary=bill_participant, lazy='selectin',
+                                        order_by='User.id',
+                                        backref=db.backref('participated_bills', lazy='dynamic'))
+
+    @staticmethod
+    def with_details(query=None):
+        """为账单查询批量预加载结算、凭证、付款人和参与人，避免N+1查询"""
+        query = query if query is not None else Bill.query
+        return query.options(
+            selectinload(Bill.settlements),
+            selectinload(Bill.receipts),
+            selectinload(Bill.payer),
+            selectinload(Bill.participant_users)
+        )
+
+    @staticmethod
+    def category_from_description(description):
+        """根据描述开头的类型名称推断账单类型，无法识别时为 other"""
+        for category, name in BILL_CATEGORIES.items():
+            if category != 'other' and (description or '').startswith(name):
+                return category
+        return 'other'
+
+    @staticmethod
+    def search(text):
+        """按描述搜索账单（子串匹配），返回 (命中子查询或None, LIKE条件列表)，见 fts_search"""
+        return fts_search(Bill, text, ['description'])
+
+    @staticmethod
+    def participated_by(user_id):
+        """返回用户参与的账单查询（走 bill_participant 的 (user_id, bill_id) 索引）"""
+        return Bill.query.join(bill_participant, bill_participant.c.bill_id == Bill.id)\
+            .filter(bill_participant.c.user_id == user_id)
 
     def get_participants_list(self):
         """返回参与人ID列表"""
-        if not self.participants:
-            return []
+        return [user.id for user in self.participant_users]
+
+    def has_participant(self, user_id):
+        """检查用户是否为该账单的参与人"""
+        return user_id in self.get_participants_list()
+
+    def set_participants(self, user_ids):
+        """设置参与人（接受ID列表）
+
+        参与人为空，或有无效ID、不存在的用户、已停用的用户（原本就是参与人的除外）时抛出 ValueError，
+        参与人保持不变。
+        """
+        try:
+            user_ids = {int(user_id) for user_id in user_ids}
+        except (TypeError, ValueError):
+            raise ValueError('参与人无效')
+        if not user_ids:
+            raise ValueError('至少需要选择一个参与人')
+        current_ids = set(self.get_participants_list())
+        users = User.query.filter(User.id.in_(user_ids)).order_by(User.id).all()
+        invalid = user_ids - {user.id for user in users if user.is_active or user.id in current_ids}
+        if invalid:
+            raise ValueError(f"参与人不存在或已停用: {', '.join(str(user_id) for user_id in sorted(invalid))}")
+        self._clear_settlement_status()
+        self.participant_users = users
+
+    def update_settlement_counters(self, settled_ids=None):
+        """刷新 participant_count/settled_count
+
+        settled_ids: 已结算的用户ID集合；默认从已加载的结算记录中获取
+        """
+        if settled_ids is None:
+            settled_ids = {settlement.settler_id for settlement in self.settlements}
+        participants = self.get_participants_list()
+        self.participant_count = len(participants)
+        self.settled_count = sum(
+            1 for user_id in participants if user_id == self.payer_id or user_id in settled_ids
+        )
+        self._clear_settlement_status()
 
-        participant_ids = []
-        for x in self.participants.split(','):
-            x = x.strip()
-            if not x:
-                continue
-
-            # 尝试转换为整数
-            try:
-                participant_ids.append(int(x))
-            except ValueError:
-                # 如果转换失败，可能是用户名，尝试通过用户名查找用户ID
-                try:
-                    user = User.query.filter_by(username=x).first()
-                    if user:
-                        participant_ids.append(user.id)
-                        print(f"警告: 参与者字段包含用户名 '{x}'，已自动转换为用户ID {user.id}")
-                    else:
-                        print(f"错误: 无法找到用户名为 '{x}' 的用户")
-                except Exception as e:
-                    print(f"错误: 处理参与者 '{x}' 时发生异常: {e}")
-
-        return participant_ids
+    @staticmethod
+    def recount_settlement_counters(bill_ids=None):
+        """用单条SQL从 bill_participant/settlement 重新计算结算计数（用于迁移和批量操作）"""
+        bill = Bill.__table__
+        participant = bill_participant.alias()
+        settlement = Settlement.__table__
+        participant_count = db.select(db.func.count()).select_from(participant)\
+            .where(participant.c.bill_id == bill.c.id).scalar_subquery()
+        settled_count = db.select(db.func.count()).select_from(participant).where(
+            participant.c.bill_id == bill.c.id,
+            db.or_(
+                participant.c.user_id == bill.c.payer_id,
+                db.exists().where(settlement.c.bill_id == bill.c.id, settlement.c.settler_id == participant.c.user_id)
+            )
+        ).scalar_subquery()
+        stmt = bill.update().values(participant_count=participant_count, settled_count=settled_count)
+        if bill_ids is not None:
+            stmt = stmt.where(bill.c.id.in_(bill_ids))
+        db.session.execute(stmt)
+
+    def get_open_debts(self, settled_ids=None):
+        """返回未结算参与人的应付金额 {债务人ID: 金额}（付款人除外）"""
+        if settled_ids is None:
+            settled_ids = {settlement.settler_id for settlement in self.settlements}
+        split_amount = self.get_split_amount()
+        return {
+            user_id: split_amount
+            for user_id in self.get_participants_list()
+            if user_id != self.payer_id and user_id not in settled_ids
+        }
 
     def get_split_amount(self):
         """计算每人应付金额"""
@@ -114,8 +313,17 @@ class Bill(db.Model):
             return round(self.amount / participants_count, 2)
         return 0
 
-    def get_settlement_status(self):
-        """获取每个参与者的结算状态"""
+    def get_settlement_status(self, users=None):
+        """获取每个参与者的结算状态（同一请求内同一账单、同一 users 映射只计算一次，对象过期时失效）
+
+        users: 可选的预加载 {用户ID: User} 映射；默认使用已加载的参与人关系
+        """
+        memo = _settlement_status_memo().setdefault(id(self), (self, {}))[1]
+        cached = memo.get(id(users))
+        if cached is not None:
+            return cached[1]
+
+        user_map = users if users is not None else {user.id: user for user in self.participant_users}
 
         participants = self.get_participants_list()
         split_amount = self.get_split_amount()
@@ -132,7 +340,7 @@ class Bill(db.Model):
 
         # 为每个参与者生成状态
         for user_id in participants:
-            user = User.query.get(user_id)
+            user = user_map.get(user_id)
             if user:
                 is_payer = user_id == self.payer_id
                 settlement_status[user_id] = {
@@ -144,28 +352,29 @@ class Bill(db.Model):
                     'settled_date': settled_users.get(user_id, {}).get('date', None)
                 }
 
+        # 同时保存账单和 users 的引用，请求结束前它们的 id() 不会被其他对象复用
+        memo[id(users)] = (users, settlement_status)
         return settlement_status
 
+    def _clear_settlement_status(self):
+        _settlement_status_memo().pop(id(self), None)
+
     def get_settlement_progress(self):
-        """获取结算进度"""
-        settlement_status = self.get_settlement_status()
-        if not settlement_status:
+        """获取结算进度（直接读取持久化计数）"""
+        total_count = self.participant_count or 0
+        if total_count == 0:
             return {'settled': 0, 'total': 0, 'percentage': 0}
 
-        settled_count = sum(1 for status in settlement_status.values() if status['is_settled'])
-        total_count = len(settlement_status)
-        percentage = round((settled_count / total_count) * 100) if total_count > 0 else 0
-
+        settled_count = self.settled_count or 0
         return {
             'settled': settled_count,
             'total': total_count,
-            'percentage': percentage
+            'percentage': round((settled_count / total_count) * 100)
         }
 
     def check_fully_settled(self):
         """检查是否全部结算"""
-        progress = self.get_settlement_progress()
-        return progress['settled'] == progress['total'] and progress['total'] > 0
+        return (self.participant_count or 0) > 0 and self.settled_count == self.participant_count
 
     def get_unsettled_participants(self):
         """获取未结算的参与者列表"""
@@ -178,7 +387,30 @@ class Bill(db.Model):
     def __repr__(self):
         return f'<Bill {self.description}: {self.amount}>'
 
+def _settlement_status_memo():
+    """本次请求（应用上下文）内的结算状态缓存 {id(账单): (账单, {id(users): (users, 结算状态)})}"""
+    if not has_app_context():
+        return {}
+    if 'settlement_status' not in g:
+        g.settlement_status = {}
+    return g.settlement_status
+
+@event.listens_for(Bill, 'expire')
+@event.listens_for(Bill, 'refresh')
+def _clear_settlement_status_cache(bill, *args):
+    """账单对象过期或刷新时丢弃结算状态缓存"""
+    if bill is not None:  # 提交时过期的对象可能已被回收
+        bill._clear_settlement_status()
+
+@event.listens_for(Bill.__table__, 'after_create')
+def _create_bill_search_index(table, connection, **kw):
+    create_fts_index(connection, fts_ddl('bill', ['description']))
+
 class Settlement(db.Model):
+    __table_args__ = (
+        db.Index('ix_settlement_bill_settler', 'bill_id', 'settler_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False)
     settler_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -188,18 +420,314 @@ class Settlement(db.Model):
     def __repr__(self):
         return f'<Settlement {self.settler_id} paid {self.settled_amount} for bill {self.bill_id}>'
 
+class PairwiseBalance(db.Model):
+    """两两债务账本（物化视图）：debtor 欠 creditor 的未结算金额
+
+    由账单/结算操作在同一事务内增量维护，读取债务只需按用户查询少量行。
+    可通过 `flask rebuild-ledger` 从账单数据完整重建并校验。
+    """
+    __tablename__ = 'pairwise_balance'
+
+    debtor_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    creditor_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    open_bill_ids = db.Column(db.Text, nullable=False, default='')  # 未结算账单ID，逗号分隔
+
+    def get_open_bill_ids(self):
+        """返回未结算账单ID列表"""
+        return [int(x) for x in self.open_bill_ids.split(',') if x]
+
+    @staticmethod
+    def add_debt(debtor_id, creditor_id, bill_id, amount):
+        """记入一笔债务（单条UPSERT语句，并发安全）"""
+        table = PairwiseBalance.__table__
+        stmt = sqlite_insert(table).values(
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            amount=round(amount, 2),
+            open_bill_ids=str(bill_id)
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['debtor_id', 'creditor_id'],
+            set_={
+                'amount': db.func.round(table.c.amount + stmt.excluded.amount, 2),
+                'open_bill_ids': db.case(
+                    (table.c.open_bill_ids == '', stmt.excluded.open_bill_ids),
+                    else_=table.c.open_bill_ids + ',' + stmt.excluded.open_bill_ids
+                )
+            }
+        )
+        db.session.execute(stmt)
+
+    @staticmethod
+    def remove_debt(debtor_id, creditor_id, bill_id, amount):
+        """冲销一笔债务，账单清空后删除该行"""
+        table = PairwiseBalance.__table__
+        pair = db.and_(table.c.debtor_id == debtor_id, table.c.creditor_id == creditor_id)
+        remaining_ids = db.func.trim(
+            db.func.replace(',' + table.c.open_bill_ids + ',', f',{int(bill_id)},', ','), ','
+        )
+        db.session.execute(
+            table.update().where(pair).values(
+                amount=db.func.round(table.c.amount - round(amount, 2), 2),
+                open_bill_ids=remaining_ids
+            )
+        )
+        db.session.execute(table.delete().where(pair).where(table.c.open_bill_ids == ''))
+
+    @staticmethod
+    def apply_bill_debts(bill, debts, sign=1):
+        """将账单的未结算债务 {债务人ID: 金额} 记入(sign=1)或冲销(sign=-1)账本"""
+        for debtor_id, amount in debts.items():
+            if sign > 0:
+                PairwiseBalance.add_debt(debtor_id, bill.payer_id, bill.id, amount)
+            else:
+                PairwiseBalance.remove_debt(debtor_id, bill.payer_id, bill.id, amount)
+
+    @staticmethod
+    def rebuild():
+        """从全部账单重新计算债务账本，返回债务对数量"""
+        from collections import defaultdict
+
+        pairs = defaultdict(lambda: {'amount': 0, 'bill_ids': []})
+        for bill in Bill.with_details().order_by(Bill.id).all():
+            for debtor_id, amount in bill.get_open_debts().items():
+                pair = pairs[(debtor_id, bill.payer_id)]
+                pair['amount'] += amount
+                pair['bill_ids'].append(str(bill.id))
+
+        PairwiseBalance.query.delete()
+        db.session.add_all(
+            PairwiseBalance(
+                debtor_id=debtor_id,
+                creditor_id=creditor_id,
+                amount=round(data['amount'], 2),
+                open_bill_ids=','.join(data['bill_ids'])
+            )
+            for (debtor_id, creditor_id), data in pairs.items()
+        )
+        db.session.commit()
+        return len(pairs)
+
+    def __repr__(self):
+        return f'<PairwiseBalance {self.debtor_id} owes {self.creditor_id} {self.amount}>'
+
 class Receipt(db.Model):
     """账单凭证模型（支持多文件）"""
     id = db.Column(db.Integer, primary_key=True)
     bill_id = db.Column(db.Integer, db.ForeignKey('bill.id'), nullable=False)
     filename = db.Column(db.String(200), nullable=False)
     file_type = db.Column(db.String(10), nullable=False)  # pdf/image
-    file_size = db.Column(db.Integer)  # 文件大小（字节）
+    file_size = db.Column(db.Integer)  # 文件大小（字节），图片压缩后为压缩后的大小
+    original_size = db.Column(db.Integer)  # 上传时的原始大小（字节）
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # 内容寻址存储中的文件；为空表示旧版按账单目录存放的文件（<bill_id>/<filename>）
+    blob_key = db.Column(db.String(80), db.ForeignKey('receipt_blob.key'))
+    # 压缩图片时选择保留的原图
+    original_blob_key = db.Column(db.String(80), db.ForeignKey('receipt_blob.key'))
+
+    __table_args__ = (
+        db.Index('ix_receipt_bill_id', 'bill_id'),
+        db.Index('ix_receipt_blob_key', 'blob_key'),
+    )
+
+    @property
+    def storage_path(self):
+        """文件相对 UPLOAD_FOLDER 的路径"""
+        if self.blob_key:
+            return blob_relative_path(self.blob_key)
+        return f'{self.bill_id}/{self.filename}'
+
+    @staticmethod
+    def release_files(receipts):
+        """删除凭证前调用：释放文件引用，返回提交后应删除的 (存储键列表, 旧版文件相对路径列表)"""
+        blob_keys = [key for receipt in receipts for key in (receipt.blob_key, receipt.original_blob_key) if key]
+        legacy_paths = [receipt.storage_path for receipt in receipts if not receipt.blob_key]
+        return ReceiptBlob.release(blob_keys), legacy_paths
 
     def __repr__(self):
         return f'<Receipt {self.filename} for bill {self.bill_id}>'
 
+class ReceiptBlob(db.Model):
+    """内容寻址存储中的凭证文件（见 storage.py），ref_count 为引用该文件的凭证数量"""
+    __tablename__ = 'receipt_blob'
+
+    key = db.Column(db.String(80), primary_key=True)  # sha256 + 扩展名
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @staticmethod
+    def acquire(key, size):
+        """引用计数加一（文件首次出现时创建记录），与凭证记录在同一事务中提交"""
+        table = ReceiptBlob.__table__
+        stmt = sqlite_insert(table).values(key=key, size=size, ref_count=1, created_at=datetime.utcnow())
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={'ref_count': table.c.ref_count + 1}
+        ))
+
+    @staticmethod
+    def release(keys):
+        """引用计数减少，删除计数归零的记录并返回其存储键（调用方在提交后删除文件）"""
+        if not keys:
+            return []
+        table = ReceiptBlob.__table__
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        db.session.execute(
+            table.update().where(table.c.key == db.bindparam('blob_key'))
+            .values(ref_count=table.c.ref_count - db.bindparam('released')),
+            [{'blob_key': key, 'released': count} for key, count in counts.items()]
+        )
+        unreferenced = db.and_(table.c.key.in_(list(counts)), table.c.ref_count <= 0)
+        if SQLITE_HAS_RETURNING:
+            return db.session.execute(
+                table.delete().where(unreferenced).returning(table.c.key)
+            ).scalars().all()
+        # 上面的 UPDATE 已取得写锁，查询和删除之间计数不会变化
+        keys = db.session.execute(db.select(table.c.key).where(unreferenced)).scalars().all()
+        if keys:
+            db.session.execute(table.delete().where(table.c.key.in_(keys)))
+        return keys
+
+    @staticmethod
+    def is_referenced(key, for_update=False):
+        """文件是否仍被凭证引用
+
+        for_update=True 时同时取得数据库写锁（调用方删除文件后结束事务以释放）：上传时先登记引用
+        （同样需要写锁）再检查文件是否已存在，因此持有写锁期间删除文件不会删掉刚被新上传复用的文件。
+        """
+        if not for_update:
+            return db.session.get(ReceiptBlob, key) is not None
+        table = ReceiptBlob.__table__
+        # 不修改数据的 UPDATE 也会取得写锁，匹配的行数即是否存在引用
+        result = db.session.execute(
+            table.update().where(table.c.key == key).values(ref_count=table.c.ref_count)
+        )
+        return result.rowcount > 0
+
+class Job(db.Model):
+    """后台任务（见 jobs.py）
+
+    status: pending（run_after 之后可领取）| running | done | failed（重试次数用尽）。
+    同一 idempotency_key 同时只保留一个 pending 任务，重复提交会被忽略。
+    """
+    __tablename__ = 'job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    idempotency_key = db.Column(db.String(200))
+    last_error = db.Column(db.Text)
+    locked_at = db.Column(db.DateTime)  # 最近一次被领取的时间
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+        db.Index('ux_job_pending_key', 'idempotency_key', unique=True, sqlite_where=db.text("status = 'pending'")),
+    )
+
+    @staticmethod
+    def enqueue(kind, payload, idempotency_key=None, delay=0, max_attempts=5):
+        """在当前事务中登记任务（随调用方的数据一起提交）"""
+        now = datetime.utcnow()
+        table = Job.__table__
+        stmt = sqlite_insert(table).values(
+            kind=kind, payload=json.dumps(payload), status='pending', attempts=0, max_attempts=max_attempts,
+            run_after=now + timedelta(seconds=delay), idempotency_key=idempotency_key, created_at=now
+        )
+        db.session.execute(stmt.on_conflict_do_nothing(
+            index_elements=['idempotency_key'], index_where=table.c.status == 'pending'
+        ))
+        db.session.info['jobs_enqueued'] = True
+
+    @staticmethod
+    def claim(stale_before):
+        """领取一个到期任务并提交，返回任务行（id, kind, payload, attempts, max_attempts），没有时返回 None
+
+        执行中超过 stale_before 仍未结束的任务（进程中途退出）会被重新领取。
+        """
+        now = datetime.utcnow()
+        table = Job.__table__
+        claimable = db.or_(
+            db.and_(table.c.status == 'pending', table.c.run_after <= now),
+            db.and_(table.c.status == 'running', table.c.locked_at < stale_before)
+        )
+        columns = (table.c.id, table.c.kind, table.c.payload, table.c.attempts, table.c.max_attempts)
+        claim = table.update().values(status='running', attempts=table.c.attempts + 1, locked_at=now)
+        candidate = db.select(table.c.id).where(claimable).order_by(table.c.run_after, table.c.id).limit(1)
+
+        if SQLITE_HAS_RETURNING:
+            # 单条 UPDATE ... RETURNING，多个线程/进程同时领取时每个任务只会被一个领取到
+            job = db.session.execute(
+                claim.where(table.c.id == candidate.scalar_subquery()).returning(*columns)
+            ).first()
+        else:
+            # 先查询再带条件更新：任务已被其他线程/进程领取时更新不到行，重新查询
+            while True:
+                job_id = db.session.execute(candidate).scalar()
+                if job_id is None:
+                    job = None
+                    break
+                if db.session.execute(claim.where(table.c.id == job_id, claimable)).rowcount:
+                    job = db.session.execute(db.select(*columns).where(table.c.id == job_id)).first()
+                    break
+                db.session.rollback()
+        db.session.commit()
+        return job
+
+    @staticmethod
+    def finish(job_id, error=None, retry_at=None):
+        """记录执行结果：成功；失败且 retry_at 不为空时等待重试；否则标记为 failed"""
+        table = Job.__table__
+        now = datetime.utcnow()
+        if error is None:
+            values = {'status': 'done', 'finished_at': now, 'last_error': None}
+        elif retry_at is not None:
+            values = {'status': 'pending', 'run_after': retry_at, 'last_error': error}
+        else:
+            values = {'status': 'failed', 'finished_at': now, 'last_error': error}
+        # 重新进入 pending 时若已有相同 idempotency_key 的新任务，替换掉它（两者内容相同）
+        db.session.execute(table.update().prefix_with('OR REPLACE').where(table.c.id == job_id).values(**values))
+        db.session.commit()
+
+    @staticmethod
+    def retry_failed(job_ids=None):
+        """把失败的任务重新放回队列，返回数量"""
+        table = Job.__table__
+        stmt = table.update().prefix_with('OR REPLACE').where(table.c.status == 'failed')
+        if job_ids:
+            stmt = stmt.where(table.c.id.in_(job_ids))
+        result = db.session.execute(stmt.values(
+            status='pending', attempts=0, run_after=datetime.utcnow(), finished_at=None
+        ))
+        db.session.info['jobs_enqueued'] = True
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def purge_finished(before):
+        """删除 before 之前已完成的任务，返回删除数量"""
+        result = db.session.execute(
+            Job.__table__.delete().where(Job.status == 'done', Job.finished_at < before)
+        )
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def count_by_status():
+        return dict(db.session.execute(db.select(Job.status, db.func.count(Job.id)).group_by(Job.status)).all())
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
 class SystemConfig(db.Model):
     """系统配置模型（键值对存储）"""
     id = db.Column(db.Integer, primary_key=True)
@@ -209,31 +737,64 @@ class SystemConfig(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # 进程内配置缓存 {key: 已转换类型的值}，整体替换以保证读取线程安全
+    _cache = None
+    _cache_loaded_at = 0.0
+    _cache_lock = threading.Lock()
+    cache_ttl = None  # 缓存有效期（秒），None 表示只在写入时刷新；多进程部署时建议设置
+
+    @staticmethod
+    def parse_value(value):
+        """将字符串配置值转换为合适的类型"""
+        try:
+            # 处理布尔值
+            if value.lower() in ['true', 'false']:
+                return value.lower() == 'true'
+            # 处理整数
+            if value.isdigit():
+                return int(value)
+            # 处理浮点数
+            if '.' in value and value.replace('.', '').isdigit():
+                return float(value)
+            # 返回字符串
+            return value
+        except:
+            return value
+
+    @staticmethod
+    def configure_cache(ttl=None):
+        """设置缓存有效期（秒），0 或 None 表示不过期"""
+        SystemConfig.cache_ttl = ttl or None
+
+    @staticmethod
+    def load_cache():
+        """从数据库一次性加载全部配置到缓存"""
+        with SystemConfig._cache_lock:
+            SystemConfig._cache = {
+                config.key: SystemConfig.parse_value(config.value)
+                for config in SystemConfig.query.all()
+            }
+            SystemConfig._cache_loaded_at = time.monotonic()
+        return SystemConfig._cache
+
+    @staticmethod
+    def invalidate_cache():
+        """丢弃缓存，下次读取时重新加载"""
+        with SystemConfig._cache_lock:
+            SystemConfig._cache = None
+
     @staticmethod
     def get_config(key, default_value=None):
-        """获取配置值"""
-        config = SystemConfig.query.filter_by(key=key).first()
-        if config:
-            # 尝试转换为合适的类型
-            try:
-                # 处理布尔值
-                if config.value.lower() in ['true', 'false']:
-                    return config.value.lower() == 'true'
-                # 处理整数
-                if config.value.isdigit():
-                    return int(config.value)
-                # 处理浮点数
-                if '.' in config.value and config.value.replace('.', '').isdigit():
-                    return float(config.value)
-                # 返回字符串
-                return config.value
-            except:
-                return config.value
-        return default_value
+        """获取配置值（读取进程内缓存）"""
+        cache = SystemConfig._cache
+        ttl = SystemConfig.cache_ttl
+        if cache is None or (ttl and time.monotonic() - SystemConfig._cache_loaded_at > ttl):
+            cache = SystemConfig.load_cache()
+        return cache.get(key, default_value)
 
     @staticmethod
     def set_config(key, value, description=None):
-        """设置配置值"""
+        """设置配置值（调用方负责提交事务，提交成功后才写入缓存）"""
         config = SystemConfig.query.filter_by(key=key).first()
         if config:
             config.value = str(value)
@@ -248,11 +809,35 @@ class SystemConfig(db.Model):
             )
             db.session.add(config)
 
+        db.session.info.setdefault('system_config_updates', {})[key] = SystemConfig.parse_value(str(value))
+
+    @staticmethod
+    def update_cache(updates):
+        """把已提交的配置值写入缓存"""
+        with SystemConfig._cache_lock:
+            if SystemConfig._cache is not None:
+                SystemConfig._cache = {**SystemConfig._cache, **updates}
+
     def __repr__(self):
         return f'<SystemConfig {self.key}={self.value}>'
 
+@event.listens_for(Session, 'after_commit')
+def _apply_system_config_updates(session):
+    updates = session.info.pop('system_config_updates', None)
+    if updates:
+        SystemConfig.update_cache(updates)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_system_config_updates(session):
+    session.info.pop('system_config_updates', None)
+
 class LoginLog(db.Model):
     """登录日志模型"""
+    __table_args__ = (
+        db.Index('ix_login_log_login_time', 'login_time'),
+        db.Index('ix_login_log_username', 'username'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     username = db.Column(db.String(80), nullable=False)  # 记录用户名，即使用户被删除也能查看
@@ -265,6 +850,138 @@ class LoginLog(db.Model):
     # 关系
     user = db.relationship('User', backref='login_logs', lazy=True)
 
+    SEARCH_COLUMNS = ['username', 'ip_address', 'user_agent', 'failure_reason']
+
+    @staticmethod
+    def text_filter(text, column=None):
+        """构建文本搜索条件（子串匹配），column 为空时搜索用户名、IP、用户代理和失败原因"""
+        matches, conditions = fts_search(LoginLog, text, LoginLog.SEARCH_COLUMNS, column)
+        if matches is not None:
+            conditions.append(LoginLog.id.in_(db.select(matches.c.id)))
+        return db.and_(*conditions)
+
+    @staticmethod
+    def archive_before(cutoff, archive_file, chunk_size=5000):
+        """将 cutoff 之前的登录日志逐批写入归档文件（JSON Lines）并从表中删除
+
+        每批用 DELETE ... RETURNING 取出并删除同一批行（SQLite 3.35 之前先查询再按ID删除，
+        删除的行数不足说明其他进程已归档了其中一部分，回滚后重取这一批），多个进程同时归档也不会重复。
+        先写归档文件再提交删除；提交失败时归档中可能多出一批仍在表中的记录，但不会丢失日志。
+        返回归档的记录数。
+        """
+        table = LoginLog.__table__
+        archived = 0
+        while True:
+            chunk = db.select(table.c.id).where(table.c.login_time < cutoff).order_by(table.c.id).limit(chunk_size)
+            if SQLITE_HAS_RETURNING:
+                rows = db.session.execute(
+                    table.delete().where(table.c.id.in_(chunk)).returning(*table.c)
+                ).mappings().all()
+            else:
+                rows = db.session.execute(db.select(table).where(table.c.id.in_(chunk))).mappings().all()
+                ids = [row['id'] for row in rows]
+                if rows and db.session.execute(table.delete().where(table.c.id.in_(ids))).rowcount != len(ids):
+                    db.session.rollback()
+                    continue
+            if not rows:
+                db.session.rollback()
+                return archived
+
+            for row in sorted(rows, key=lambda r: r['id']):
+                record = dict(row)
+                if record['login_time'] is not None:
+                    record['login_time'] = record['login_time'].isoformat()
+                archive_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            archive_file.flush()
+            db.session.commit()
+            archived += len(rows)
+
     def __repr__(self):
         status = "成功" if self.success else "失败"
-        return f'<LoginLog {self.username} {status} at {self.login_time}>'
\ No newline at end of file
+        return f'<LoginLog {self.username} {status} at {self.login_time}>'
+
+@event.listens_for(LoginLog.__table__, 'after_create')
+def _create_login_log_search_index(table, connection, **kw):
+    create_fts_index(connection, fts_ddl('login_log', LoginLog.SEARCH_COLUMNS))
+
+class LoginStatsDaily(db.Model):
+    """按天、用户名汇总的登录次数，由登录日志写入线程增量维护
+
+    原始登录日志归档后汇总仍然保留，管理页面的统计只读此表。
+    """
+    __tablename__ = 'login_stats_daily'
+
+    date = db.Column(db.Date, primary_key=True)
+    username = db.Column(db.String(80), primary_key=True)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def record_batch(records):
+        """将一批登录日志（字段同 LoginLog）累加到每日汇总"""
+        counts = {}
+        for record in records:
+            login_time = record.get('login_time') or datetime.utcnow()
+            key = (login_time.date(), record['username'])
+            success, failure = counts.get(key, (0, 0))
+            if record['success']:
+                success += 1
+            else:
+                failure += 1
+            counts[key] = (success, failure)
+        if not counts:
+            return
+
+        table = LoginStatsDaily.__table__
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['date', 'username'],
+            set_={
+                'success_count': table.c.success_count + stmt.excluded.success_count,
+                'failure_count': table.c.failure_count + stmt.excluded.failure_count
+            }
+        )
+        db.session.execute(stmt, [
+            {'date': date, 'username': username, 'success_count': success, 'failure_count': failure}
+            for (date, username), (success, failure) in counts.items()
+        ])
+
+    @staticmethod
+    def get_totals():
+        """返回登录统计 {'total', 'success', 'failed', 'success_rate'}"""
+        success, failed = db.session.execute(db.select(
+            db.func.coalesce(db.func.sum(LoginStatsDaily.success_count), 0),
+            db.func.coalesce(db.func.sum(LoginStatsDaily.failure_count), 0)
+        )).one()
+        total = success + failed
+        return {
+            'total': total,
+            'success': success,
+            'failed': failed,
+            'success_rate': round((success / total * 100) if total > 0 else 0, 1)
+        }
+
+    @staticmethod
+    def rebuild():
+        """从现有登录日志重新生成每日汇总（已归档的日志无法计入）"""
+        LoginStatsDaily.query.delete()
+        db.session.execute(db.text(
+            'INSERT INTO login_stats_daily (date, username, success_count, failure_count) '
+            'SELECT date(login_time), username, SUM(success = 1), SUM(success = 0) '
+            'FROM login_log WHERE login_time IS NOT NULL '
+            'GROUP BY date(login_time), username'
+        ))
+        db.session.commit()
+
+    def __repr__(self):
+        return f'<LoginStatsDaily {self.date} {self.username} {self.success_count}/{self.failure_count}>'
+
+class SchemaVersion(db.Model):
+    """数据库结构版本记录，每条对应一个已应用的迁移"""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SchemaVersion {self.version} {self.description}>'
@@ -0,0 +1,150 @@
+"""按请求统计SQL语句（开发和生产环境均可开启）
+
+QueryProfiler 挂在 SQLAlchemy 的 before/after_cursor_execute 事件上，每个请求记录：
+语句数、数据库总耗时、同一语句模板（指纹）的重复次数。请求结束时：
+- 重复次数达到阈值的语句按疑似 N+1 查询打印（通常是循环里逐个加载关系或 User）
+- 在响应头 Server-Timing 中输出数据库耗时和语句数，浏览器开发者工具可直接查看
+慢查询日志不依赖开关，耗时超过阈值的语句随时连同端点名打印。
+
+开启时每条语句只多一次计时和一次字典计数，指纹的正则归一化在请求结束时对去重后的语句执行。
+
+query_budget() / assert_query_budgets() 供测试使用，超出语句预算时抛出 AssertionError。
+"""
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import url_for
+from sqlalchemy import event
+
+# 各端点的语句数预算（登录后的一次 GET 请求），超出即视为性能回退
+QUERY_BUDGETS = {
+    'index': 11,
+    'dashboard': 13,
+    'api_debt_details': 3,
+}
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:\?|:\w+|__\[POSTCOMPILE_\w+\])\s*,?)+\)')
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+
+
+def fingerprint(statement):
+    """把语句归一化为模板：合并空白，数字和字符串字面量替换为 ?，IN 列表合并为 (?+)"""
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _PLACEHOLDER_LIST.sub('(?+)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryProfile:
+    """单个请求的SQL统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()  # 原始语句 -> 执行次数
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.duration += elapsed
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        """返回重复次数 >= threshold 的 [(指纹, 次数), ...]，按次数降序"""
+        fingerprints = Counter()
+        for statement, count in self.statements.items():
+            fingerprints[fingerprint(statement)] += count
+        return [(fp, count) for fp, count in fingerprints.most_common() if count >= threshold]
+
+    def server_timing(self):
+        return f'db;dur={self.duration * 1000:.1f};desc="{self.count} queries"'
+
+
+class QueryProfiler:
+    """请求级SQL统计与慢查询日志"""
+
+    def __init__(self, enabled=False, slow_query_ms=200, n_plus_one_threshold=5):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms  # 0 表示不记录慢查询
+        self.n_plus_one_threshold = n_plus_one_threshold
+
+    def configure(self, enabled=None, slow_query_ms=None, n_plus_one_threshold=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if slow_query_ms is not None:
+            self.slow_query_ms = slow_query_ms
+        if n_plus_one_threshold is not None:
+            self.n_plus_one_threshold = n_plus_one_threshold
+
+    def start(self):
+        """请求开始时调用，未开启时返回 None"""
+        return QueryProfile() if self.enabled else None
+
+    def record(self, profile, statement, elapsed, endpoint):
+        """每条语句执行后调用（profile 为 None 表示当前不在请求中或未开启）"""
+        if profile is not None:
+            profile.record(statement, elapsed)
+        if self.slow_query_ms and elapsed * 1000 >= self.slow_query_ms:
+            print(f"慢查询 [{endpoint}] {elapsed * 1000:.1f}ms: {_WHITESPACE.sub(' ', statement).strip()[:500]}")
+
+    def finish(self, profile, endpoint, response=None):
+        """请求结束时调用：报告疑似 N+1 查询并写入 Server-Timing 响应头"""
+        if profile is None:
+            return
+        for statement, count in profile.repeated(self.n_plus_one_threshold):
+            print(f"疑似N+1查询 [{endpoint}] 同一语句执行 {count} 次: {statement[:300]}")
+        if response is not None:
+            timing = response.headers.get('Server-Timing')
+            response.headers['Server-Timing'] = (
+                f'{timing}, {profile.server_timing()}' if timing else profile.server_timing()
+            )
+
+
+@contextmanager
+def query_budget(engine, max_queries, label='block'):
+    """统计代码块内执行的语句数，超过 max_queries 时抛出 AssertionError
+
+    用法（pytest）:
+        with query_budget(db.engine, 5):
+            client.get('/dashboard')
+    """
+    profile = QueryProfile()
+    started = {}
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        started[id(cursor)] = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        profile.record(statement, time.perf_counter() - started.pop(id(cursor), time.perf_counter()))
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+    try:
+        yield profile
+    finally:
+        event.remove(engine, 'before_cursor_execute', before)
+        event.remove(engine, 'after_cursor_execute', after)
+
+    if profile.count > max_queries:
+        details = '\n'.join(f'  {count}x {statement}' for statement, count in profile.repeated(1))
+        raise AssertionError(f'{label} 执行了 {profile.count} 条SQL，预算 {max_queries}:\n{details}')
+
+
+def assert_query_budgets(app, client, budgets=None):
+    """对每个端点发起一次 GET 请求并检查语句预算（client 需已登录）
+
+    用法（pytest）:
+        client.post('/login', data={...})
+        assert_query_budgets(app, client)
+    """
+    budgets = QUERY_BUDGETS if budgets is None else budgets
+    with app.test_request_context():
+        engine = app.extensions['sqlalchemy'].engine
+        urls = {endpoint: url_for(endpoint) for endpoint in budgets}
+    for endpoint, max_queries in budgets.items():
+        with query_budget(engine, max_queries, label=endpoint):
+            response = client.get(urls[endpoint])
+        assert response.status_code == 200, f'{endpoint} 返回 {response.status_code}'
@@ -0,0 +1,200 @@
+"""凭证目录与数据库的核对（孤儿文件回收）
+
+遍历 UPLOAD_FOLDER，与数据库中凭证引用的文件做集合比较：
+- 孤儿文件：磁盘上有、数据库未引用（提交失败或进程中途退出留下的文件、删除失败的文件、
+  长时间未清理的暂存文件），只统计修改时间早于 min_age 的文件，避免误判正在上传或压缩的文件
+- 缺失文件：数据库引用了、磁盘上没有
+缩略图/预览图跟随原文件：原文件被引用时不算孤儿。
+
+孤儿文件可只报告，也可移到隔离目录（保持相对路径，确认无误后手动删除）。
+每个目录的 mtime 和文件列表保存在检查点文件中，目录的 mtime 未变化（没有增删文件）时直接使用
+上次的文件列表，不再 scandir，因此每次核对只需 stat 各个目录。
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+from models import db, Bill, Receipt, ReceiptBlob
+from storage import BLOB_FOLDER, STAGING_FOLDER, blob_relative_path
+from thumbnails import RENDITION_SIZES
+
+# 修改时间距扫描开始不到该时间（纳秒）的目录不写入检查点缓存：同一时间戳内可能还有文件增删
+_MTIME_SETTLE_NS = 2 * 10 ** 9
+_RENDITION_SUFFIXES = tuple(f'.{name}.{fmt}' for name in RENDITION_SIZES for fmt in ('webp', 'jpg'))
+
+
+def rendition_source(relative_path):
+    """缩略图/预览图对应的原文件相对路径，不是缩略图时返回 None"""
+    for suffix in _RENDITION_SUFFIXES:
+        if relative_path.endswith(suffix):
+            return relative_path[:-len(suffix)]
+    return None
+
+
+class StorageReconciler:
+    """凭证目录的增量核对"""
+
+    def __init__(self, root, checkpoint_path, quarantine_dir, min_age=3600):
+        self.root = root
+        self.checkpoint_path = checkpoint_path
+        self.quarantine_dir = quarantine_dir
+        self.min_age = min_age  # 秒
+
+    # ------------------------------------------------------------------
+    # 检查点
+    # ------------------------------------------------------------------
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_checkpoint(self, checkpoint):
+        temp_path = f'{self.checkpoint_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    # ------------------------------------------------------------------
+    # 扫描
+    # ------------------------------------------------------------------
+    def scan(self, cached_dirs, full=False):
+        """返回 ({文件相对路径: 修改时间}, 新的目录缓存, 重新扫描的目录数)"""
+        files = {}
+        dirs = {}
+        rescanned = 0
+        scan_started_ns = time.time_ns()
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue  # 扫描期间被删除的目录
+
+            cached = cached_dirs.get(relative_dir)
+            if not full and cached is not None and cached['mtime_ns'] == mtime_ns:
+                listing = cached
+            else:
+                try:
+                    listing = self._list_directory(path, top_level=not relative_dir)
+                except FileNotFoundError:
+                    continue
+                rescanned += 1
+                # 刚修改过的目录下次仍重新扫描
+                listing['mtime_ns'] = mtime_ns if scan_started_ns - mtime_ns > _MTIME_SETTLE_NS else None
+            dirs[relative_dir] = listing
+
+            prefix = f'{relative_dir}/' if relative_dir else ''
+            for name, mtime in listing['files'].items():
+                files[prefix + name] = mtime
+            stack.extend(prefix + name for name in listing['subdirs'])
+        return files, dirs, rescanned
+
+    @staticmethod
+    def _list_directory(path, top_level=False):
+        files = {}
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # 跳过隐藏文件；顶层的暂存区需要检查遗留文件
+                if entry.name.startswith('.') and not (top_level and entry.name == STAGING_FOLDER):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files[entry.name] = entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+        return {'files': files, 'subdirs': subdirs}
+
+    @staticmethod
+    def expected_paths():
+        """数据库中引用的全部文件相对路径"""
+        expected = set()
+        receipts = db.session.execute(
+            db.select(Receipt.bill_id, Receipt.filename, Receipt.blob_key, Receipt.original_blob_key)
+        )
+        for bill_id, filename, key, original_key in receipts:
+            expected.add(blob_relative_path(key) if key else f'{bill_id}/{filename}')
+            if original_key:
+                expected.add(blob_relative_path(original_key))
+        # 旧版只记录在账单上的凭证
+        legacy_bills = db.session.execute(
+            db.select(Bill.id, Bill.receipt_filename)
+            .where(Bill.receipt_filename.isnot(None), ~Bill.receipts.any())
+        )
+        expected.update(f'{bill_id}/{filename}' for bill_id, filename in legacy_bills)
+        # 结束读事务，扫描目录可能耗时较长
+        db.session.rollback()
+        return expected
+
+    # ------------------------------------------------------------------
+    # 核对
+    # ------------------------------------------------------------------
+    def run(self, quarantine=False, full=False):
+        """核对一次并保存检查点，返回报告字典（含孤儿和缺失文件列表）"""
+        started = time.monotonic()
+        checkpoint = self.load_checkpoint()
+        expected = self.expected_paths()
+        files, dirs, rescanned = self.scan(checkpoint.get('dirs', {}), full=full)
+
+        on_disk = set(files)
+        cutoff = time.time() - self.min_age
+        orphans = sorted(
+            path for path in on_disk - expected
+            if rendition_source(path) not in expected and files[path] < cutoff
+        )
+        missing = sorted(expected - on_disk)
+
+        quarantined = self.quarantine(orphans) if quarantine and orphans else []
+        report = {
+            'finished_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'directories': len(dirs),
+            'rescanned_directories': rescanned,
+            'files': len(files),
+            'orphans': orphans,
+            'orphan_bytes': sum(self._size(path) for path in orphans if path not in quarantined),
+            'missing': missing,
+            'quarantined': len(quarantined),
+            'duration_seconds': round(time.monotonic() - started, 3),
+        }
+        self._save_checkpoint({
+            'dirs': dirs,
+            'last_report': {key: len(value) if isinstance(value, list) else value for key, value in report.items()},
+        })
+        return report
+
+    def quarantine(self, orphans):
+        """把孤儿文件移到隔离目录（保持相对路径），返回已移动的文件列表"""
+        target_root = os.path.join(self.quarantine_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        moved = []
+        for relative_path in orphans:
+            parts = relative_path.split('/')
+            source = rendition_source(relative_path) or relative_path
+            try:
+                # 扫描后可能有相同内容的新上传重新引用了该文件：持有写锁检查并移动（见 ReceiptBlob.is_referenced）
+                if parts[0] == BLOB_FOLDER and ReceiptBlob.is_referenced(source.rsplit('/', 1)[-1], for_update=True):
+                    continue
+                target = os.path.join(target_root, *parts)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(os.path.join(self.root, *parts), target)
+                moved.append(relative_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"隔离文件失败: {relative_path}, 错误: {e}")
+            finally:
+                db.session.rollback()  # 释放写锁（未修改数据）
+        return moved
+
+    def _size(self, relative_path):
+        try:
+            return os.path.getsize(os.path.join(self.root, *relative_path.split('/')))
+        except OSError:
+            return 0
@@ -10,8 +10,8 @@ from config import get_config
 
 def check_python_version():
     """检查Python版本兼容性"""
-    if sys.version_info < (3, 6):
-        print("错误: 需要Python 3.6或更高版本")
+    if sys.version_info < (3, 7):
+        print("错误: 需要Python 3.7或更高版本")
         print(f"当前版本: {sys.version}")
         sys.exit(1)
 
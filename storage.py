@@ -0,0 +1,165 @@
+"""凭证文件的内容寻址存储
+
+上传文件在解析 multipart 请求体时就按块写入存储目录下的暂存区（与最终位置在同一文件系统），
+边写边计算 SHA-256；提交时原子 rename 到 blobs/ab/cd/<sha256><扩展名>，不再经过系统临时目录复制。
+相同内容（且扩展名相同）的文件只保存一份，引用计数记录在 ReceiptBlob 表中（见 models.py）。
+
+目录结构（相对 UPLOAD_FOLDER）:
+    .staging/            未提交的上传文件，请求结束时未提交的自动删除
+    blobs/ab/cd/<key>    已提交的文件，key 为 sha256 + 扩展名
+    <bill_id>/<文件名>    旧版按账单存放的文件（只读兼容）
+"""
+import hashlib
+import os
+import tempfile
+
+BLOB_FOLDER = 'blobs'
+STAGING_FOLDER = '.staging'
+
+# 同一种格式的常见别名统一扩展名，避免同一文件因扩展名写法不同而重复存储
+_EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+
+
+def blob_key(sha256, filename):
+    """由内容摘要和原文件名得到存储键"""
+    ext = os.path.splitext(filename)[1].lower()
+    return sha256 + _EXTENSION_ALIASES.get(ext, ext)
+
+
+def blob_relative_path(key):
+    """存储键对应的相对路径（两级目录分散，避免单个目录文件过多）"""
+    return f'{BLOB_FOLDER}/{key[:2]}/{key[2:4]}/{key}'
+
+
+class StagedUpload:
+    """写入暂存区的上传文件（供 Werkzeug 作为上传文件的 stream 使用）
+
+    写入时累计 SHA-256 和字节数；未被 ReceiptStore.commit() 取走时，close() 会删除暂存文件。
+    """
+
+    def __init__(self, staging_dir):
+        fd, self.path = tempfile.mkstemp(dir=staging_dir, prefix='upload_')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def detach(self):
+        """落盘并关闭文件，返回暂存路径（之后由调用方负责该文件）"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        path, self.path = self.path, None
+        return path
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class ReceiptStore:
+    """内容寻址的凭证文件存储（只负责文件，引用计数由 ReceiptBlob 维护）"""
+
+    def __init__(self, root):
+        self.root = root
+
+    @property
+    def staging_dir(self):
+        return os.path.join(self.root, STAGING_FOLDER)
+
+    def open_staging(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        return StagedUpload(self.staging_dir)
+
+    def stage(self, stream, chunk_size=64 * 1024):
+        """把任意文件对象按块复制到暂存区（上传文件不是 StagedUpload 时使用）"""
+        staged = self.open_staging()
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                staged.write(chunk)
+        except BaseException:
+            staged.close()
+            raise
+        return staged
+
+    def path(self, key):
+        return os.path.join(self.root, *blob_relative_path(key).split('/'))
+
+    def commit(self, staged, filename):
+        """把暂存文件原子移动到内容寻址位置，返回 (存储键, 是否新文件)
+
+        内容相同的文件已存在时直接丢弃暂存文件。
+        """
+        key = blob_key(staged.sha256, filename)
+        if os.path.exists(self.path(key)):
+            staged.close()
+            return key, False
+        return self.commit_path(staged.detach(), staged.sha256, filename)
+
+    def commit_path(self, staged_path, sha256, filename):
+        """提交暂存区中已写好的文件（如后台进程生成的压缩图片），返回值同 commit()"""
+        key = blob_key(sha256, filename)
+        target = self.path(key)
+        if os.path.exists(target):
+            os.remove(staged_path)
+            return key, False
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(staged_path, target)
+        except OSError:
+            os.remove(staged_path)
+            raise
+        return key, True
+
+    def delete(self, key):
+        """删除文件及空的分散目录（文件不存在时忽略）"""
+        target = self.path(key)
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            return
+        for folder in (os.path.dirname(target), os.path.dirname(os.path.dirname(target))):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
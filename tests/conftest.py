@@ -0,0 +1,74 @@
+"""测试公共夹具
+
+app 模块导入时按 DATABASE_PATH 创建数据库引擎，因此在导入之前指向临时目录；
+每个测试开始前删除数据库文件，由 init_database() 或迁移测试重新创建。
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='roommate-bills-test-'), 'database.db')
+
+from app import app as flask_app, init_database, user_cache  # noqa: E402
+from config import TestingConfig  # noqa: E402
+from models import db  # noqa: E402
+
+flask_app.config.from_object(TestingConfig)
+
+
+@pytest.fixture
+def database_path():
+    """空的数据库文件路径（测试结束后关闭连接）"""
+    path = os.environ['DATABASE_PATH']
+    with flask_app.app_context():
+        db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    user_cache.invalidate()
+    yield path
+    with flask_app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def app(database_path):
+    """已初始化（默认用户和系统配置）的应用"""
+    with flask_app.app_context():
+        init_database()
+    yield flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+
+@pytest.fixture
+def check_ledger(app):
+    """返回检查函数：增量维护的债务账本与逐账单计算（calculate_debt_details）结果一致，返回账本明细"""
+    from app import calculate_debt_details, get_debt_details
+    from models import User
+
+    def normalize(details):
+        return {
+            direction: sorted((item['user'], round(item['amount'], 2), sorted(item['bills']))
+                              for item in details[direction])
+            for direction in ('i_owe', 'owe_me')
+        }
+
+    def check():
+        with app.app_context():
+            ledger = {}
+            for user in User.query.order_by(User.id):
+                expected = normalize(calculate_debt_details(user.id))
+                actual = normalize(get_debt_details(user.id))
+                assert actual == expected, f'{user.username} 的账本与计算结果不一致'
+                ledger[user.id] = actual
+            return ledger
+
+    return check
@@ -0,0 +1,77 @@
+"""账单列表接口的游标分页和筛选"""
+from models import Bill
+
+
+def login(client, username):
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, participants, bill_date):
+    response = client.post('/add_bill', data={
+        'amount': '30',
+        'bill_type': 'other',
+        'custom_description': '测试账单',
+        'participants': [str(user_id) for user_id in participants],
+        'bill_date': bill_date,
+    })
+    assert response.status_code == 302
+
+
+def fetch_all(client, **params):
+    """按 next_cursor 逐页读取，返回 (账单ID列表, 页数)"""
+    ids, pages, cursor = [], 0, None
+    while True:
+        query = dict(params, before=cursor) if cursor else params
+        result = client.get('/api/bills', query_string=query).get_json()
+        ids += [bill['id'] for bill in result['bills']]
+        pages += 1
+        cursor = result['next_cursor']
+        if cursor is None:
+            return ids, pages
+
+
+def test_cursor_pagination_across_equal_dates(client):
+    login(client, 'roommate1')
+    for bill_date in ['2024-03-01'] * 5 + ['2024-02-01'] * 2 + ['2024-03-02']:
+        add_bill(client, [1, 2], bill_date)
+
+    with client.application.app_context():
+        expected = [bill.id for bill in Bill.query.order_by(Bill.date.desc(), Bill.id.desc())]
+    ids, pages = fetch_all(client, limit=2)
+    assert ids == expected
+    assert pages == 4
+
+    ids, pages = fetch_all(client, limit=3)
+    assert ids == expected
+    assert pages == 3
+
+
+def test_filters(client):
+    login(client, 'roommate1')
+    add_bill(client, [1, 2], '2024-03-01')
+    add_bill(client, [1, 3], '2024-03-02')
+    login(client, 'roommate2')
+    add_bill(client, [2, 3], '2024-03-03')
+    client.get('/settle_individual/3/3')
+
+    def ids(**params):
+        return fetch_all(client, limit=1, **params)[0]
+
+    assert ids(payer=1) == [2, 1]
+    assert ids(participant=3) == [3, 2]
+    assert ids(settled='true') == [3]
+    assert ids(settled='false', participant=2) == [1]
+    assert ids(**{'from': '2024-03-02', 'to': '2024-03-02'}) == [2]
+
+
+def test_render_html_and_invalid_parameters(client):
+    login(client, 'roommate1')
+    add_bill(client, [1, 2], '2024-03-01')
+    result = client.get('/api/bills', query_string={'render': 'html'}).get_json()
+    assert result['next_cursor'] is None and len(result['bills']) == 1
+    assert '测试账单' in result['html']
+
+    for params in ({'before': 'abc'}, {'before': 'abc,1'}, {'limit': '0'}, {'payer': 'x'}, {'from': '03/01/2024'}):
+        assert client.get('/api/bills', query_string=params).status_code == 400
@@ -0,0 +1,81 @@
+"""账单搜索接口（全文 + 筛选 + 分类统计）"""
+
+
+def login(client, username):
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, bill_type, notes, amount=30, bill_date='2024-03-01'):
+    response = client.post('/add_bill', data={
+        'amount': str(amount),
+        'bill_type': bill_type,
+        'custom_description': notes,
+        'notes': notes if bill_type != 'other' else '',
+        'participants': ['1', '2'],
+        'bill_date': bill_date,
+    })
+    assert response.status_code == 302
+
+
+def search(client, **params):
+    response = client.get('/api/bills/search', query_string=params)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def seed(client):
+    login(client, 'roommate1')
+    add_bill(client, 'water', '三月水费', amount=45, bill_date='2024-03-05')
+    add_bill(client, 'electricity', '三月电费', amount=120, bill_date='2024-03-06')
+    add_bill(client, 'other', '周末聚餐火锅', amount=200, bill_date='2024-03-09')
+    login(client, 'roommate2')
+    add_bill(client, 'electricity', '二月电费', amount=98, bill_date='2024-02-06')
+    add_bill(client, 'other', '火锅底料', amount=25, bill_date='2024-03-10')
+
+
+def descriptions(result):
+    return [bill['description'] for bill in result['bills']]
+
+
+def facet(result, name, key):
+    return {item[key]: item['count'] for item in result['facets'][name]}
+
+
+def test_search_without_keywords(client):
+    seed(client)
+    result = search(client, limit=2)
+    assert result['total'] == 5 and result['has_more']
+    assert descriptions(result) == ['📝 火锅底料', '📝 周末聚餐火锅']
+    assert facet(result, 'category', 'category') == {'electricity': 2, 'water': 1, 'other': 2}
+    assert facet(result, 'payer', 'payer_id') == {1: 3, 2: 2}
+
+    # 按某一维度筛选时，该维度的统计不受自身筛选影响
+    result = search(client, category='electricity', payer=1)
+    assert descriptions(result) == ['⚡ 电费 - 三月电费']
+    assert facet(result, 'category', 'category') == {'electricity': 1, 'water': 1, 'other': 1}
+    assert facet(result, 'payer', 'payer_id') == {1: 1, 2: 1}
+
+    result = search(client, amount_min=50, amount_max=150, **{'from': '2024-03-01'})
+    assert descriptions(result) == ['⚡ 电费 - 三月电费']
+
+
+def test_search_keywords(client):
+    seed(client)
+    # 不少于3个字符的词走全文索引（子串匹配），更短的词用 LIKE 过滤
+    assert sorted(descriptions(search(client, q='聚餐火锅'))) == ['📝 周末聚餐火锅']
+    assert sorted(descriptions(search(client, q='火锅'))) == ['📝 周末聚餐火锅', '📝 火锅底料']
+    result = search(client, q='电费 三月')
+    assert descriptions(result) == ['⚡ 电费 - 三月电费']
+    assert facet(result, 'payer', 'payer_id') == {1: 1}
+
+    result = search(client, q='电费', page=2, limit=1)
+    assert result['total'] == 2 and not result['has_more'] and len(result['bills']) == 1
+    assert facet(result, 'category', 'category') == {'electricity': 2}
+
+
+def test_search_invalid_parameters(client):
+    login(client, 'roommate1')
+    for params in ({'page': '0'}, {'limit': 'x'}, {'payer': 'x'}, {'amount_min': 'x'}, {'to': '2024/01/01'}):
+        assert client.get('/api/bills/search', query_string=params).status_code == 400
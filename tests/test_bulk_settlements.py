@@ -0,0 +1,80 @@
+"""批量结算接口"""
+from models import Bill
+
+
+def login(client, username):
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, amount, participants, description):
+    response = client.post('/add_bill', data={
+        'amount': str(amount),
+        'bill_type': 'other',
+        'custom_description': description,
+        'participants': [str(user_id) for user_id in participants],
+    })
+    assert response.status_code == 302
+    with client.application.app_context():
+        return Bill.query.order_by(Bill.id.desc()).first().id
+
+
+def bulk(client, body):
+    return client.post('/api/settlements/bulk', json=body)
+
+
+def test_bulk_settle_items(client, check_ledger):
+    login(client, 'roommate2')
+    first = add_bill(client, 30, [1, 2, 3], '买菜')
+    second = add_bill(client, 20, [2, 3], '外卖')
+
+    response = bulk(client, {'items': [
+        {'bill_id': first, 'user_id': 1}, {'bill_id': first, 'user_id': 3}, {'bill_id': second, 'user_id': 3},
+    ]})
+    result = response.get_json()
+    assert result['settled_count'] == 3
+    assert result['bills'][str(first)] == {'is_settled': True, 'settled_users': [1, 3]}
+    assert check_ledger()[3]['i_owe'] == []
+
+    response = bulk(client, {'items': [{'bill_id': second, 'user_id': 3, 'settled': False}]})
+    assert response.get_json()['unsettled_count'] == 1
+    assert check_ledger()[3]['i_owe'] == [('室友2', 10.0, ['📝 外卖'])]
+
+    # 任一条目校验失败时整批不执行
+    login(client, 'roommate3')
+    response = bulk(client, {'items': [{'bill_id': second, 'user_id': 3}]})
+    assert response.status_code == 403
+    assert check_ledger()[3]['i_owe'] == [('室友2', 10.0, ['📝 外卖'])]
+
+
+def test_bulk_settle_filter(client, check_ledger):
+    login(client, 'roommate2')
+    add_bill(client, 30, [1, 2, 3], '买菜')
+    add_bill(client, 20, [2, 3], '外卖')
+    login(client, 'roommate4')
+    add_bill(client, 40, [3, 4], '网费')
+
+    # 默认结清当前用户作为债权人的账单
+    login(client, 'roommate2')
+    response = bulk(client, {'filter': {'debtor_id': 3}})
+    assert response.get_json()['settled_count'] == 2
+    ledger = check_ledger()
+    assert ledger[3]['i_owe'] == [('室友4', 20.0, ['📝 网费'])]
+
+    # 普通用户不能结清其他人作为债权人的账单
+    response = bulk(client, {'filter': {'debtor_id': 3, 'creditor_id': 4}})
+    assert response.status_code == 403
+
+
+def test_admin_bulk_settle_filter_for_other_creditor(client, check_ledger):
+    login(client, 'roommate2')
+    add_bill(client, 30, [1, 2, 3], '买菜')
+    add_bill(client, 20, [2, 3], '外卖')
+
+    login(client, 'roommate1')
+    response = bulk(client, {'filter': {'debtor_id': 3, 'creditor_id': 2}})
+    assert response.get_json()['settled_count'] == 2
+    ledger = check_ledger()
+    assert ledger[3]['i_owe'] == []
+    assert ledger[1]['i_owe'] == [('室友2', 10.0, ['📝 买菜'])]
@@ -0,0 +1,55 @@
+"""健康检查与存活/就绪探针"""
+import time
+
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture
+def health_checker(app, monkeypatch):
+    checker = app_module.health_checker
+    monkeypatch.setattr(checker, '_snapshot', None)
+    monkeypatch.setattr(checker, '_ensure_started', lambda: None)  # 测试中不启动后台线程
+    return checker
+
+
+def test_live(client):
+    response = client.get('/health/live')
+    assert response.status_code == 200
+    assert response.get_json() == {'status': 'alive'}
+
+
+def test_ready_computes_first_snapshot(client, health_checker):
+    response = client.get('/health/ready')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['status'] == 'ready' and body['health'] in ('healthy', 'degraded')
+
+    health = client.get('/health').get_json()
+    assert health['checks']['database']['status'] == 'ok'
+    assert health['checks']['application']['active_users'] == 4
+
+
+def test_ready_rejects_stale_snapshot(client, health_checker, monkeypatch):
+    result = health_checker.refresh()
+    monkeypatch.setattr(health_checker, '_snapshot', (result, time.time() - 3600))
+
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.get_json()['reason'] == 'stale'
+
+    # 完整检查仍返回200，但标记为降级
+    response = client.get('/health')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'degraded'
+
+
+def test_ready_rejects_unhealthy(client, health_checker, monkeypatch):
+    result = {'status': 'unhealthy', 'checks': {'database': {'status': 'error', 'message': '数据库连接失败'}}}
+    monkeypatch.setattr(health_checker, '_snapshot', (result, time.time()))
+
+    assert client.get('/health/ready').status_code == 503
+    response = client.get('/health')
+    assert response.status_code == 503
+    assert response.get_json()['checks']['database']['age_seconds'] >= 0
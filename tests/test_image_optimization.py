@@ -0,0 +1,84 @@
+"""上传图片的重新编码和缩小"""
+import io
+import os
+
+import pytest
+
+import app as app_module
+import thumbnails
+from models import Receipt, ReceiptBlob
+from storage import ReceiptStore
+
+if not thumbnails.available():
+    pytest.skip('需要 Pillow', allow_module_level=True)
+
+from PIL import Image  # noqa: E402
+
+
+def photo_png(size, exif=None):
+    # 渐变叠加噪点，无损压缩效果差，接近手机拍摄的凭证
+    image = Image.blend(Image.linear_gradient('L').resize(size), Image.effect_noise(size, 4), 0.5).convert('RGB')
+    out = io.BytesIO()
+    image.save(out, 'PNG', exif=exif) if exif is not None else image.save(out, 'PNG')
+    return out.getvalue()
+
+
+def test_optimize_image(tmp_path):
+    source = tmp_path / 'receipt.png'
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 顺时针旋转90度拍摄
+    source.write_bytes(photo_png((3000, 1000), exif))
+
+    staged_path, sha256, size, ext = thumbnails.optimize_image(str(source), str(tmp_path), 2560, 'jpeg', 85)
+    assert ext == '.jpg' and size == os.path.getsize(staged_path) < source.stat().st_size
+    with Image.open(staged_path) as image:
+        assert image.format == 'JPEG' and image.size == (853, 2560)
+        assert not image.getexif().get(0x0112)
+
+
+def test_optimize_image_skips_small_gains(tmp_path):
+    source = tmp_path / 'receipt.png'
+    Image.new('RGB', (200, 200), (255, 255, 255)).save(source, 'PNG')
+    assert thumbnails.optimize_image(str(source), str(tmp_path), 2560, 'jpeg', 85) is None
+    assert os.listdir(tmp_path) == ['receipt.png']
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ReceiptStore(str(tmp_path / 'receipts'))
+    monkeypatch.setattr(app_module, 'receipt_store', store)
+    monkeypatch.setattr(app_module, 'UPLOADS_BASE', str(tmp_path))
+    return store
+
+
+@pytest.mark.parametrize('keep_original', [False, True], ids=['replace', 'keep-original'])
+def test_uploaded_image_is_recompressed(client, store, keep_original):
+    original = photo_png((3000, 2000))
+    client.post('/login', data={'username': 'roommate1', 'password': 'password123'})
+    data = {'amount': '10', 'bill_type': 'other', 'custom_description': '凭证', 'participants': ['1', '2'],
+            'receipts': (io.BytesIO(original), 'receipt.png')}
+    if keep_original:
+        data['keep_original'] = '1'
+    assert client.post('/add_bill', data=data, content_type='multipart/form-data').status_code == 302
+    app_module.job_queue.run_pending(client.application)
+
+    with client.application.app_context():
+        receipt = Receipt.query.one()
+        assert receipt.filename.endswith('_receipt.webp') and receipt.file_type == 'image'
+        assert receipt.original_size == len(original) and receipt.file_size < len(original)
+        with Image.open(store.path(receipt.blob_key)) as image:
+            assert max(image.size) == 2560
+        blob_keys = sorted(key for key, in ReceiptBlob.query.with_entities(ReceiptBlob.key))
+        if keep_original:
+            assert os.path.exists(store.path(receipt.original_blob_key))
+            assert blob_keys == sorted([receipt.blob_key, receipt.original_blob_key])
+        else:
+            assert receipt.original_blob_key is None
+            assert blob_keys == [receipt.blob_key]
+            blob_files = [name for _, _, names in os.walk(os.path.join(store.root, 'blobs')) for name in names
+                          if not name.startswith(receipt.blob_key + '.')]  # 不含缩略图
+            assert blob_files == [receipt.blob_key]
+        storage_path = receipt.storage_path
+
+    response = client.get(f'/uploads/receipts/{storage_path}')
+    assert response.status_code == 200 and response.mimetype == 'image/webp'
@@ -0,0 +1,89 @@
+"""后台任务队列"""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import models
+from jobs import JobQueue
+from models import db, Job
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'select-then-update'])
+def returning(request, monkeypatch):
+    if request.param and not models.SQLITE_HAS_RETURNING:
+        pytest.skip('当前 SQLite 或 SQLAlchemy 不支持 RETURNING')
+    monkeypatch.setattr(models, 'SQLITE_HAS_RETURNING', request.param)
+    return request.param
+
+
+def statuses(kind):
+    return sorted(db.session.execute(db.select(Job.status).where(Job.kind == kind)).scalars())
+
+
+def test_claim(app, returning):
+    with app.app_context():
+        # init_database() 登记的凭证核对任务尚未到期
+        db.session.execute(db.update(Job).values(run_after=datetime.utcnow() + timedelta(hours=1)))
+        Job.enqueue('echo', {'n': 1})
+        Job.enqueue('echo', {'n': 2})
+        Job.enqueue('echo', {'n': 3}, delay=3600)
+        db.session.commit()
+
+        stale_before = datetime.utcnow() - timedelta(minutes=10)
+        first, second = Job.claim(stale_before), Job.claim(stale_before)
+        assert [first.payload, second.payload] == ['{"n": 1}', '{"n": 2}']
+        assert first.attempts == 1
+        assert Job.claim(stale_before) is None
+        assert statuses('echo') == ['pending', 'running', 'running']
+
+        # 执行中超过 stale_before 的任务（进程中途退出）会被重新领取
+        reclaimed = Job.claim(datetime.utcnow() + timedelta(seconds=1))
+        assert reclaimed.id == first.id and reclaimed.attempts == 2
+
+
+def test_concurrent_claims_take_each_job_once(app, returning):
+    with app.app_context():
+        db.session.execute(db.update(Job).values(run_after=datetime.utcnow() + timedelta(hours=1)))
+        for n in range(40):
+            Job.enqueue('echo', {'n': n})
+        db.session.commit()
+
+    claimed = []
+
+    def worker():
+        with app.app_context():
+            stale_before = datetime.utcnow() - timedelta(minutes=10)
+            while True:
+                job = Job.claim(stale_before)
+                if job is None:
+                    return
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(claimed) == len(set(claimed)) == 40
+
+
+def test_run_pending_retries_failed_jobs(app, returning):
+    queue = JobQueue(max_attempts=2, retry_delay=0)
+    calls = []
+
+    @queue.handler('flaky')
+    def flaky(payload):
+        calls.append(payload['n'])
+        if len(calls) == 1:
+            raise RuntimeError('first attempt fails')
+
+    with app.app_context():
+        db.session.execute(db.update(Job).values(run_after=datetime.utcnow() + timedelta(hours=1)))
+        queue.enqueue('flaky', {'n': 1})
+        db.session.commit()
+    assert queue.run_pending(app) == 2
+    assert calls == [1, 1]
+    assert queue.stats == {'succeeded': 1, 'retried': 1, 'failed': 0}
+    with app.app_context():
+        assert statuses('flaky') == ['done']
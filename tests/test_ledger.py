@@ -0,0 +1,67 @@
+"""两两债务账本的增量维护"""
+from models import Bill
+
+
+def login(client, username):
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, amount, participants, description):
+    response = client.post('/add_bill', data={
+        'amount': str(amount),
+        'bill_type': 'other',
+        'custom_description': description,
+        'participants': [str(user_id) for user_id in participants],
+    })
+    assert response.status_code == 302
+    with client.application.app_context():
+        return Bill.query.order_by(Bill.id.desc()).first().id
+
+
+def owed(ledger, user_id):
+    """user_id 欠别人的 {(债权人, 金额, 账单描述)}"""
+    return ledger[user_id]['i_owe']
+
+
+def test_ledger_follows_bill_changes(client, check_ledger):
+    login(client, 'roommate1')
+    groceries = add_bill(client, 40, [1, 2, 3, 4], '买菜')
+    internet = add_bill(client, 30, [1, 2, 3], '网费')
+    login(client, 'roommate2')
+    add_bill(client, 20, [1, 2], '外卖')
+    cleaning = add_bill(client, 12, [2, 3, 4], '清洁用品')
+
+    ledger = check_ledger()
+    assert owed(ledger, 2) == [('室友1', 20.0, ['📝 买菜', '📝 网费'])]
+    assert owed(ledger, 1) == [('室友2', 10.0, ['📝 外卖'])]
+
+    # 单人结算与撤销
+    login(client, 'roommate1')
+    client.get(f'/settle_individual/{groceries}/2')
+    assert owed(check_ledger(), 2) == [('室友1', 10.0, ['📝 网费'])]
+    client.get(f'/settle_individual/{groceries}/2')
+    check_ledger()
+
+    # 修改金额和参与人：原有结算清除，按新的分摊重新记入
+    client.get(f'/settle_individual/{internet}/3')
+    response = client.post(f'/edit_bill/{internet}', data={
+        'description': '📝 网费', 'amount': '60', 'date': '2024-01-01', 'participants': ['1', '3'],
+    })
+    assert response.status_code == 302
+    ledger = check_ledger()
+    assert owed(ledger, 2) == [('室友1', 10.0, ['📝 买菜'])]
+    assert ('室友1', 40.0, ['📝 买菜', '📝 网费']) in owed(ledger, 3)
+
+    # 删除账单
+    login(client, 'roommate2')
+    assert client.post(f'/delete_bill/{cleaning}').status_code == 200
+    ledger = check_ledger()
+    assert ledger[4]['i_owe'] == [('室友1', 10.0, ['📝 买菜'])]
+
+    # 整单标记为已结算
+    login(client, 'roommate1')
+    client.get(f'/toggle_settlement/{groceries}')
+    ledger = check_ledger()
+    assert owed(ledger, 4) == []
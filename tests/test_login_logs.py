@@ -0,0 +1,62 @@
+"""登录日志归档"""
+import gzip
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import login_audit
+import models
+from models import db, LoginLog
+
+
+def add_logs(count, days_ago):
+    login_time = datetime.utcnow() - timedelta(days=days_ago)
+    db.session.add_all(
+        LoginLog(username=f'roommate{index % 4 + 1}', ip_address='127.0.0.1', login_time=login_time, success=True)
+        for index in range(count)
+    )
+    db.session.commit()
+
+
+@pytest.mark.parametrize('returning', [True, False], ids=['returning', 'select-then-delete'])
+def test_archive_login_logs(app, database_path, tmp_path, monkeypatch, returning):
+    if returning and not models.SQLITE_HAS_RETURNING:
+        pytest.skip('当前 SQLite 或 SQLAlchemy 不支持 RETURNING')
+    monkeypatch.setattr(models, 'SQLITE_HAS_RETURNING', returning)
+    opened = []
+    gzip_open = gzip.open
+
+    def open_after_concurrent_write(*args, **kwargs):
+        # 检查过期日志之后、删除之前，另一个连接（如登录日志写入线程）提交了新日志
+        conn = sqlite3.connect(database_path)
+        conn.execute("INSERT INTO login_log (username, login_time, success) VALUES ('roommate1', ?, 1)",
+                     (datetime.utcnow().isoformat(sep=' '),))
+        conn.commit()
+        conn.close()
+        opened.append(args[0])
+        return gzip_open(*args, **kwargs)
+
+    monkeypatch.setattr(login_audit.gzip, 'open', open_after_concurrent_write)
+
+    with app.app_context():
+        add_logs(7, days_ago=100)
+        add_logs(3, days_ago=1)
+        assert login_audit.archive_login_logs(str(tmp_path), 90) == 7
+        assert LoginLog.query.count() == 4
+
+    with gzip_open(opened[0], 'rt', encoding='utf-8') as archive_file:
+        records = [json.loads(line) for line in archive_file]
+    assert len(records) == 7
+    assert all(record['login_time'] < (datetime.utcnow() - timedelta(days=90)).isoformat() for record in records)
+    assert os.listdir(tmp_path) == [os.path.basename(opened[0])]
+
+
+def test_archive_login_logs_without_expired_logs(app, tmp_path):
+    with app.app_context():
+        add_logs(3, days_ago=1)
+        assert login_audit.archive_login_logs(str(tmp_path), 90) == 0
+        assert LoginLog.query.count() == 3
+    assert not os.listdir(tmp_path)
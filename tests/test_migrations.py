@@ -0,0 +1,130 @@
+"""从引入版本管理之前的数据库升级到最新结构"""
+import sqlite3
+
+from app import app as flask_app
+from migrations import LATEST_VERSION, upgrade_database
+from models import db, Bill, PairwiseBalance, Receipt
+
+# 版本管理之前（逗号分隔参与人、无结算计数和账本）的表结构
+BASELINE_SCHEMA = '''
+CREATE TABLE user (
+    id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, password_hash VARCHAR(120) NOT NULL,
+    display_name VARCHAR(100) NOT NULL, created_at DATETIME, is_default_password BOOLEAN NOT NULL,
+    is_admin BOOLEAN NOT NULL, last_login DATETIME, login_attempts INTEGER NOT NULL, locked_until DATETIME,
+    is_active BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (username)
+);
+CREATE TABLE system_config (
+    id INTEGER NOT NULL, "key" VARCHAR(100) NOT NULL, value VARCHAR(500) NOT NULL, description VARCHAR(200),
+    created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id), UNIQUE ("key")
+);
+CREATE TABLE bill (
+    id INTEGER NOT NULL, payer_id INTEGER NOT NULL, amount FLOAT NOT NULL, description VARCHAR(200) NOT NULL,
+    date DATETIME, participants VARCHAR(50) NOT NULL, is_settled BOOLEAN, receipt_filename VARCHAR(200),
+    receipt_type VARCHAR(10), created_at DATETIME, PRIMARY KEY (id), FOREIGN KEY(payer_id) REFERENCES user (id)
+);
+CREATE TABLE login_log (
+    id INTEGER NOT NULL, user_id INTEGER, username VARCHAR(80) NOT NULL, ip_address VARCHAR(45),
+    user_agent VARCHAR(500), login_time DATETIME, success BOOLEAN NOT NULL, failure_reason VARCHAR(200),
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id)
+);
+CREATE TABLE settlement (
+    id INTEGER NOT NULL, bill_id INTEGER NOT NULL, settler_id INTEGER NOT NULL, settled_amount FLOAT NOT NULL,
+    settled_date DATETIME, PRIMARY KEY (id), FOREIGN KEY(bill_id) REFERENCES bill (id),
+    FOREIGN KEY(settler_id) REFERENCES user (id)
+);
+CREATE TABLE receipt (
+    id INTEGER NOT NULL, bill_id INTEGER NOT NULL, filename VARCHAR(200) NOT NULL, file_type VARCHAR(10) NOT NULL,
+    file_size INTEGER, upload_date DATETIME, PRIMARY KEY (id), FOREIGN KEY(bill_id) REFERENCES bill (id)
+);
+'''
+
+
+def create_baseline_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        'INSERT INTO user (id, username, password_hash, display_name, is_default_password, is_admin, '
+        'login_attempts, is_active) VALUES (?, ?, ?, ?, 1, ?, 0, 1)',
+        [(user_id, f'roommate{user_id}', 'x', f'室友{user_id}', user_id == 1) for user_id in range(1, 5)]
+    )
+    bills = []
+    for bill_id in range(1, 13):
+        payer_id = bill_id % 4 + 1
+        # 旧数据中的参与人可能是用户ID，也可能是用户名
+        participants = 'roommate1,2,4' if bill_id % 2 else '1,2,3'
+        bills.append((bill_id, payer_id, 30.0 + bill_id, f'⚡ 电费 {bill_id}' if bill_id % 3 else f'买菜 {bill_id}',
+                      '2024-01-%02d 12:00:00' % bill_id, participants,
+                      f'receipt{bill_id}.jpg' if bill_id <= 3 else None))
+    conn.executemany(
+        'INSERT INTO bill (id, payer_id, amount, description, date, participants, is_settled, receipt_filename) '
+        'VALUES (?, ?, ?, ?, ?, ?, 0, ?)', bills
+    )
+    conn.executemany(
+        'INSERT INTO settlement (bill_id, settler_id, settled_amount) VALUES (?, 2, 10)',
+        [(bill_id,) for bill_id in range(3, 13, 3)]
+    )
+    conn.executemany(
+        "INSERT INTO receipt (bill_id, filename, file_type, file_size) VALUES (?, ?, 'image', 1000)",
+        [(bill_id, f'receipt{bill_id}.jpg') for bill_id in range(4, 13)]
+    )
+    conn.execute(
+        "INSERT INTO login_log (user_id, username, ip_address, login_time, success) "
+        "VALUES (1, 'roommate1', '127.0.0.1', '2024-01-01 08:00:00', 1)"
+    )
+    conn.commit()
+    conn.close()
+
+
+def ledger_rows():
+    return sorted(
+        (row.debtor_id, row.creditor_id, row.amount, row.open_bill_ids)
+        for row in PairwiseBalance.query.all()
+    )
+
+
+def test_upgrade_from_baseline(database_path):
+    create_baseline_database(database_path)
+
+    with flask_app.app_context():
+        assert upgrade_database() == LATEST_VERSION
+        inspector = db.inspect(db.engine)
+
+        # 升级后的表、字段和索引与新建数据库一致
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            assert columns == {column.name for column in table.columns}, table.name
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            assert indexes == {index.name for index in table.indexes}, table.name
+
+        bills = Bill.query.order_by(Bill.id).all()
+        assert len(bills) == 12
+        assert sorted(bills[0].get_participants_list()) == [1, 2, 4]
+        assert sorted(bills[1].get_participants_list()) == [1, 2, 3]
+        for bill in bills:
+            assert bill.participant_count == len(bill.get_participants_list())
+            settled_ids = {settlement.settler_id for settlement in bill.settlements}
+            assert bill.settled_count == sum(
+                1 for user_id in bill.get_participants_list() if user_id == bill.payer_id or user_id in settled_ids
+            )
+        assert bills[2].category == 'other' and bills[0].category == 'electricity'
+
+        receipts = Receipt.query.all()
+        assert len(receipts) == 9
+        assert all(receipt.original_size == 1000 and receipt.blob_key is None for receipt in receipts)
+
+        # 迁移构建的账本与模型的完整重建结果一致
+        migrated = ledger_rows()
+        assert migrated
+        PairwiseBalance.rebuild()
+        assert ledger_rows() == migrated
+
+        assert upgrade_database() == 0
+
+
+def test_fresh_database_is_not_analyzed(app):
+    # 空表的统计信息会让查询规划器低估表大小（FTS5 写入会变得极慢），新建数据库不执行 ANALYZE
+    with app.app_context():
+        assert db.session.execute(db.text(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        )).scalar() == 0
+        assert db.session.execute(db.text('SELECT MAX(version) FROM schema_version')).scalar() == LATEST_VERSION
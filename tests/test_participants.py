@@ -0,0 +1,56 @@
+"""账单参与人校验"""
+from models import db, Bill, User
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, participants):
+    return client.post('/add_bill', data={
+        'amount': '40',
+        'bill_type': 'other',
+        'custom_description': '测试账单',
+        'participants': [str(user_id) for user_id in participants],
+    })
+
+
+def test_add_bill_rejects_unknown_participant(client):
+    login(client, 'roommate1')
+    assert add_bill(client, [1, 2, 99]).status_code == 400
+    with client.application.app_context():
+        assert Bill.query.count() == 0
+
+
+def test_add_bill_rejects_inactive_participant(client):
+    with client.application.app_context():
+        User.query.filter_by(username='roommate4').one().is_active = False
+        db.session.commit()
+    login(client, 'roommate1')
+    assert add_bill(client, [1, 4]).status_code == 400
+    assert add_bill(client, [1, 2]).status_code == 302
+    with client.application.app_context():
+        assert Bill.query.one().get_participants_list() == [1, 2]
+
+
+def test_edit_bill_rejects_unknown_participant(client):
+    login(client, 'roommate1')
+    assert add_bill(client, [1, 2, 4]).status_code == 302
+    with client.application.app_context():
+        bill = Bill.query.one()
+        bill_id, description = bill.id, bill.description
+        User.query.filter_by(username='roommate4').one().is_active = False
+        db.session.commit()
+
+    form = {'description': description, 'amount': '60', 'date': '2024-01-01'}
+    response = client.post(f'/edit_bill/{bill_id}', data=dict(form, participants=['1', '99']))
+    assert response.status_code == 400
+
+    # 已停用的用户原本就是参与人时可以保留
+    response = client.post(f'/edit_bill/{bill_id}', data=dict(form, participants=['1', '4']))
+    assert response.status_code == 302
+    with client.application.app_context():
+        bill = db.session.get(Bill, bill_id)
+        assert bill.get_participants_list() == [1, 4]
+        assert bill.amount == 60
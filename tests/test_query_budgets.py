@@ -0,0 +1,39 @@
+"""首页、统计页和债务明细接口的SQL语句预算（见 profiler.QUERY_BUDGETS）"""
+from models import Bill, Settlement
+from profiler import assert_query_budgets
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def seed_bills(client):
+    """四个室友互相记账，部分参与人已结算；账单数超过一页，语句数不应随账单数增长"""
+    bill_id = 0
+    for payer in range(1, 5):
+        login(client, f'roommate{payer}')
+        for index in range(8):
+            participants = [str(user_id) for user_id in range(1, 5) if user_id != payer or index % 2]
+            response = client.post('/add_bill', data={
+                'amount': str(30 + index),
+                'bill_type': ('water', 'electricity', 'other')[index % 3],
+                'custom_description': f'测试账单 {payer}-{index}',
+                'participants': participants,
+            })
+            assert response.status_code == 302
+            bill_id += 1
+            if index % 3 == 0:
+                debtor = payer % 4 + 1
+                client.get(f'/settle_individual/{bill_id}/{debtor}')
+        client.get('/logout')
+
+
+def test_query_budgets(client):
+    seed_bills(client)
+    with client.application.app_context():
+        assert Bill.query.count() == 32
+        assert Settlement.query.count() > 0
+    login(client, 'roommate1')
+    assert_query_budgets(client.application, client)
+
@@ -0,0 +1,65 @@
+"""内容寻址凭证文件的删除与引用检查"""
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import app as app_module
+import models
+from models import db, ReceiptBlob
+from storage import ReceiptStore
+
+KEY = 'a' * 64 + '.png'
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ReceiptStore(str(tmp_path))
+    monkeypatch.setattr(app_module, 'receipt_store', store)
+    os.makedirs(os.path.dirname(store.path(KEY)))
+    with open(store.path(KEY), 'wb') as f:
+        f.write(b'receipt')
+    return store
+
+
+def test_delete_unreferenced_blob(app, store):
+    with app.app_context():
+        assert app_module.delete_unreferenced_blob(KEY)
+    assert not os.path.exists(store.path(KEY))
+
+
+def test_delete_waits_for_concurrent_upload(app, database_path, store):
+    # 相同内容的新上传已登记引用（持有写锁）但尚未提交，删除任务必须等它提交后再检查引用
+    upload = sqlite3.connect(database_path, check_same_thread=False)
+    upload.execute("INSERT INTO receipt_blob (key, size, ref_count) VALUES (?, 7, 1)", (KEY,))
+    committer = threading.Timer(0.5, upload.commit)
+    committer.start()
+    try:
+        started = time.monotonic()
+        with app.app_context():
+            assert not app_module.delete_unreferenced_blob(KEY)
+        assert time.monotonic() - started >= 0.4
+    finally:
+        committer.join()
+        upload.close()
+    assert os.path.exists(store.path(KEY))
+
+
+@pytest.mark.parametrize('returning', [True, False], ids=['returning', 'select-then-delete'])
+def test_release_returns_unreferenced_keys(app, monkeypatch, returning):
+    if returning and not models.SQLITE_HAS_RETURNING:
+        pytest.skip('当前 SQLite 或 SQLAlchemy 不支持 RETURNING')
+    monkeypatch.setattr(models, 'SQLITE_HAS_RETURNING', returning)
+    other = 'b' * 64 + '.pdf'
+    with app.app_context():
+        ReceiptBlob.acquire(KEY, 7)
+        ReceiptBlob.acquire(KEY, 7)
+        ReceiptBlob.acquire(other, 9)
+        db.session.commit()
+
+        assert ReceiptBlob.release([KEY, other]) == [other]
+        assert ReceiptBlob.release([KEY]) == [KEY]
+        db.session.commit()
+        assert ReceiptBlob.query.count() == 0
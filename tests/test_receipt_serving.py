@@ -0,0 +1,74 @@
+"""凭证文件服务：条件请求、Range 请求、缓存头和 X-Accel-Redirect"""
+import os
+
+import pytest
+
+import app as app_module
+
+BLOB_NAME = 'ab' * 32 + '.pdf'
+BLOB_PATH = f'receipts/blobs/ab/ab/{BLOB_NAME}'
+LEGACY_PATH = 'receipts/5/receipt_20240101.jpg'
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'UPLOADS_BASE', str(tmp_path))
+    for relative_path in (BLOB_PATH, LEGACY_PATH):
+        path = tmp_path / relative_path
+        os.makedirs(path.parent)
+        path.write_bytes(CONTENT)
+    return tmp_path
+
+
+@pytest.fixture
+def user_client(client):
+    client.post('/login', data={'username': 'roommate1', 'password': 'password123'})
+    return client
+
+
+def test_content_addressed_file(user_client, uploads):
+    response = user_client.get(f'/uploads/{BLOB_PATH}')
+    assert response.status_code == 200 and response.data == CONTENT
+    assert response.headers['ETag'] == f'"{BLOB_NAME}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    cache_control = response.cache_control
+    assert cache_control.private and not cache_control.public and cache_control.immutable
+    assert cache_control.max_age == app_module.RECEIPT_CACHE_MAX_AGE
+
+    response = user_client.get(f'/uploads/{BLOB_PATH}', headers={'If-None-Match': f'"{BLOB_NAME}"'})
+    assert response.status_code == 304 and not response.data
+
+
+def test_range_request(user_client, uploads):
+    response = user_client.get(f'/uploads/{BLOB_PATH}', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+    assert response.data == CONTENT[100:200]
+
+
+def test_legacy_file_uses_generated_etag(user_client, uploads):
+    response = user_client.get(f'/uploads/{LEGACY_PATH}')
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag != '"receipt_20240101.jpg"'
+    assert user_client.get(f'/uploads/{LEGACY_PATH}', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_missing_file_and_login_required(client, uploads):
+    assert client.get(f'/uploads/{BLOB_PATH}').status_code == 302
+    client.post('/login', data={'username': 'roommate1', 'password': 'password123'})
+    assert client.get('/uploads/receipts/missing.pdf').status_code == 404
+    assert client.get('/uploads/../app.py').status_code == 404
+
+
+def test_x_accel_redirect(user_client, uploads, monkeypatch):
+    monkeypatch.setitem(user_client.application.config, 'RECEIPT_SENDFILE', 'x-accel')
+    response = user_client.get(f'/uploads/{BLOB_PATH}')
+    assert response.status_code == 200 and not response.data
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/{BLOB_PATH}'
+    assert response.headers['Content-Type'] == 'application/pdf'
+    assert response.cache_control.immutable
+
+    response = user_client.get(f'/uploads/{BLOB_PATH}', headers={'If-None-Match': f'"{BLOB_NAME}"'})
+    assert response.status_code == 304 and 'X-Accel-Redirect' not in response.headers
+    assert user_client.get('/uploads/%2E%2E/app.py').status_code == 404
@@ -0,0 +1,65 @@
+"""最少转账结算方案的应用"""
+from models import db, Bill, PairwiseBalance
+
+
+def login(client, username):
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_bill(client, amount, participants):
+    response = client.post('/add_bill', data={
+        'amount': str(amount),
+        'bill_type': 'other',
+        'custom_description': '测试账单',
+        'participants': [str(user_id) for user_id in participants],
+    })
+    assert response.status_code == 302
+
+
+def ledger():
+    return {
+        (row.debtor_id, row.creditor_id): (row.amount, row.get_open_bill_ids())
+        for row in PairwiseBalance.query
+    }
+
+
+def test_apply_settle_plan(client):
+    login(client, 'roommate2')
+    add_bill(client, 40, [1, 2, 3, 4])  # 1、3、4 各欠 2 十元
+    login(client, 'roommate3')
+    add_bill(client, 30, [1, 3])  # 1 欠 3 十五元
+    login(client, 'roommate4')
+    add_bill(client, 20, [1, 4])  # 1 欠 4 十元
+
+    with client.application.app_context():
+        # 旧数据：账单已标记结清，但参与人仍有欠款，不在结算方案内
+        legacy = Bill.query.filter_by(payer_id=4).one()
+        legacy.is_settled = True
+        db.session.commit()
+        legacy_id = legacy.id
+
+    login(client, 'roommate1')
+    plan = client.get('/api/settle_plan').get_json()
+    assert plan['open_bill_count'] == 2
+
+    response = client.post('/api/settle_plan/apply', json={'plan_token': 'stale'})
+    assert response.status_code == 409
+
+    response = client.post('/api/settle_plan/apply', json={'plan_token': plan['plan_token']})
+    assert response.get_json()['settled_count'] == 4
+
+    with client.application.app_context():
+        assert Bill.query.filter_by(is_settled=False).count() == 0
+        # 只冲销方案中的债务，其他账本行保留
+        assert ledger() == {(1, 4): (10.0, [legacy_id])}
+
+
+def test_apply_settle_plan_requires_admin(client):
+    login(client, 'roommate2')
+    add_bill(client, 40, [1, 2])
+    plan = client.get('/api/settle_plan').get_json()
+    assert not plan['can_apply']
+    response = client.post('/api/settle_plan/apply', json={'plan_token': plan['plan_token']})
+    assert response.status_code == 403
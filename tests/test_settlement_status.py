@@ -0,0 +1,38 @@
+"""账单结算状态的请求内缓存"""
+from models import db, Bill, Settlement, User
+
+
+def create_bill():
+    bill = Bill(payer_id=1, amount=30, description='测试账单')
+    bill.set_participants([1, 2, 3])
+    db.session.add(bill)
+    db.session.commit()
+    return bill.id
+
+
+def test_settlement_status_is_memoized_per_users_map(app):
+    with app.app_context():
+        bill = db.session.get(Bill, create_bill())
+        users = {user.id: user for user in User.query.all()}
+        status = bill.get_settlement_status(users)
+        assert sorted(status) == [1, 2, 3]
+        assert bill.get_settlement_status(users) is status
+
+        # 不同的 users 映射单独计算
+        assert sorted(bill.get_settlement_status({1: users[1]})) == [1]
+        assert bill.get_settlement_status() is not status
+
+
+def test_settlement_status_is_request_scoped(app):
+    with app.app_context():
+        bill_id = create_bill()
+        bill = db.session.get(Bill, bill_id)
+        assert not bill.get_settlement_status()[2]['is_settled']
+
+    with app.app_context():
+        db.session.add(Settlement(bill_id=bill_id, settler_id=2, settled_amount=10))
+        db.session.commit()
+
+    with app.app_context():
+        bill = db.session.get(Bill, bill_id)
+        assert bill.get_settlement_status()[2]['is_settled']
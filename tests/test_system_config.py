@@ -0,0 +1,37 @@
+"""系统配置缓存"""
+import pytest
+
+from models import db, SystemConfig
+
+
+def test_set_config_updates_cache_after_commit(app):
+    with app.app_context():
+        SystemConfig.set_config('security.max_login_attempts', '7')
+        assert SystemConfig.get_config('security.max_login_attempts') == 5
+        db.session.commit()
+        assert SystemConfig.get_config('security.max_login_attempts') == 7
+
+
+def test_set_config_rollback_keeps_cache(app):
+    with app.app_context():
+        SystemConfig.set_config('security.max_login_attempts', '7')
+        db.session.rollback()
+        db.session.commit()
+        assert SystemConfig.get_config('security.max_login_attempts') == 5
+
+
+def test_admin_config_commit_failure_reloads_committed_values(app, monkeypatch):
+    client = app.test_client()
+    client.post('/login', data={'username': 'roommate1', 'password': 'password123'})
+
+    def failing_commit():
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(db.session, 'commit', failing_commit)
+    with pytest.raises(RuntimeError):
+        client.post('/admin/config', data={'config_security.max_login_attempts': '9'})
+    monkeypatch.undo()
+
+    with app.app_context():
+        assert SystemConfig.get_config('security.max_login_attempts') == 5
+        assert SystemConfig.query.filter_by(key='security.max_login_attempts').one().value == '5'
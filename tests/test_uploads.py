@@ -0,0 +1,46 @@
+"""上传文件写入凭证暂存区的范围"""
+import io
+
+import pytest
+from flask import request
+from flask_login import login_user
+
+import app as app_module
+from models import User
+from storage import StagedUpload
+
+
+@pytest.fixture
+def staged(tmp_path, monkeypatch):
+    """记录写入暂存区的上传文件（暂存区放在临时目录）"""
+    opened = []
+
+    def open_staging():
+        opened.append(StagedUpload(str(tmp_path)))
+        return opened[-1]
+
+    monkeypatch.setattr(app_module.receipt_store, 'open_staging', open_staging)
+    return opened
+
+
+def upload_data():
+    return {'receipts': (io.BytesIO(b'x' * 1024), 'receipt.png')}
+
+
+def test_receipt_upload_is_staged(app, staged):
+    with app.test_request_context('/add_bill', method='POST', data=upload_data()):
+        login_user(User.query.filter_by(username='roommate1').first())
+        assert isinstance(request.files['receipts'].stream, StagedUpload)
+    assert len(staged) == 1
+
+
+def test_other_endpoints_are_not_staged(app, staged):
+    client = app.test_client()
+    client.post('/login', data={'username': 'roommate1', 'password': 'password123', **upload_data()})
+    assert staged == []
+
+
+def test_anonymous_upload_is_not_staged(app, staged):
+    with app.test_request_context('/add_bill', method='POST', data=upload_data()):
+        assert not isinstance(request.files['receipts'].stream, StagedUpload)
+    assert staged == []
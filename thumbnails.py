@@ -0,0 +1,251 @@
+"""凭证图片处理：上传压缩与缩略图/预览图生成
+
+上传的图片可重新编码（按 EXIF 方向旋转、去除 EXIF、缩小到最大边长、WebP/渐进式JPEG），
+见 optimize_image()。图片生成小图（thumb）和中图（preview）；PDF 先把第一页栅格化再生成同样的两种尺寸。
+生成的文件与原文件放在同一目录，文件名为 <原文件名>.<尺寸名>.<格式>，例如
+blobs/ab/cd/<key>.thumb.webp。内容相同的凭证共用同一份文件，因此也只生成一次。
+
+图片处理在独立的进程池中执行（spawn 方式启动，避免 fork 多线程的 Web 进程），
+不占用请求线程，也不受 GIL 影响。依赖 Pillow（可选）；PDF 需要 poppler-utils 的 pdftoppm
+或 PyMuPDF，都没有时跳过 PDF。缺少依赖时查看器直接使用原文件。
+"""
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+
+# 尺寸名 -> 最长边像素
+RENDITION_SIZES = {'thumb': 320, 'preview': 1280}
+RENDITION_QUALITY = 80
+PDF_RASTER_DPI = 110
+
+
+def available():
+    return Image is not None
+
+
+def rendition_format():
+    """优先 WebP（体积更小），Pillow 未编译 WebP 支持时使用 JPEG"""
+    if Image is not None and features.check('webp'):
+        return 'webp'
+    return 'jpg'
+
+
+def rendition_path(source_path, size_name, fmt):
+    return f'{source_path}.{size_name}.{fmt}'
+
+
+def _rasterize_pdf(source_path):
+    """把 PDF 第一页转换为 PIL 图片，无法转换时返回 None"""
+    if shutil.which('pdftoppm'):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            prefix = os.path.join(temp_dir, 'page')
+            subprocess.run(
+                ['pdftoppm', '-f', '1', '-l', '1', '-r', str(PDF_RASTER_DPI), '-png', '-singlefile',
+                 source_path, prefix],
+                check=True, capture_output=True, timeout=60
+            )
+            with Image.open(prefix + '.png') as page:
+                page.load()
+                return page.copy()
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        return None
+    with fitz.open(source_path) as document:
+        pixmap = document[0].get_pixmap(dpi=PDF_RASTER_DPI)
+        return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def generate_renditions(source_path, file_type, fmt):
+    """为一个原文件生成缺失的缩略图/预览图（在工作进程中执行），返回新生成的文件数"""
+    targets = {name: rendition_path(source_path, name, fmt) for name in RENDITION_SIZES}
+    missing = {name: path for name, path in targets.items() if not os.path.exists(path)}
+    if not missing or not os.path.exists(source_path):
+        return 0
+
+    if file_type == 'pdf':
+        image = _rasterize_pdf(source_path)
+        if image is None:
+            return 0
+    else:
+        with Image.open(source_path) as original:
+            # 按 EXIF 方向旋转，手机照片否则会横躺
+            image = ImageOps.exif_transpose(original)
+            image.load()
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    created = 0
+    # 从大到小依次缩放，小图基于中图生成以减少计算
+    for name in sorted(missing, key=RENDITION_SIZES.get, reverse=True):
+        image.thumbnail((RENDITION_SIZES[name], RENDITION_SIZES[name]))
+        temp_path = f'{missing[name]}.tmp{os.getpid()}'
+        if fmt == 'webp':
+            image.save(temp_path, 'WEBP', quality=RENDITION_QUALITY, method=4)
+        else:
+            image.save(temp_path, 'JPEG', quality=RENDITION_QUALITY, optimize=True, progressive=True)
+        os.replace(temp_path, missing[name])
+        created += 1
+    return created
+
+
+def _sha256_file(path, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def optimize_image(source_path, staging_dir, max_dimension, fmt, quality):
+    """重新编码上传的图片（在工作进程中执行）
+
+    按 EXIF 方向旋转后去除 EXIF，缩小到最长边不超过 max_dimension，编码为 WebP 或渐进式 JPEG，
+    结果写入暂存区。返回 (暂存路径, sha256, 字节数, 扩展名)；动图或压缩后节省不到 10% 时返回 None。
+    """
+    original_size = os.path.getsize(source_path)
+    with Image.open(source_path) as original:
+        if getattr(original, 'is_animated', False):
+            return None
+        image = ImageOps.exif_transpose(original)
+        image.load()
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # 透明背景铺白色（截图类凭证），JPEG/有损WebP按不透明图片保存
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail((max_dimension, max_dimension))
+
+    if fmt == 'webp' and not features.check('webp'):
+        fmt = 'jpeg'
+    fd, temp_path = tempfile.mkstemp(dir=staging_dir, prefix='optimized_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if fmt == 'webp':
+                image.save(f, 'WEBP', quality=quality, method=4)
+            else:
+                image.save(f, 'JPEG', quality=quality, optimize=True, progressive=True)
+            f.flush()
+            os.fsync(f.fileno())
+        size = os.path.getsize(temp_path)
+        if size > original_size * 0.9:
+            os.remove(temp_path)
+            return None
+        return temp_path, _sha256_file(temp_path), size, '.webp' if fmt == 'webp' else '.jpg'
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def delete_renditions(source_path):
+    """删除原文件的全部缩略图/预览图"""
+    for name in RENDITION_SIZES:
+        for fmt in ('webp', 'jpg'):
+            try:
+                os.remove(rendition_path(source_path, name, fmt))
+            except FileNotFoundError:
+                pass
+
+
+class Thumbnailer:
+    """图片处理进程池（首次提交任务时启动）"""
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self.enabled = True
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()  # 多个任务线程可能同时提交
+        self._pending = set()  # 尚未完成的 Future，关闭时取消（cancel_futures 需要 Python 3.9）
+
+    @property
+    def active(self):
+        return self.enabled and available()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _submit(self, fn, *args):
+        future = self._get_executor().submit(fn, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def submit(self, files):
+        """提交 [(原文件绝对路径, 文件类型)]，在后台生成，立即返回"""
+        if not self.active:
+            return []
+        fmt = rendition_format()
+        futures = []
+        for source_path, file_type in files:
+            future = self._submit(generate_renditions, source_path, file_type, fmt)
+            future.add_done_callback(_report_failure(source_path))
+            futures.append(future)
+        return futures
+
+    def generate(self, source_path, file_type):
+        """生成一个文件的缩略图/预览图并等待完成（后台任务使用，失败时抛出异常），返回新生成的文件数"""
+        if not self.active:
+            return 0
+        return self._submit(generate_renditions, source_path, file_type, rendition_format()).result()
+
+    def optimize(self, source_path, staging_dir, max_dimension, fmt, quality):
+        """提交图片压缩任务，返回 Future（结果见 optimize_image），未启用时返回 None"""
+        if not self.active:
+            return None
+        return self._submit(optimize_image, source_path, staging_dir, max_dimension, fmt, quality)
+
+    def run(self, files):
+        """生成并等待完成（补生成命令使用），返回 (新生成的文件数, 失败数)"""
+        created = failed = 0
+        for future in self.submit(files):
+            try:
+                created += future.result()
+            except Exception:
+                failed += 1
+        return created, failed
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for future in pending:
+                future.cancel()  # 已交给工作进程的任务无法取消
+            # Python 3.9 之前 wait=False 关闭进程池后解释器退出时会卡住，等待已交给工作进程的几个任务完成
+            self._executor.shutdown(wait=sys.version_info < (3, 9))
+            self._executor = None
+
+
+def _report_failure(source_path):
+    def callback(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"缩略图生成失败: {source_path}, 错误: {future.exception()}")
+    return callback